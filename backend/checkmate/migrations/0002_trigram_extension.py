@@ -0,0 +1,12 @@
+from django.db import migrations
+from django.contrib.postgres.operations import TrigramExtension
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("checkmate", "0001_initial"),
+    ]
+
+    operations = [
+        TrigramExtension(),
+    ]
@@ -185,6 +185,33 @@ CHANNEL_LAYERS = {
         },
     },
 }
+# Updates to the hunt data are folded into one broadcast until none arrive for
+# BROADCAST_DEBOUNCE, but no later than BROADCAST_MAX_LATENCY after the first.
+BROADCAST_DEBOUNCE = 0.1  # s
+BROADCAST_MAX_LATENCY = 0.5  # s
+# Payloads at least this large are also sent as zlib compressed binary frames to
+# websocket clients that opt in.
+WEBSOCKET_COMPRESSION_THRESHOLD = 16 * 1024  # bytes
+# Activity updates are deduplicated per tab and broadcast together this often.
+ACTIVITY_BROADCAST_INTERVAL = 0.25  # s
+# Websocket clients can opt in to receiving only the digest of these round and
+# puzzle fields when they are at least LAZY_TEXT_THRESHOLD long.
+LAZY_TEXT_FIELDS = ("notes",)
+LAZY_TEXT_THRESHOLD = 256  # characters
+# Send Discord ids as strings instead of numbers (see `structure/encoding.py`).
+SNOWFLAKE_STRINGS = False
+# Metrics are added to Redis by a thread of each process this often (None to
+# keep them in the process).
+METRICS_FLUSH_INTERVAL = 1.0  # s
+# Rebalance a container in the background once moving a relation leaves less
+# than this between the keys of its neighbours (see `structure/relations.py`).
+RELATION_REBALANCE_GAP = 1024
+# Edits of only notes or tags are saved at most this often (see
+# `structure/edits.py`). 0 saves them immediately.
+EDIT_BUFFER_INTERVAL = 1.0  # s
+# Leader election between broadcast master workers (see `manage.py runmaster`).
+MASTER_LEASE_TTL = 10.0  # s, how long a standby waits for a stuck leader
+MASTER_STANDBY_POLL_INTERVAL = 0.1  # s
 
 
 # Auth
@@ -205,6 +232,8 @@ if "oauth" in DRIVE_SETTINGS:
     # Google OAuth uses the secret but not the key field, but it needs to exist
     DRIVE_SETTINGS["oauth"]["key"] = ""
 DISCORD_CREDENTIALS = SECRETS.get("DISCORD_CREDENTIALS", {})
+# Bearer token for scraping /metrics without a staff login.
+METRICS_TOKEN = SECRETS.get("METRICS_TOKEN")
 
 SOCIALACCOUNT_PROVIDERS = {
     "discord": {
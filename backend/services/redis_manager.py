@@ -1,4 +1,3 @@
-import functools
 import logging
 
 from django.conf import settings
@@ -8,30 +7,6 @@ logger = logging.getLogger(__name__)
 
 
 class RedisManager(redis.Redis):
-    class RLock(redis.lock.Lock):
-        def __init__(self, rmgr, redis, name, *args, **kwargs):
-            super().__init__(redis, name, *args, **kwargs)
-            self.__rmgr = rmgr
-            self.__name = name
-            self.__reentrant = None
-
-        def __enter__(self, *args, **kwargs):
-            self.__reentrant = self.__name in self.__rmgr._semaphores
-            self.__rmgr._semaphore_incr(self.__name)
-            if self.__reentrant:
-                return None
-            else:
-                return super().__enter__(*args, **kwargs)
-
-        def __exit__(self, *args, **kwargs):
-            self.__rmgr._semaphore_decr(self.__name)
-            if self.__reentrant:
-                value = None
-            else:
-                value = super().__exit__(*args, **kwargs)
-            self.__reentrant = None
-            return value
-
     __instance = None
 
     @classmethod
@@ -49,18 +24,3 @@ class RedisManager(redis.Redis):
             port=settings.REDIS_PORT,
             db=settings.REDIS_DATABASE_ENUM.REDIS_CLIENT,
         )
-        self._semaphores = {}
-
-    def _semaphore_incr(self, name):
-        self._semaphores.setdefault(name, 0)
-        self._semaphores[name] += 1
-
-    def _semaphore_decr(self, name):
-        self._semaphores[name] -= 1
-        if self._semaphores[name] == 0:
-            del self._semaphores[name]
-
-    def reentrant_lock(self, *args, **kwargs):
-        return self.lock(
-            *args, **kwargs, lock_class=functools.partial(RedisManager.RLock, self)
-        )
@@ -21,8 +21,10 @@ from services import scraper
 from services import scraper_types
 from services import subprocess_tasks as _  # register subprocess tasks
 from structure import api
+from structure import changes
+from structure import edits
 from structure import models
-from structure import consumers as _  # for activating update hooks
+from structure import relations
 
 logger = get_task_logger(__name__)
 
@@ -69,29 +71,42 @@ def post_autodetected_solve_puzzle(slug):
 
 @app.task
 def post_solve_puzzle(slug):
-    cleanup_puzzle.apply_async(args=[slug], countdown=5 * 60.0)
+    post_solve_puzzles([slug])
+
+
+@app.task
+def post_solve_puzzles(slugs):
+    for slug in slugs:
+        cleanup_puzzle.apply_async(args=[slug], countdown=5 * 60.0)
     bot_config = models.BotConfig.get()
-    puzzle = models.Puzzle.objects.prefetch_related("rounds", "metas__feeders").get(
-        pk=slug
+    puzzles = models.Puzzle.objects.prefetch_related("rounds", "metas__feeders").filter(
+        pk__in=slugs
     )
     # unblock metas where all feeders are solved
-    unblocked_metas = []
-    for meta in puzzle.metas.all():
-        if meta.status == models.Puzzle.BLOCKED_STATUS:
-            solved = 0
-            unsolved = 0
-            for feeder in meta.feeders.all():
-                if feeder.is_solved():
-                    solved += 1
-                else:
-                    unsolved += 1
-            if solved and not unsolved:
-                meta.status = ""
-                unblocked_metas.append(meta)
-    models.Puzzle.objects.bulk_update(unblocked_metas, ["status"])
-    asyncio.get_event_loop().run_until_complete(
-        async_post_solve_puzzle(puzzle, bot_config)
-    )
+    unblocked_metas = {}
+    for puzzle in puzzles:
+        for meta in puzzle.metas.all():
+            if meta.status == models.Puzzle.BLOCKED_STATUS:
+                solved = 0
+                unsolved = 0
+                for feeder in meta.feeders.all():
+                    if feeder.is_solved():
+                        solved += 1
+                    else:
+                        unsolved += 1
+                if solved and not unsolved:
+                    meta.status = ""
+                    unblocked_metas[meta.pk] = meta
+    with transaction.atomic():
+        models.Puzzle.objects.bulk_update(unblocked_metas.values(), ["status"])
+        changes.mark_changed(models.Puzzle, unblocked_metas)
+
+    async def post_all():
+        await asyncio.gather(
+            *(async_post_solve_puzzle(puzzle, bot_config) for puzzle in puzzles)
+        )
+
+    asyncio.get_event_loop().run_until_complete(post_all())
 
 
 async def async_post_solve_puzzle(puzzle, bot_config):
@@ -190,16 +205,41 @@ async def async_cleanup_puzzle(puzzle):
 @app.task
 def unsolve_puzzle(slug):
     "Delayed check to reset puzzle solve status."
-    puzzle = models.Puzzle.objects.get(pk=slug)
-    if not puzzle.is_solved() and puzzle.solved is not None:
-        puzzle.solved = None
-        puzzle.save(update_fields=["solved"])
-        if puzzle.discord_text_channel_id is not None:
-            dmgr = DiscordManager.instance()
-            asyncio.get_event_loop().run_until_complete(
-                dmgr.rename_channel(puzzle.discord_text_channel_id, slug)
+    unsolve_puzzles([slug])
+
+
+@app.task
+def unsolve_puzzles(slugs):
+    "Delayed check to reset the solve status of several puzzles."
+    renames = []
+    for puzzle in models.Puzzle.objects.filter(pk__in=slugs):
+        if not puzzle.is_solved() and puzzle.solved is not None:
+            puzzle.solved = None
+            puzzle.save(update_fields=["solved"])
+            if puzzle.discord_text_channel_id is not None:
+                renames.append((puzzle.discord_text_channel_id, puzzle.slug))
+    if renames:
+        dmgr = DiscordManager.instance()
+
+        async def rename_all():
+            await asyncio.gather(
+                *(dmgr.rename_channel(channel_id, slug) for channel_id, slug in renames)
             )
 
+        asyncio.get_event_loop().run_until_complete(rename_all())
+
+
+@app.task
+def flush_edits():
+    "Save buffered edits of notes and tags."
+    edits.flush()
+
+
+@app.task
+def rebalance_relations(model_name, container_id):
+    "Spread out the order keys of a round's or meta's relations."
+    relations.rebalance(getattr(models, model_name), container_id)
+
 
 @app.task
 def create_puzzle(
@@ -673,6 +713,7 @@ def auto_create_new_puzzles(dry_run=True, manual=True) -> dict | None:
                         original_link=scraped_puzzle.link,
                         is_placeholder=False,
                     )
+                    changes.mark_changed(models.Puzzle, [slug])
                     post_update_placeholder_puzzle.delay(slug)
                 new_puzzles_data.placeholder_metas_updated.append(slug)
             else:
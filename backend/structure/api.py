@@ -1,19 +1,32 @@
 import dataclasses
 import datetime
+import hashlib
 import inspect
 import logging
 
 import discord
 from django import db
+from django import http
 from django.contrib.auth.decorators import login_required
 from django.middleware import csrf
+from django.utils import timezone
+from django.utils.http import parse_etags
+from django.utils.html import escape
 from django.db import transaction
-from django.db.models import F
+from django.contrib.postgres.search import (
+    SearchHeadline,
+    SearchQuery,
+    SearchRank,
+    TrigramWordSimilarity,
+)
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
 from django.conf import settings
 from django.contrib.auth.models import User
 from rest_framework import (
     decorators,
     exceptions,
+    filters,
     permissions,
     response,
     serializers,
@@ -24,7 +37,12 @@ from allauth.socialaccount.models import SocialAccount
 
 from services import tasks
 from services.discord_manager import DiscordManager
+from . import changes
+from . import edits
+from . import encoding
 from . import models
+from . import relations
+from .leader import MasterStateStore
 
 logger = logging.getLogger(__name__)
 
@@ -72,6 +90,28 @@ class ExtraFieldsSerializer(serializers.ModelSerializer):
         return mapped_fields
 
 
+class EditBufferSpecialization:
+    def partial_update(self, request, *args, **kwargs):
+        # edits of only buffered fields are saved later
+        fields = set(request.data.keys()) if isinstance(request.data, dict) else ()
+        if (
+            not settings.EDIT_BUFFER_INTERVAL
+            or not fields
+            or not fields.issubset(edits.BUFFERED_FIELDS)
+        ):
+            return super().partial_update(request, *args, **kwargs)
+        instance = self.get_object()
+        serializer = self.get_serializer(instance, data=request.data, partial=True)
+        serializer.is_valid(raise_exception=True)
+        if serializer.validated_data:
+            edits.buffer(
+                self.model, instance.pk, serializer.validated_data, request.user.pk
+            )
+            for field, value in serializer.validated_data.items():
+                setattr(instance, field, value)
+        return response.Response(serializer.data)
+
+
 class ContainerSpecialization:
     def process_items(self, request, pk=None):
         if request.method == "POST":
@@ -95,10 +135,99 @@ class ContainerSpecialization:
         instance.save()
 
 
+def parse_tag(tag):
+    """Split "key" or "key:value" into (key, value or None)."""
+    key, sep, value = tag.partition(":")
+    if not key:
+        raise exceptions.NotAcceptable(f"invalid tag: {tag!r}")
+    return key, value if sep else None
+
+
+class TagFilter(filters.BaseFilterBackend):
+    """
+    Filter by tags (served by the GIN indexes):
+        ?tag=key: has the key (repeat to require all)
+        ?tag=key:value: has the key with the value
+        ?tag_any=key1,key2: has any of the keys
+        ?round_tag=name: (rounds) has the round tag (repeat to require all)
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+        for key, value in map(parse_tag, params.getlist("tag")):
+            if value is None:
+                queryset = queryset.filter(tags__has_key=key)
+            else:
+                queryset = queryset.filter(tags__contains={key: value})
+        any_keys = [
+            key
+            for param in params.getlist("tag_any")
+            for key in param.split(",")
+            if key
+        ]
+        if any_keys:
+            queryset = queryset.filter(tags__has_any_keys=any_keys)
+        round_tags = params.getlist("round_tag")
+        if round_tags:
+            if not hasattr(queryset.model, "round_tags"):
+                raise exceptions.NotAcceptable("round_tag only applies to rounds")
+            queryset = queryset.filter(round_tags__contains=round_tags)
+        return queryset
+
+
+class TagSpecialization:
+    filter_backends = [TagFilter]
+
+    @decorators.action(methods=["GET"], detail=False)
+    def tag_facets(self, request):
+        """
+        Counts of each tag key and value among the (filtered) objects:
+        {"tags": {key: {"count": n, "values": {value: n}}}}, and for rounds
+        {"round_tags": {tag: n}}.
+        """
+        queryset = self.filter_queryset(self.get_queryset()).order_by()
+        data = {"tags": tag_counts(queryset)}
+        if hasattr(self.model, "round_tags"):
+            data["round_tags"] = round_tag_counts(queryset)
+        return response.Response(data)
+
+
+def tag_counts(queryset):
+    # hstore each() is set returning, which the ORM cannot group by
+    sql, params = queryset.values("tags").query.sql_with_params()
+    with db.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT tag.key, tag.value, COUNT(*)"
+            f" FROM ({sql}) AS entity CROSS JOIN LATERAL each(entity.tags) AS tag"
+            " GROUP BY tag.key, tag.value",
+            params,
+        )
+        rows = cursor.fetchall()
+    counts = {}
+    for key, value, count in sorted(rows, key=lambda row: (row[0], -row[2])):
+        key_counts = counts.setdefault(key, {"count": 0, "values": {}})
+        key_counts["count"] += count
+        if value is not None:
+            key_counts["values"][value] = count
+    return counts
+
+
+def round_tag_counts(queryset):
+    sql, params = queryset.values("round_tags").query.sql_with_params()
+    with db.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT tag, COUNT(*)"
+            f" FROM ({sql}) AS entity CROSS JOIN LATERAL unnest(entity.round_tags)"
+            " AS tag GROUP BY tag ORDER BY tag",
+            params,
+        )
+        return dict(cursor.fetchall())
+
+
 class BaseRoundSerializer(ExtraFieldsSerializer):
     class Meta:
         model = models.Round
-        exclude = ["puzzles"]
+        exclude = ["puzzles", "search_vector"]
 
 
 class RoundSerializer(BaseRoundSerializer):
@@ -109,7 +238,7 @@ class RoundSerializer(BaseRoundSerializer):
 class BasePuzzleSerializer(ExtraFieldsSerializer):
     class Meta:
         model = models.Puzzle
-        exclude = ["feeders"]
+        exclude = ["feeders", "search_vector"]
 
 
 class PuzzleSerializer(BasePuzzleSerializer):
@@ -118,7 +247,12 @@ class PuzzleSerializer(BasePuzzleSerializer):
         depth = 0
 
 
-class RoundViewSet(ContainerSpecialization, viewsets.ModelViewSet):
+class RoundViewSet(
+    EditBufferSpecialization,
+    TagSpecialization,
+    ContainerSpecialization,
+    viewsets.ModelViewSet,
+):
     model = models.Round
     relation_model = models.RoundPuzzle
     queryset = model.objects.all().prefetch_related("puzzle_relations")
@@ -142,7 +276,12 @@ class RoundViewSet(ContainerSpecialization, viewsets.ModelViewSet):
         return self.process_items(*args, **kwargs)
 
 
-class PuzzleViewSet(ContainerSpecialization, viewsets.ModelViewSet):
+class PuzzleViewSet(
+    EditBufferSpecialization,
+    TagSpecialization,
+    ContainerSpecialization,
+    viewsets.ModelViewSet,
+):
     model = models.Puzzle
     relation_model = models.MetaFeeder
     queryset = model.objects.all().prefetch_related(
@@ -163,11 +302,132 @@ class PuzzleViewSet(ContainerSpecialization, viewsets.ModelViewSet):
         tasks.create_puzzle.delay(**data)
         return response.Response(status=status.HTTP_204_NO_CONTENT)
 
+    @decorators.action(methods=["POST"], detail=False)
+    def bulk_update(self, request):
+        return bulk_update_puzzles(request)
+
     @decorators.action(methods=["GET", "POST"], detail=True)
     def feeders(self, *args, **kwargs):
         return self.process_items(*args, **kwargs)
 
 
+def bulk_update_puzzles(request):
+    """
+    Apply changes to several puzzles in one transaction, so clients get a
+    single update.
+    request:
+        data:
+            puzzles: list of {"slug": ..., <field>: <value>, ...}. Fields are
+                validated as for a PATCH of the puzzle. "rounds" is the list of
+                round slugs the puzzle should be in.
+    """
+    data = request.data
+    updates = data.get("puzzles") if isinstance(data, dict) else None
+    if (
+        not isinstance(updates, list)
+        or not updates
+        or not all(
+            isinstance(update, dict) and isinstance(update.get("slug"), str)
+            for update in updates
+        )
+    ):
+        raise exceptions.NotAcceptable(
+            "puzzles must be a nonempty list of objects with a slug"
+        )
+    slugs = [update["slug"] for update in updates]
+    if len(set(slugs)) != len(slugs):
+        raise exceptions.NotAcceptable("each puzzle can only be updated once")
+    new_rounds = {}
+    for update in updates:
+        if "rounds" in update:
+            round_slugs = update["rounds"]
+            if not isinstance(round_slugs, list) or not all(
+                isinstance(slug, str) for slug in round_slugs
+            ):
+                raise exceptions.NotAcceptable("rounds must be a list of round slugs")
+            new_rounds[update["slug"]] = set(round_slugs)
+    valid_round_slugs = set(
+        models.Round.objects.filter(
+            pk__in=set().union(*new_rounds.values())
+        ).values_list("pk", flat=True)
+    )
+    invalid_round_slugs = set().union(*new_rounds.values()) - valid_round_slugs
+    if invalid_round_slugs:
+        raise exceptions.NotAcceptable(
+            f"invalid round slugs: {sorted(invalid_round_slugs)}"
+        )
+
+    with transaction.atomic():
+        puzzles = models.Puzzle.objects.select_for_update().in_bulk(slugs)
+        invalid_slugs = [slug for slug in slugs if slug not in puzzles]
+        if invalid_slugs:
+            raise exceptions.NotAcceptable(f"invalid puzzle slugs: {invalid_slugs}")
+        fields = {"modified", "modified_by"}
+        saved_fields = {}
+        errors = {}
+        for update in updates:
+            puzzle = puzzles[update["slug"]]
+            serializer = BasePuzzleSerializer(
+                puzzle,
+                data={
+                    key: value
+                    for key, value in update.items()
+                    if key not in ("slug", "rounds")
+                },
+                partial=True,
+            )
+            if not serializer.is_valid():
+                errors[puzzle.pk] = serializer.errors
+                continue
+            for field, value in serializer.validated_data.items():
+                setattr(puzzle, field, value)
+                fields.add(field)
+            saved_fields[puzzle.pk] = list(serializer.validated_data)
+        if errors:
+            raise exceptions.ValidationError(errors)
+        # a buffered edit must not overwrite these later ones
+        for slug, puzzle_fields in saved_fields.items():
+            edits.discard(models.Puzzle, slug, puzzle_fields)
+
+        # what Puzzle.save does, for all puzzles at once
+        now = timezone.now()
+        user = request.user if request.user.pk is not None else None
+        for puzzle in puzzles.values():
+            puzzle.modified = now
+            puzzle.modified_by = user
+        models.Puzzle.save_all(
+            list(puzzles.values()),
+            lambda auto_fields: models.Puzzle.objects.bulk_update(
+                puzzles.values(), sorted(fields | auto_fields)
+            ),
+        )
+
+        if new_rounds:
+            current_rounds = set(
+                models.RoundPuzzle.objects.filter(
+                    puzzle_id__in=new_rounds.keys()
+                ).values_list("round_id", "puzzle_id")
+            )
+            relations.remove(
+                models.RoundPuzzle,
+                [
+                    (round_slug, slug)
+                    for round_slug, slug in current_rounds
+                    if round_slug not in new_rounds[slug]
+                ],
+            )
+            relations.add(
+                models.RoundPuzzle,
+                [
+                    (round_slug, slug)
+                    for slug, round_slugs in new_rounds.items()
+                    for round_slug in sorted(round_slugs)
+                ],
+            )
+        changes.mark_changed(models.Puzzle, slugs)
+    return response.Response(status=status.HTTP_204_NO_CONTENT)
+
+
 def process_relation(cls, pk, request):
     """
     Process the request to change the set of puzzles for a round/meta.
@@ -236,11 +496,7 @@ def process_relation(cls, pk, request):
             existing_slugs = set(existing_slugs_query)
             new_slugs = [slug for slug in slugs if slug not in existing_slugs]
             if new_slugs:
-                with transaction.atomic():
-                    for slug in new_slugs:
-                        cls(
-                            **{f"{cls.CONTAINER}_id": pk, f"{cls.ITEM}_id": slug}
-                        ).save()
+                relations.add(cls, [(pk, slug) for slug in new_slugs])
                 return response.Response(status=status.HTTP_204_NO_CONTENT)
             else:
                 raise exceptions.NotAcceptable("Request is a no-op.")
@@ -253,9 +509,13 @@ def process_relation(cls, pk, request):
                 if getattr(relation, f"{cls.ITEM}_id") in slugs
             ]
             if relations_to_remove:
-                with transaction.atomic():
-                    for relation in relations_to_remove:
-                        relation.delete()
+                relations.remove(
+                    cls,
+                    [
+                        (pk, getattr(relation, f"{cls.ITEM}_id"))
+                        for relation in relations_to_remove
+                    ],
+                )
                 return response.Response(status=status.HTTP_204_NO_CONTENT)
             else:
                 raise exceptions.NotAcceptable("Request is a no-op.")
@@ -265,14 +525,15 @@ def process_relation(cls, pk, request):
                     **{
                         f"{cls.CONTAINER}_id": pk,
                         f"{cls.ITEM}_id": slug,
-                        "order": order,
+                        "order": position * cls.ORDER_GAP,
                     }
                 )
-                for order, slug in enumerate(slugs)
+                for position, slug in enumerate(slugs)
             ]
             now = datetime.datetime.now()
             with transaction.atomic():
-                item_cls.objects.filter(pk__in=existing_slugs_query).update(
+                existing_slugs = list(existing_slugs_query)
+                item_cls.objects.filter(pk__in=existing_slugs).update(
                     modified=now, modified_by=request.user
                 )
                 existing_relations_query.delete()
@@ -283,99 +544,117 @@ def process_relation(cls, pk, request):
                 container_cls.objects.filter(pk=pk).update(
                     modified=now, modified_by=request.user
                 )
+                changes.mark_changed(item_cls, {*existing_slugs, *valid_slugs})
+                changes.mark_changed(container_cls, [pk])
             return response.Response(status=status.HTTP_204_NO_CONTENT)
         elif action == "move":
             slug = next(iter(slugs))
-            relations_set = cls.objects.filter(**{f"{cls.CONTAINER}_id": pk})
-            relations = list(relations_set)
-            existing_relation = None
-            for relation in relations:
-                if getattr(relation, f"{cls.ITEM}_id") == slug:
-                    existing_relation = relation
-            if existing_relation is None:
-                raise exceptions.NotFound()
-            if not 0 <= order < len(relations):
-                raise exceptions.NotAcceptable(
-                    f"order is out of range: {order} is not in [0, {len(relations)})"
+            with transaction.atomic():
+                # the keys of the new neighbours must not change until the
+                # moved relation is saved
+                container_relations = list(
+                    cls.objects.select_for_update().filter(
+                        **{f"{cls.CONTAINER}_id": pk}
+                    )
                 )
-            new_order = relations[order].order
-            if new_order != existing_relation.order:
-                with container_cls.get_lock(pk):
-                    with transaction.atomic():
-                        if new_order < existing_relation.order:
-                            relations_set.filter(
-                                order__gte=new_order, order__lt=existing_relation.order
-                            ).update(order=F("order") + 1)
-                        else:
-                            relations_set.filter(
-                                order__gt=existing_relation.order, order__lte=new_order
-                            ).update(order=F("order") - 1)
-                        existing_relation.order = new_order
-                        existing_relation.save()
-                return response.Response(status=status.HTTP_204_NO_CONTENT)
-            else:
-                raise exceptions.NotAcceptable("Request is a no-op.")
+                existing_relation = None
+                for relation in container_relations:
+                    if getattr(relation, f"{cls.ITEM}_id") == slug:
+                        existing_relation = relation
+                if existing_relation is None:
+                    raise exceptions.NotFound()
+                if not 0 <= order < len(container_relations):
+                    raise exceptions.NotAcceptable(
+                        f"order is out of range: {order} is not in [0, {len(container_relations)})"
+                    )
+                if container_relations[order] is existing_relation:
+                    raise exceptions.NotAcceptable("Request is a no-op.")
+                relations.move(existing_relation, container_relations, order)
+            return response.Response(status=status.HTTP_204_NO_CONTENT)
         else:
             raise NotImplementedError()
     except db.Error as e:
         raise exceptions.APIException(e)
 
 
-def data_everything():
-    # using Django REST Framework serializers directly is slow
-    # hunt_config = HuntConfigSerializer(models.HuntConfig.get()).data
-    def cast(objs):
-        return [
-            {
-                key: value.isoformat()
-                if isinstance(value, datetime.datetime)
-                else value
-                for key, value in obj.items()
-            }
-            for obj in objs
-        ]
+def _filter(queryset, field, keys):
+    if keys is None:
+        return queryset.all()
+    return queryset.filter(**{f"{field}__in": keys})
+
 
+def data_hunt():
     hunt_config = models.HuntConfig.get()
-    hunt_config = {
-        key: getattr(hunt_config, key) for key in HuntConfigSerializer().fields.keys()
-    }
-    users = cast(
-        User.objects.values(
-            *(key for key in UserSerializer().fields.keys() if key != "socialaccounts")
-        )
+    return encoding.prepare_row(
+        {key: getattr(hunt_config, key) for key in HuntConfigSerializer().fields.keys()}
     )
-    socialaccounts = cast(
-        SocialAccount.objects.values(
-            "user_id", *SocialAccountSerializer().fields.keys()
-        )
+
+
+def data_users(ids=None):
+    """Users keyed by id. Restricted to `ids` if given."""
+    users = _filter(User.objects, "id", ids).values(
+        *(key for key in UserSerializer().fields.keys() if key != "socialaccounts")
+    )
+    socialaccounts = _filter(SocialAccount.objects, "user_id", ids).values(
+        "user_id", *SocialAccountSerializer().fields.keys()
     )
     user_by_id = {user["id"]: user for user in users}
     for socialaccount in socialaccounts:
         user_by_id[socialaccount["user_id"]].setdefault("socialaccount", []).append(
             {key: socialaccount[key] for key in SocialAccountSerializer().fields.keys()}
         )
+    return user_by_id
+
+
+def data_rounds(slugs=None):
+    """Rounds keyed by slug. Restricted to `slugs` if given."""
     # NB: important to fetch relations before objects
-    round_puzzles = cast(models.RoundPuzzle.objects.values("round_id", "puzzle_id"))
-    meta_feeders = cast(models.MetaFeeder.objects.values("meta_id", "feeder_id"))
-    rounds = cast(models.Round.objects.values(*BaseRoundSerializer().fields.keys()))
-    puzzles = cast(models.Puzzle.objects.values(*BasePuzzleSerializer().fields.keys()))
+    round_puzzles = _filter(models.RoundPuzzle.objects, "round_id", slugs).values(
+        "round_id", "puzzle_id"
+    )
+    rounds = _filter(models.Round.objects, "slug", slugs).values(
+        *BaseRoundSerializer().fields.keys()
+    )
     round_by_slug = {}
-    puzzle_by_slug = {}
     for _round in rounds:
-        round_by_slug[_round["slug"]] = _round
+        round_by_slug[_round["slug"]] = encoding.prepare_row(_round)
         _round.setdefault("puzzles", [])
+    for round_puzzle in round_puzzles:
+        _round = round_by_slug.get(round_puzzle["round_id"])
+        if _round is not None:
+            _round["puzzles"].append(round_puzzle["puzzle_id"])
+    return round_by_slug
+
+
+def data_round_order():
+    return list(models.Round.objects.values_list("slug", flat=True))
+
+
+def data_puzzles(slugs=None):
+    """Puzzles keyed by slug. Restricted to `slugs` if given."""
+    # NB: important to fetch relations before objects
+    round_puzzles = _filter(models.RoundPuzzle.objects, "puzzle_id", slugs).values(
+        "round_id", "puzzle_id"
+    )
+    meta_feeders = models.MetaFeeder.objects.all()
+    if slugs is not None:
+        meta_feeders = meta_feeders.filter(
+            Q(meta_id__in=slugs) | Q(feeder_id__in=slugs)
+        )
+    meta_feeders = meta_feeders.values("meta_id", "feeder_id")
+    puzzles = _filter(models.Puzzle.objects, "slug", slugs).values(
+        *BasePuzzleSerializer().fields.keys()
+    )
+    puzzle_by_slug = {}
     for puzzle in puzzles:
-        puzzle_by_slug[puzzle["slug"]] = puzzle
+        puzzle_by_slug[puzzle["slug"]] = encoding.prepare_row(puzzle)
         puzzle.setdefault("rounds", [])
         puzzle.setdefault("metas", [])
         puzzle.setdefault("feeders", [])
     for round_puzzle in round_puzzles:
         puzzle = puzzle_by_slug.get(round_puzzle["puzzle_id"])
-        _round = round_by_slug.get(round_puzzle["round_id"])
         if puzzle is not None:
             puzzle["rounds"].append(round_puzzle["round_id"])
-        if _round is not None:
-            _round["puzzles"].append(round_puzzle["puzzle_id"])
     for meta_feeder in meta_feeders:
         feeder = puzzle_by_slug.get(meta_feeder["feeder_id"])
         meta = puzzle_by_slug.get(meta_feeder["meta_id"])
@@ -383,25 +662,277 @@ def data_everything():
             feeder["metas"].append(meta_feeder["meta_id"])
         if meta is not None:
             meta["feeders"].append(meta_feeder["feeder_id"])
+    return puzzle_by_slug
+
+
+LAZY_TEXT_SECTIONS = ("rounds", "puzzles")
+
+
+def lazy_text_entry(text):
+    return {
+        "digest": hashlib.blake2b(text.encode(), digest_size=8).hexdigest(),
+        "length": len(text),
+    }
+
+
+def lazy_entity(entity):
+    """
+    Return `entity` (a round or puzzle, possibly partial) with text fields in
+    LAZY_TEXT_FIELDS longer than LAZY_TEXT_THRESHOLD replaced by their digest
+    and length. The text can be fetched from `/api/text`.
+    """
+    replaced = {
+        field: lazy_text_entry(entity[field])
+        for field in settings.LAZY_TEXT_FIELDS
+        if isinstance(entity.get(field), str)
+        and len(entity[field]) >= settings.LAZY_TEXT_THRESHOLD
+    }
+    return {**entity, **replaced} if replaced else entity
+
+
+def lazy_delta(delta):
+    """
+    Apply `lazy_entity` to the entities in an update. Returns (data, changed)
+    where `changed` lists "section/slug" of the entities with replaced text.
+    """
+    data = dict(delta)
+    changed = []
+    for section in LAZY_TEXT_SECTIONS:
+        if section in delta:
+            data[section] = {}
+            for slug, entity in delta[section].items():
+                lazy = lazy_entity(entity) if isinstance(entity, dict) else entity
+                if lazy is not entity:
+                    changed.append(f"{section}/{slug}")
+                data[section][slug] = lazy
+    return data, changed
+
+
+def data_everything():
+    # using Django REST Framework serializers directly is slow
+    # hunt_config = HuntConfigSerializer(models.HuntConfig.get()).data
+    rounds = data_rounds()
     data = {
-        "hunt": hunt_config,
-        "users": {user["id"]: user for user in users},
-        "rounds": {_round["slug"]: _round for _round in rounds},
-        "round_order": [_round["slug"] for _round in rounds],
-        "puzzles": {puzzle["slug"]: puzzle for puzzle in puzzles},
+        "hunt": data_hunt(),
+        "users": data_users(),
+        "rounds": rounds,
+        "round_order": list(rounds.keys()),
+        "puzzles": data_puzzles(),
         "extension_version": settings.EXTENSION_VERSION,
+        "format_version": encoding.format_version(),
     }
     if settings.SECRETS["LOGIN"]["username"] and settings.SECRETS["LOGIN"]["password"]:
         data["login"] = settings.SECRETS["LOGIN"]
     return data
 
 
+def data_partial(changes):
+    """
+    Recompute only the parts of `data_everything()` named by `changes`, a
+    mapping from section ("hunt", "users", "rounds", "puzzles") to the keys
+    that changed. Keys that no longer exist map to None.
+    """
+    data = {}
+    if "hunt" in changes:
+        data["hunt"] = data_hunt()
+    for section, fetch in (
+        ("users", data_users),
+        ("rounds", data_rounds),
+        ("puzzles", data_puzzles),
+    ):
+        keys = changes.get(section)
+        if keys:
+            fetched = fetch(keys)
+            data[section] = {key: fetched.get(key) for key in keys}
+    if changes.get("rounds"):
+        data["round_order"] = data_round_order()
+    return data
+
+
+def _computed_everything(since):
+    data = data_everything()
+    if since is not None:
+        data = [{"prev_version": None, "version": None, "roots": True, "data": data}]
+    return http.HttpResponse(encoding.dumps(data), content_type="application/json")
+
+
 @decorators.api_view()
 def everything(request):
-    data = data_everything()
+    """
+    The whole hunt, as of the last snapshot checkpointed by the master (which
+    trails its broadcasts slightly). The ETag is the version. Computed when no
+    master is running, without an ETag.
+
+    With `?since=<version>`, a list of updates in the websocket format that
+    bring data at that version up to date instead. This is a single full
+    update (with "prev_version" null) if the deltas are no longer saved.
+    """
+    since = request.query_params.get("since")
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            raise exceptions.ParseError("since must be a version")
+    store = MasterStateStore()
+    version = store.load_version()
+    if version is None:
+        # no master is running, or it has not saved its state yet
+        return _computed_everything(since)
+    etag = f'"{version}"'
+    if etag in parse_etags(request.headers.get("If-None-Match", "")):
+        response = http.HttpResponseNotModified()
+        response.headers["ETag"] = etag
+        return response
+    saved = None if since is None else store.load_updates(since)
+    if saved is not None:
+        version, updates = saved
+        body = f"[{', '.join(updates)}]"
+    else:
+        checkpoint = store.load_snapshot()
+        if checkpoint is None:
+            # the master has not checkpointed its snapshot yet
+            return _computed_everything(since)
+        version, snapshot = checkpoint
+        if since is None:
+            body = snapshot
+        else:
+            body = (
+                f'[{{"prev_version": null, "version": {version}, '
+                f'"roots": true, "data": {snapshot}}}]'
+            )
+    response = http.HttpResponse(body, content_type="application/json")
+    response.headers["ETag"] = f'"{version}"'
+    return response
+
+
+@decorators.api_view()
+def text(request):
+    """
+    Full text fields omitted from lazy snapshots, for the slugs given as
+    `?rounds=<slug>&puzzles=<slug>...`.
+    """
+    data = {}
+    for section, model in (("rounds", models.Round), ("puzzles", models.Puzzle)):
+        slugs = request.query_params.getlist(section)
+        if slugs:
+            data[section] = {
+                entity["slug"]: {
+                    field: {**lazy_text_entry(entity[field]), "text": entity[field]}
+                    for field in settings.LAZY_TEXT_FIELDS
+                }
+                for entity in model.objects.filter(pk__in=slugs).values(
+                    "slug", *settings.LAZY_TEXT_FIELDS
+                )
+            }
     return response.Response(data)
 
 
+# section -> (model, text fields matched by trigrams and highlighted)
+SEARCH_FIELDS = {
+    "rounds": (models.Round, ("name", "notes")),
+    "puzzles": (models.Puzzle, ("name", "answer", "notes")),
+}
+SEARCH_MAX_LIMIT = 100
+# whole short fields, fragments of notes
+SEARCH_HEADLINE_OPTIONS = {"notes": {"max_fragments": 3}}
+# private use characters that mark matches in headlines until they are escaped
+SEARCH_START_SEL = "\ue000"
+SEARCH_STOP_SEL = "\ue001"
+
+
+def highlight(headline):
+    """
+    HTML of a `ts_headline` made with the SEARCH_*_SEL markers: the text
+    escaped and the matched words in <mark> tags. None if nothing matched.
+    """
+    if SEARCH_START_SEL not in headline:
+        return None
+    return (
+        escape(headline)
+        .replace(SEARCH_START_SEL, "<mark>")
+        .replace(SEARCH_STOP_SEL, "</mark>")
+    )
+
+
+def search_entities(text, limit):
+    """
+    Rounds and puzzles matching `text`, best first. Matches are full text
+    matches of `search_vector` or trigram word similarity (for partial words
+    and typos) with a text field, ranked by the sum of both. Returns a list of
+    {"section", "slug", "rank", "highlights"} where `highlights` has the
+    matched text fields as HTML (see `highlight`).
+    """
+    query = SearchQuery(text, search_type="websearch", config=models.SEARCH_CONFIG)
+    results = []
+    for section, (model, fields) in SEARCH_FIELDS.items():
+        trigram_match = Q()
+        for field in fields:
+            trigram_match |= Q(**{f"{field}__trigram_word_similar": text})
+        matches = (
+            model.objects.filter(hidden=False)
+            .filter(Q(search_vector=query) | trigram_match)
+            .annotate(
+                rank=SearchRank(F("search_vector"), query)
+                + Greatest(*(TrigramWordSimilarity(text, field) for field in fields))
+            )
+            .order_by("-rank", "pk")
+            .values_list("pk", "rank")[:limit]
+        )
+        results.extend(
+            {"section": section, "slug": slug, "rank": rank, "highlights": {}}
+            for slug, rank in matches
+        )
+    results.sort(key=lambda result: -result["rank"])
+    results = results[:limit]
+
+    # headlines are expensive, so only for the results
+    for section, (model, fields) in SEARCH_FIELDS.items():
+        result_by_slug = {
+            result["slug"]: result for result in results if result["section"] == section
+        }
+        if not result_by_slug:
+            continue
+        headlines = model.objects.filter(pk__in=result_by_slug).values_list(
+            "pk",
+            *(
+                SearchHeadline(
+                    field,
+                    query,
+                    config=models.SEARCH_CONFIG,
+                    start_sel=SEARCH_START_SEL,
+                    stop_sel=SEARCH_STOP_SEL,
+                    **SEARCH_HEADLINE_OPTIONS.get(field, {"highlight_all": True}),
+                )
+                for field in fields
+            ),
+        )
+        for slug, *field_headlines in headlines:
+            highlights = {
+                field: highlight(headline)
+                for field, headline in zip(fields, field_headlines)
+            }
+            result_by_slug[slug]["highlights"] = {
+                field: html for field, html in highlights.items() if html is not None
+            }
+    return results
+
+
+@decorators.api_view()
+def search(request):
+    """
+    Search rounds and puzzles for `?q=<text>` (web search syntax: "quoted
+    phrases", or, -excluded). At most `?limit=` (default 20) results.
+    """
+    text = request.query_params.get("q", "").strip()
+    try:
+        limit = min(int(request.query_params.get("limit", 20)), SEARCH_MAX_LIMIT)
+    except ValueError:
+        raise exceptions.NotAcceptable("limit must be an integer")
+    if not text or limit <= 0:
+        return response.Response({"results": []})
+    return response.Response({"results": search_entities(text, limit)})
+
+
 def scraper_data():
     """For debugging the auto scraper."""
     from services import subprocess_tasks
@@ -424,6 +955,39 @@ def data_everything_with_uid(request):
     return data
 
 
+_page_snapshot = None  # (version, snapshot escaped for HTML)
+_html_escapes = str.maketrans({"<": "\\u003C", ">": "\\u003E", "&": "\\u0026"})
+
+
+def encoded_everything_with_uid(request):
+    """
+    `data_everything_with_uid` encoded for embedding in a page. Built from the
+    snapshot saved by the master, which is escaped once per version and kept in
+    the process, instead of querying everything on every page load.
+
+    Returns (encoded, source) where `source` is "hit" (kept in the process),
+    "miss" (loaded from Redis) or "fallback" (computed since no master is
+    running or it has not checkpointed its snapshot).
+    """
+    global _page_snapshot
+    store = MasterStateStore()
+    # the checkpoint trails the latest version, so it is what identifies the
+    # snapshot kept in the process
+    version = store.load_snapshot_version()
+    cached = _page_snapshot
+    if version is not None and cached is not None and cached[0] == version:
+        source = "hit"
+    else:
+        saved = None if version is None else store.load_snapshot()
+        if saved is None:
+            data = data_everything_with_uid(request)
+            return encoding.dumps(data, html_safe=True), "fallback"
+        cached = _page_snapshot = (saved[0], saved[1].translate(_html_escapes))
+        source = "miss"
+    # splice the uid into the shared snapshot
+    return f'{{"uid": {encoding.dumps(request.user.id)}, {cached[1][1:]}', source
+
+
 @login_required
 def google_sheets_owner_data(request):
     owner = models.GoogleSheetOwner.get()
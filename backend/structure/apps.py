@@ -0,0 +1,27 @@
+from django.apps import AppConfig
+from django.db.models import signals
+
+
+class StructureConfig(AppConfig):
+    name = "structure"
+
+    def ready(self):
+        from allauth.socialaccount.models import SocialAccount
+        from django.contrib.auth.models import User
+
+        from . import changes
+        from . import edits
+        from . import models
+
+        for signal in (signals.post_save, signals.post_delete):
+            signal.connect(changes.hunt_config_changed, sender=models.HuntConfig)
+            for model in (User, models.Round, models.Puzzle):
+                signal.connect(changes.entity_changed, sender=model)
+            signal.connect(changes.socialaccount_changed, sender=SocialAccount)
+            for model in (models.RoundPuzzle, models.MetaFeeder):
+                signal.connect(changes.relation_changed, sender=model)
+        for field in (models.Round.puzzles, models.Puzzle.feeders):
+            signals.m2m_changed.connect(changes.relations_changed, sender=field.through)
+
+        for model in edits.SECTION_MODELS.values():
+            signals.pre_save.connect(edits.discard_saved, sender=model)
@@ -0,0 +1,73 @@
+"""
+Synthetic data for the `benchmark` command and the tests comparing against it.
+"""
+
+from . import consumers
+
+
+def reference_diff(old, new):
+    """The original fully recursive diff, kept to check and benchmark `diff`."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        data = {}
+        roots = {}
+        for key in set(old.keys()) | set(new.keys()):
+            subdata, subroots = reference_diff(
+                old.get(key, consumers.VOID), new.get(key, consumers.VOID)
+            )
+            if subroots:
+                roots[key] = subroots
+                if subdata is not consumers.VOID:
+                    data[key] = subdata
+        if roots:
+            return data, roots
+        else:
+            return None, False
+    else:
+        if old == new:
+            return None, False
+        else:
+            return new, True
+
+
+def synthetic_hunt(num_puzzles, num_rounds=20):
+    """A snapshot like `api.data_everything` of a hunt with `num_puzzles`."""
+    rounds = {
+        f"round-{i}": {
+            "slug": f"round-{i}",
+            "name": f"Round {i}",
+            "notes": "",
+            "tags": {},
+            "puzzles": [f"puzzle-{j}" for j in range(i, num_puzzles, num_rounds)],
+        }
+        for i in range(num_rounds)
+    }
+    puzzles = {
+        f"puzzle-{i}": {
+            "slug": f"puzzle-{i}",
+            "name": f"Puzzle {i}",
+            "link": f"/puzzles/{i}",
+            "created": "2021-01-15T17:00:00+00:00",
+            "modified": "2021-01-15T17:00:00+00:00",
+            "hidden": False,
+            "notes": "notes " * 40,
+            "tags": {"type": "word"},
+            "discord_text_channel_id": 800000000000000000 + i,
+            "discord_voice_channel_id": None,
+            "sheet_link": f"https://docs.google.com/spreadsheets/d/{i}",
+            "answer": "",
+            "solved": None,
+            "status": "",
+            "is_meta": False,
+            "rounds": [f"round-{i % num_rounds}"],
+            "metas": [],
+            "feeders": [],
+        }
+        for i in range(num_puzzles)
+    }
+    return {
+        "hunt": {"root": "https://example.com", "role_colors": {}},
+        "users": {},
+        "rounds": rounds,
+        "round_order": list(rounds),
+        "puzzles": puzzles,
+    }
@@ -0,0 +1,109 @@
+"""
+Row level change tracking for the broadcast master.
+
+Saves and deletes of models that appear in the hunt snapshot are collected per
+thread and sent to the master once the enclosing transaction commits, so the
+master only needs to refetch the rows that changed. Changes of a transaction
+that rolls back are dropped with it. Writes that bypass model signals
+(`QuerySet.update`, `bulk_create`, `bulk_update`) must call `mark_changed`
+themselves. The receivers below are connected in `apps.py`.
+"""
+
+from collections import defaultdict
+import functools
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from . import models
+
+MASTER_CHANNEL_NAME = "channels_master"
+CLIENT_GROUP_NAME = "all_updates"
+
+SECTIONS = {
+    models.HuntConfig: "hunt",
+    User: "users",
+    models.Round: "rounds",
+    models.Puzzle: "puzzles",
+}
+
+_local = threading.local()
+
+
+def mark_changed(model, keys):
+    """
+    Mark rows of `model` (keyed by primary key) as changed. The master is
+    notified when the current transaction commits.
+    """
+    pending = getattr(_local, "pending", None)
+    if pending is not None and _will_flush(pending):
+        pending.args[0][SECTIONS[model]].update(keys)
+        return
+    # the first change since the last commit or rollback
+    changes = defaultdict(set)
+    changes[SECTIONS[model]].update(keys)
+    pending = _local.pending = functools.partial(flush, changes)
+    transaction.on_commit(pending)
+
+
+def _will_flush(pending):
+    # Django drops the callbacks of a savepoint that rolls back and runs them
+    # all once the transaction commits; a batch is only extended from the
+    # savepoint that registered it, so a rollback never drops other changes
+    connection = transaction.get_connection()
+    savepoint_ids = set(connection.savepoint_ids)
+    return connection.in_atomic_block and any(
+        func is pending and sids == savepoint_ids
+        for sids, func, _ in connection.run_on_commit
+    )
+
+
+def flush(changes):
+    if changes:
+        async_to_sync(get_channel_layer().send)(
+            MASTER_CHANNEL_NAME,
+            {
+                "type": "server.maybe_update",
+                "changes": {section: list(keys) for section, keys in changes.items()},
+                "time": time.time(),
+            },
+        )
+
+
+def hunt_config_changed(sender, instance, **kwargs):
+    mark_changed(models.HuntConfig, ["hunt"])
+
+
+def entity_changed(sender, instance, **kwargs):
+    mark_changed(sender, [instance.pk])
+
+
+def socialaccount_changed(sender, instance, **kwargs):
+    mark_changed(User, [instance.user_id])
+
+
+def relation_changed(sender, instance, **kwargs):
+    for key in (sender.CONTAINER, sender.ITEM):
+        related_model = sender._meta.get_field(key).related_model
+        mark_changed(related_model, [getattr(instance, f"{key}_id")])
+
+
+def relations_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """`m2m_changed` receiver for `Round.puzzles` and `Puzzle.feeders`."""
+    if action == "pre_clear":
+        source, target = (
+            (sender.ITEM, sender.CONTAINER)
+            if reverse
+            else (sender.CONTAINER, sender.ITEM)
+        )
+        pk_set = sender.objects.filter(**{f"{source}_id": instance.pk}).values_list(
+            f"{target}_id", flat=True
+        )
+    elif action not in ("post_add", "post_remove"):
+        return
+    mark_changed(type(instance), [instance.pk])
+    mark_changed(model, pk_set)
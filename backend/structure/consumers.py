@@ -1,82 +1,278 @@
-from collections import deque
+import asyncio
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import dataclasses
 import datetime
-import json
 import logging
 import time
+from urllib.parse import parse_qs
+import zlib
 
 from asgiref.sync import async_to_sync
-import cachalot
-from channels.layers import get_channel_layer
 from channels.consumer import SyncConsumer
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django import dispatch
+from django import db
+from django.conf import settings
+import msgpack
 
 from . import api
+from . import encoding
+from . import metrics
+from .changes import CLIENT_GROUP_NAME, MASTER_CHANNEL_NAME
+from .leader import LeaseLost, MasterStateStore
+from .presence import PresenceStore
 
 logger = logging.getLogger(__name__)
 
-MASTER_CHANNEL_NAME = "channels_master"
-CLIENT_GROUP_NAME = "all_updates"
-
 
 class ClientConsumer(AsyncWebsocketConsumer):
     SYNC_THRESHOLD = 20  # seconds
+    ACTIVITY_REFRESH_TIME = 30  # seconds
+    DEFLATE_SUBPROTOCOL = "checkmate.deflate"
+    MSGPACK_SUBPROTOCOL = "checkmate.msgpack"
+    BACKLOG_LIMIT = 64  # frames, or versions the client has not echoed back
+    connected = 0  # clients of this process
 
     async def connect(self):
         self.version = 0
         self.timestamp = None
         self.tab = None
         self.puzzle = None
+        self.activity_forwarded = None
+        # frames are queued here and sent as fast as the client reads them, so
+        # a slow client cannot back up the channel layer (see `resync`)
+        self.outbox = deque()  # (frame, is_delta, commit time)
+        self.outbox_deltas = 0
+        self.outbox_ready = asyncio.Event()
+        # broadcasts are dropped while a fetch is in flight since the response
+        # will include them
+        self.fetching = True
+        # the server buffers frames the client does not read, so the outbox
+        # stays short even for a stuck client; clients that echo back the
+        # versions they received show how far behind they are instead
+        self.acked = None  # last version echoed back by the client
+        self.stalled = False  # waiting for the client to read what was sent
+        self.stalled_deltas = 0
 
+        query = parse_qs(self.scope["query_string"].decode())
+        subprotocols = self.scope.get("subprotocols", ())
+        subprotocol = None
+        # opt in to MessagePack binary frames, which carry 64 bit ids natively
+        # (takes precedence over the options below)
+        if self.MSGPACK_SUBPROTOCOL in subprotocols:
+            subprotocol = self.MSGPACK_SUBPROTOCOL
+        self.msgpack = subprotocol is not None or query.get("encoding") == ["msgpack"]
+        # opt in to large payloads as zlib compressed binary frames
+        if not self.msgpack and self.DEFLATE_SUBPROTOCOL in subprotocols:
+            subprotocol = self.DEFLATE_SUBPROTOCOL
+        self.compress = not self.msgpack and (
+            subprotocol is not None or query.get("compress") == ["deflate"]
+        )
+        # opt in to receiving digests instead of large text fields
+        self.lazy = not self.msgpack and query.get("lazy") == ["1"]
+        self.subscriptions = set()  # "section/slug" to receive full text for
+        # notifications go to every client, updates only to the clients using
+        # the same encoding
+        self.variant = client_variant(self.msgpack, self.compress, self.lazy)
+        await self.channel_layer.group_add(CLIENT_GROUP_NAME, self.channel_name)
         await self.channel_layer.group_add(
-            CLIENT_GROUP_NAME,
-            self.channel_name,
+            variant_group(self.variant), self.channel_name
         )
-        await self.accept()
-        await self.query(fetch=True)
+        await self.accept(subprotocol=subprotocol)
+        self.sender = asyncio.create_task(self.drain())
+        ClientConsumer.connected += 1
+        metrics.set_process_gauge("checkmate_websocket_clients", self.connected)
+        # clients reconnecting with a known version only need the missed deltas
+        since = query.get("version")
+        try:
+            since = int(since[-1])
+        except (TypeError, ValueError):
+            since = None
+        await self.query(fetch=True, since=since)
 
-    async def query(self, *, fetch=False, activity=None):
-        # single request that combines fetching entire data state and notifying
-        # with current activity
+    async def query(self, *, fetch=False, since=None, activity=None, resync=None):
+        # single request that combines fetching entire data state (or the
+        # deltas after version `since`) and notifying with current activity
         request = {
             "type": "client.query",
         }
         if fetch:
             request["fetch"] = True
             request["channel"] = self.channel_name
+            if since is not None:
+                request["since"] = since
+            if self.msgpack:
+                request["msgpack"] = True
+            if self.compress:
+                request["compress"] = True
+            if self.lazy:
+                request["lazy"] = True
         if activity is not None:
             request["activity"] = activity
+        if resync is not None:
+            request["resync"] = resync
         await self.channel_layer.send(MASTER_CHANNEL_NAME, request)
 
+    def enqueue(self, frame, is_delta=False, committed=None):
+        self.outbox.append((frame, is_delta, committed))
+        if is_delta:
+            self.outbox_deltas += 1
+        self.outbox_ready.set()
+
+    async def drain(self):
+        while True:
+            await self.outbox_ready.wait()
+            while self.outbox:
+                frame, is_delta, committed = self.outbox.popleft()
+                if is_delta:
+                    self.outbox_deltas -= 1
+                if isinstance(frame, bytes):
+                    await self.send(bytes_data=frame)
+                else:
+                    await self.send(text_data=frame)
+                if committed is not None:
+                    metrics.observe(
+                        "checkmate_broadcast_stage_seconds",
+                        time.time() - committed,
+                        stage="delivered",
+                    )
+            self.outbox_ready.clear()
+
+    async def resync(self, reason, since=None):
+        """
+        Drop everything queued for the client and fetch a single snapshot (or
+        the deltas after version `since`) instead, because the client is
+        reading too slowly (`reason` "slow") or a broadcast was lost (`reason`
+        "gap").
+        """
+        collapsed = self.outbox_deltas + self.stalled_deltas
+        logger.info(
+            "Resyncing %s (%s) instead of sending %d queued frames",
+            self.channel_name,
+            reason,
+            len(self.outbox),
+        )
+        self.outbox.clear()
+        self.outbox_deltas = 0
+        self.stalled_deltas = 0
+        self.fetching = True
+        await self.query(
+            fetch=True, since=since, resync={"reason": reason, "collapsed": collapsed}
+        )
+
+    def stall(self):
+        """
+        Stop sending to the client until it has read everything sent so far,
+        then resync from the last version it received (see `receive`).
+        """
+        logger.info(
+            "Pausing %s, which last echoed version %d of %d",
+            self.channel_name,
+            self.acked,
+            self.version,
+        )
+        self.stalled = True
+        self.stalled_deltas = 1
+
     async def client_update(self, event):
+        if event.get("fetch") is True:
+            self.fetching = False
+        elif self.fetching:
+            return
+        elif self.stalled:
+            # included in the fetch once the client catches up
+            self.stalled_deltas += 1
+            return
+        elif event["version"] > self.version + 1:
+            # dropped by the channel layer, the client would apply the next
+            # delta to a stale base
+            await self.resync("gap")
+            return
+        elif len(self.outbox) >= self.BACKLOG_LIMIT:
+            await self.resync("slow")
+            return
+        elif (
+            self.acked is not None
+            and event["version"] - self.acked > self.BACKLOG_LIMIT
+        ):
+            self.stall()
+            return
         if self.version < event["version"]:
             self.version = event["version"]
             self.timestamp = event["timestamp"]
-        await self.send(text_data=event["update"])
+        # compressed payloads are only sent to clients that opted in
+        compressed = event.get("compressed")
+        if self.msgpack:
+            frame = event["packed"]
+        elif (
+            self.lazy
+            and "lazy_update" in event
+            and self.subscriptions.isdisjoint(event["text_changed"])
+        ):
+            frame = event["lazy_update"]
+        elif compressed is not None:
+            frame = compressed
+        else:
+            frame = event["update"]
+        is_delta = event.get("fetch") is not True
+        committed = event.get("stages", {}).get("committed")
+        self.enqueue(frame, is_delta=is_delta, committed=committed)
 
     async def client_notify(self, event):
         # similar to update but no versioning
-        await self.send(text_data=event["payload"])
+        if self.stalled:
+            return
+        if self.msgpack:
+            self.enqueue(encoding.packb(encoding.loads(event["payload"])))
+        else:
+            self.enqueue(event["payload"])
 
-    async def receive(self, text_data=None, data=None):
+    async def receive(self, text_data=None, bytes_data=None, data=None):
         if self.timestamp is not None:
             if data is None:
                 try:
-                    data = json.loads(text_data)
+                    if bytes_data is not None and self.msgpack:
+                        data = msgpack.unpackb(bytes_data)
+                    else:
+                        data = encoding.loads(text_data)
                 except:
                     return
+                if not isinstance(data, dict):
+                    return
             version = data.get("version")
             activity = data.get("activity")
+            subscribe = data.get("subscribe")
             request = {}
+            if isinstance(version, int) and (
+                self.acked is None or version > self.acked
+            ):
+                self.acked = version
+                if self.stalled and version >= self.version:
+                    # the client has read everything sent before the stall
+                    self.stalled = False
+                    await self.resync("slow", since=version)
+            if isinstance(subscribe, dict):
+                # replaces the set of rounds and puzzles to receive text for
+                self.subscriptions = {
+                    f"{section}/{slug}"
+                    for section in api.LAZY_TEXT_SECTIONS
+                    if isinstance(subscribe.get(section), list)
+                    for slug in subscribe[section]
+                    if isinstance(slug, str)
+                }
             if data.get("force") is True:
                 request["fetch"] = True
+                if isinstance(version, int):
+                    request["since"] = version
             elif (
                 isinstance(version, int)
                 and version < self.version
                 and self.timestamp - time.time() > self.SYNC_THRESHOLD
             ):
                 request["fetch"] = True
+                request["since"] = version
             if isinstance(activity, dict):
                 puzzle = activity.get("puzzle")
                 tab = activity.get("tab")
@@ -87,32 +283,37 @@ class ClientConsumer(AsyncWebsocketConsumer):
                     and isinstance(tab, int)
                     and uid is not None
                 ):
-                    self.tab = tab
-                    self.puzzle = puzzle
-                    request["activity"] = {
-                        "uid": uid,
-                        "tab": tab,
-                        "puzzle": puzzle,
-                    }
-                    await self.channel_layer.group_send(
-                        CLIENT_GROUP_NAME,
-                        {
-                            "type": "client.notify",
-                            "payload": json.dumps(
-                                {
-                                    "activities": [request["activity"]],
-                                }
-                            ),
-                        },
-                    )
+                    # drop repeated heartbeats; the master batches the rest
+                    # into one broadcast per tick
+                    now = time.monotonic()
+                    if (
+                        tab != self.tab
+                        or puzzle != self.puzzle
+                        or self.activity_forwarded < now - self.ACTIVITY_REFRESH_TIME
+                    ):
+                        self.tab = tab
+                        self.puzzle = puzzle
+                        self.activity_forwarded = now
+                        request["activity"] = {
+                            "uid": uid,
+                            "tab": tab,
+                            "puzzle": puzzle,
+                        }
             if request:
                 await self.query(**request)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(
-            CLIENT_GROUP_NAME,
-            self.channel_name,
-        )
+        sender = getattr(self, "sender", None)
+        if sender is not None:
+            sender.cancel()
+            ClientConsumer.connected -= 1
+            metrics.set_process_gauge("checkmate_websocket_clients", self.connected)
+        await self.channel_layer.group_discard(CLIENT_GROUP_NAME, self.channel_name)
+        variant = getattr(self, "variant", None)
+        if variant is not None:
+            await self.channel_layer.group_discard(
+                variant_group(variant), self.channel_name
+            )
         if self.puzzle is not None and self.tab is not None:
             await self.receive(
                 data={
@@ -124,81 +325,709 @@ class ClientConsumer(AsyncWebsocketConsumer):
             )
 
 
+@dataclasses.dataclass
+class EncodedSnapshot:
+    version: int
+    data: str
+    size: int  # bytes (encoded JSON is ascii)
+    encode_time: float  # s
+    compressed: bytes = None
+    packed: bytes = None  # MessagePack
+
+
+class DeltaHistory:
+    """
+    Bounded history of encoded deltas, keyed by the version they apply to.
+    Oldest deltas are evicted past `max_length` entries or `max_bytes` total.
+    """
+
+    def __init__(self, max_length, max_bytes):
+        self.max_length = max_length
+        self.max_bytes = max_bytes
+        self.deltas = OrderedDict()  # prev_version -> (version, update)
+        self.size = 0
+
+    def add(self, prev_version, version, update):
+        self.deltas[prev_version] = (version, update)
+        self.size += len(update)
+        while self.deltas and (
+            len(self.deltas) > self.max_length or self.size > self.max_bytes
+        ):
+            _, (_, evicted) = self.deltas.popitem(last=False)
+            self.size -= len(evicted)
+
+    def since(self, version, current):
+        """
+        Return the list of (version, update) taking `version` to `current`,
+        or None if the history does not reach back to `version`.
+        """
+        if not isinstance(version, int):
+            return None
+        chain = []
+        while version in self.deltas:
+            version, update = self.deltas[version]
+            chain.append((version, update))
+        if version != current:
+            return None
+        return chain
+
+
 class BroadcastMasterConsumer(SyncConsumer):
     ACTIVITY_CACHE_TIME = 60  # s
+    DELTA_HISTORY_LENGTH = 256
+    DELTA_HISTORY_BYTES = 8 * 2**20
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.timestamp = None
         self.version = None
         self.data = None
-        self.activity = deque()
+        self.section_versions = None  # version each section last changed
+        self.snapshots = {}  # lazy -> EncodedSnapshot
+        self.encoded_sections = {}  # (section, lazy) -> (version, encoded)
+        self.presence = PresenceStore(self.ACTIVITY_CACHE_TIME)
+        self.pending_activities = {}  # (uid, tab) -> activity
+        self.activity_sent = {}  # (uid, tab) -> (monotonic s, activity)
+        self.activity_tick_scheduled = False
+        self.history = DeltaHistory(self.DELTA_HISTORY_LENGTH, self.DELTA_HISTORY_BYTES)
+        self.store = MasterStateStore(self.DELTA_HISTORY_LENGTH)
+        self.pending = PendingUpdate()
+        self.flush_scheduled = False
+        # snapshots are rebuilt in a worker thread so fetches and activity are
+        # served from the last version meanwhile
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="master-rebuild"
+        )
+        self.rebuild = None  # (future, PendingUpdate) in flight
+        self.rebuild_dirty = False  # a flush was deferred during the rebuild
+        # and checkpointed to the store in another one, since it is only needed
+        # by a successor and the deltas saved with each version catch it up
+        self.checkpointer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="master-checkpoint"
+        )
+        self.checkpoint = None  # future in flight
+        self.checkpoint_dirty = False  # a version was committed meanwhile
+        self.stats = Counter()
+        self.loop = None
+
+    async def __call__(self, *args, **kwargs):
+        # needed to schedule delayed flushes from the handler thread
+        self.loop = asyncio.get_running_loop()
+        await super().__call__(*args, **kwargs)
 
     def maybe_init(self):
         if self.version is None:
-            self.timestamp = cachalot.api.get_last_invalidation()
-            self.version = 1  # version 0 is empty set, version 1 is initial data
-            self.data = api.data_everything()
+            saved = self.store.load()
+            data = None
+            if saved is not None:
+                # take over from the previous leader: bring its last checkpoint
+                # up to its last version
+                state, version, data, deltas = saved
+                for prev_version, next_version, update in deltas:
+                    self.history.add(prev_version, next_version, update)
+                for version, update in (
+                    self.history.since(version, state["version"]) or []
+                ):
+                    update = encoding.loads(update)
+                    data = patch(data, update["data"], update["roots"])
+                if version != state["version"]:
+                    logger.warning(
+                        "Saved deltas do not reach v%d from the checkpoint at v%d",
+                        state["version"],
+                        version,
+                    )
+                    data = None
+            if data is None:
+                self.timestamp = time.time()
+                # version 0 is empty set, version 1 is initial data; after an
+                # incomplete handoff clients see a gap and refetch
+                self.version = 1 if saved is None else saved[0]["version"] + 1
+                self.data = api.data_everything()
+                self.section_versions = {key: self.version for key in self.data}
+                self.history = DeltaHistory(
+                    self.DELTA_HISTORY_LENGTH, self.DELTA_HISTORY_BYTES
+                )
+                self.save_state()
+                self.checkpoint_snapshot()
+            else:
+                # JSON object keys are strings but user ids are ints
+                data["users"] = {int(key): user for key, user in data["users"].items()}
+                self.data = data
+                self.version = state["version"]
+                self.timestamp = state["timestamp"]
+                self.section_versions = {
+                    key: state.get("section_versions", {}).get(key, self.version)
+                    for key in self.data
+                }
+                # and catch up on anything it missed
+                self.update(None)
+
+    def save_state(self, delta=None):
+        # raises LeaseLost if another master has taken over, which stops this
+        # one (see `runmaster`)
+        self.store.save(
+            {
+                "version": self.version,
+                "timestamp": self.timestamp,
+                "section_versions": self.section_versions,
+            },
+            delta,
+        )
+
+    def checkpoint_snapshot(self):
+        """
+        Save the snapshot of the current version in the checkpoint thread, or
+        once the checkpoint in flight is done.
+        """
+        if self.checkpoint is not None:
+            self.checkpoint_dirty = True
+            return
+        future = self.checkpointer.submit(
+            self.store.checkpoint, self.version, self.encoded_snapshot().data
+        )
+        future.add_done_callback(
+            lambda future: self.send_later(
+                0, {"type": "server.checkpointed", "future": future}
+            )
+        )
+        self.checkpoint = future
+
+    def server_checkpointed(self, event):
+        if self.checkpoint is not event.get("future"):
+            return
+        self.checkpoint = None
+        try:
+            event["future"].result()
+        except LeaseLost:
+            # the worker is stopping (see `runmaster`)
+            return
+        except Exception:
+            # retried with the next version
+            logger.exception("Snapshot checkpoint failed")
+            return
+        if self.checkpoint_dirty:
+            self.checkpoint_dirty = False
+            self.checkpoint_snapshot()
+
+    def encoded_snapshot(self, lazy=False):
+        """
+        Get the JSON encoded snapshot for the current version. This is shared
+        by every fetch until the version changes. Only sections that changed
+        since they were last encoded are encoded again.
+
+        If `lazy`, large text fields are replaced by their digests (see
+        `api.lazy_entity`).
+        """
+        snapshot = self.snapshots.get(lazy)
+        if snapshot is None or snapshot.version != self.version:
+            start = time.perf_counter()
+            sections = []
+            for key, value in self.data.items():
+                version = self.section_versions.get(key)
+                cached = self.encoded_sections.get((key, lazy))
+                if cached is None or cached[0] != version:
+                    if lazy and key in api.LAZY_TEXT_SECTIONS:
+                        value = {
+                            slug: api.lazy_entity(entity)
+                            for slug, entity in value.items()
+                        }
+                    cached = (version, encoding.dumps(value))
+                    self.encoded_sections[(key, lazy)] = cached
+                sections.append(f"{encoding.dumps(key)}: {cached[1]}")
+            data = f"{{{', '.join(sections)}}}"
+            snapshot = self.snapshots[lazy] = EncodedSnapshot(
+                version=self.version,
+                data=data,
+                size=len(data),
+                encode_time=time.perf_counter() - start,
+            )
+            logger.debug(
+                "Encoded snapshot v%d: %d bytes in %.3fs",
+                snapshot.version,
+                snapshot.size,
+                snapshot.encode_time,
+            )
+            metrics.set_gauge(
+                "checkmate_snapshot_bytes", snapshot.size, lazy=str(lazy).lower()
+            )
+        return snapshot
+
+    def compressed_snapshot(self, lazy=False):
+        """
+        Get the compressed fetch response (without activities) for the current
+        version. This is shared by every fetch until the version changes.
+        """
+        snapshot = self.encoded_snapshot(lazy)
+        if snapshot.compressed is None:
+            snapshot.compressed = self.compress(
+                f'{{"prev_version": null, "version": {snapshot.version}, '
+                f'"roots": true, "data": {snapshot.data}}}'
+            )
+        return snapshot.compressed
+
+    def packed_snapshot(self):
+        """
+        Get the MessagePack encoded snapshot for the current version. This is
+        shared by every fetch until the version changes.
+        """
+        snapshot = self.encoded_snapshot()
+        if snapshot.packed is None:
+            snapshot.packed = encoding.packb(self.data)
+        return snapshot.packed
+
+    def use_compression(self, event):
+        snapshot = self.encoded_snapshot(event.get("lazy") is True)
+        return (
+            event.get("compress") is True
+            and snapshot.size >= settings.WEBSOCKET_COMPRESSION_THRESHOLD
+        )
+
+    def compress(self, text):
+        compressed = zlib.compress(text.encode())
+        self.count_compression(text, compressed)
+        return compressed
+
+    def count(self, event, value=1):
+        self.stats[event] += value
+        metrics.increment("checkmate_master_events_total", value, event=event)
+
+    def count_compression(self, text, compressed):
+        self.count("compression_bytes_in", len(text))
+        self.count("compression_bytes_out", len(compressed))
+        logger.debug("Compressed %d bytes to %d", len(text), len(compressed))
 
     def client_query(self, event):
         self.maybe_init()
-        # prune activity
         now = time.monotonic()
-        while self.activity and self.activity[0][0] < now - self.ACTIVITY_CACHE_TIME:
-            self.activity.popleft()
+        resync = event.get("resync")
+        if resync is not None:
+            # a client fell behind and collapsed its backlog into this fetch
+            if resync["reason"] == "slow":
+                self.count("slow_consumers")
+            else:
+                self.count("update_gaps")
+            self.count("collapsed_deltas", resync["collapsed"])
         # perform fetch
+        deltas = None
         if event.get("fetch") is True:
+            deltas = self.history.since(event.get("since"), self.version)
+        if deltas is not None:
+            variant = client_variant(
+                event.get("msgpack") is True,
+                event.get("compress") is True,
+                event.get("lazy") is True,
+            )
+            # decoded for the other encodings, which see user ids as strings
+            # like JSON clients do
+            for version, update in deltas:
+                self.send_delta(
+                    event["channel"], version, encoding.loads(update), update, variant
+                )
+            # no-op update to mark the client as current
+            payload = {
+                "prev_version": self.version,
+                "version": self.version,
+                "data": {},
+                "roots": {},
+                "activities": self.presence.current(),
+            }
+            self.send_delta(
+                event["channel"],
+                self.version,
+                payload,
+                encoding.dumps(payload),
+                variant,
+            )
+        elif event.get("fetch") is True and event.get("msgpack") is True:
+            packer = msgpack.Packer()
+            header = {
+                "prev_version": None,  # version None for any
+                "version": self.version,
+                "roots": True,
+                "activities": self.presence.current(),
+            }
+            # splice the shared packed data into the per request header
+            packed = packer.pack_map_header(len(header) + 1)
+            for key, value in header.items():
+                packed += packer.pack(key) + packer.pack(value)
+            packed += packer.pack("data") + self.packed_snapshot()
             async_to_sync(self.channel_layer.send)(
                 event["channel"],
                 {
                     "type": "client.update",
+                    "fetch": True,
                     "version": self.version,
                     "timestamp": self.timestamp,
-                    "update": json.dumps(
+                    "packed": packed,
+                },
+            )
+        elif event.get("fetch") is True and self.use_compression(event):
+            async_to_sync(self.channel_layer.send)(
+                event["channel"],
+                {
+                    "type": "client.update",
+                    "fetch": True,
+                    "version": self.version,
+                    "timestamp": self.timestamp,
+                    "compressed": self.compressed_snapshot(event.get("lazy") is True),
+                },
+            )
+            async_to_sync(self.channel_layer.send)(
+                event["channel"],
+                {
+                    "type": "client.notify",
+                    "payload": encoding.dumps(
                         {
-                            "prev_version": None,  # version None for any
-                            "version": self.version,
-                            "data": self.data,
-                            "roots": True,
-                            "activities": [
-                                _activity for ts, _activity in self.activity
-                            ],
+                            "activities": self.presence.current(),
                         }
                     ),
                 },
             )
+        elif event.get("fetch") is True:
+            snapshot = self.encoded_snapshot(event.get("lazy") is True)
+            header = encoding.dumps(
+                {
+                    "prev_version": None,  # version None for any
+                    "version": self.version,
+                    "roots": True,
+                    "sections": self.section_versions,
+                    "activities": self.presence.current(),
+                    "snapshot": {
+                        "size": snapshot.size,
+                        "encode_time": snapshot.encode_time,
+                    },
+                }
+            )
+            async_to_sync(self.channel_layer.send)(
+                event["channel"],
+                {
+                    "type": "client.update",
+                    "fetch": True,
+                    "version": self.version,
+                    "timestamp": self.timestamp,
+                    # splice the shared encoded data into the per request header
+                    "update": f'{header[:-1]}, "data": {snapshot.data}}}',
+                },
+            )
         # update cache with client's activity
         activity = event.get("activity")
         if activity is not None:
-            self.activity.append((now, activity))
+            self.presence.update(activity)
+            # only broadcast changes, and unchanged activities often enough
+            # for clients not to expire them
+            key = (activity["uid"], activity["tab"])
+            ts, sent = self.activity_sent.get(key, (None, None))
+            if sent != activity or ts < now - self.ACTIVITY_CACHE_TIME:
+                self.pending_activities[key] = activity
+                if not self.activity_tick_scheduled:
+                    self.activity_tick_scheduled = True
+                    self.send_later(
+                        settings.ACTIVITY_BROADCAST_INTERVAL,
+                        {"type": "server.activity_tick"},
+                    )
+
+    def send_delta(self, channel, version, payload, update, variant):
+        """
+        Send the delta to `version` to `channel`, encoded for clients using
+        `variant` from its `payload` and the JSON encoded `update`.
+        """
+        fields = encode_delta(payload, update, [variant])[variant]
+        if "compressed" in fields:
+            self.count_compression(update, fields["compressed"])
+        async_to_sync(self.channel_layer.send)(
+            channel,
+            {
+                "type": "client.update",
+                "fetch": True,
+                "version": version,
+                "timestamp": self.timestamp,
+                **fields,
+            },
+        )
 
     def server_maybe_update(self, event):
+        """
+        Queue row level `changes` (see `changes.py`), or a full recompute if
+        no changes are given. Bursts of updates are folded into one broadcast
+        sent at most BROADCAST_MAX_LATENCY after the first update and once no
+        update has arrived for BROADCAST_DEBOUNCE.
+        """
         self.maybe_init()
-        timestamp = cachalot.api.get_last_invalidation()
-        if self.timestamp < timestamp:
-            self.timestamp = timestamp
-            version = self.version + 1
-            data = api.data_everything()
-            delta, roots = diff(self.data, data)
-            if roots:
-                async_to_sync(self.channel_layer.group_send)(
-                    CLIENT_GROUP_NAME,
-                    {
-                        "type": "client.update",
-                        "version": version,
-                        "timestamp": timestamp,
-                        "update": json.dumps(
-                            {
-                                "prev_version": self.version,
-                                "version": version,
-                                "data": delta,
-                                "roots": roots,
-                            }
-                        ),
-                    },
+        now = time.monotonic()
+        self.pending.add(event.get("changes"), now, event.get("time"))
+        self.count("invalidations")
+        if not self.flush_scheduled:
+            self.schedule_flush(self.pending.deadline() - now)
+
+    def server_flush(self, event):
+        self.flush_scheduled = False
+        if not self.pending.count:
+            return
+        delay = self.pending.deadline() - time.monotonic()
+        if delay > 0:
+            self.schedule_flush(delay)
+            return
+        if self.rebuild is not None:
+            # one rebuild at a time; flush again once it is done
+            self.rebuild_dirty = True
+            return
+        pending = self.pending
+        self.pending = PendingUpdate()
+        future = self.executor.submit(
+            self.build_in_thread,
+            self.version,
+            self.data,
+            None if pending.full else pending.changes,
+        )
+        future.add_done_callback(
+            lambda future: self.send_later(
+                0, {"type": "server.rebuilt", "future": future}
+            )
+        )
+        self.rebuild = (future, pending)
+
+    def server_rebuilt(self, event):
+        """Broadcast the result of the rebuild started by `server_flush`."""
+        if self.rebuild is None or self.rebuild[0] is not event.get("future"):
+            # stale notification of a rebuild that has been handled
+            return
+        future, pending = self.rebuild
+        self.rebuild = None
+        try:
+            rebuild = future.result()
+        except Exception:
+            logger.exception("Snapshot rebuild failed")
+            # retry with everything
+            self.pending.add(None, time.monotonic())
+            self.rebuild_dirty = True
+        else:
+            if rebuild is not None:
+                self.commit(rebuild, pending)
+        if self.rebuild_dirty and not self.flush_scheduled:
+            self.rebuild_dirty = False
+            self.schedule_flush(self.pending.deadline() - time.monotonic())
+
+    def schedule_flush(self, delay):
+        self.flush_scheduled = True
+        if delay <= 0:
+            self.server_flush({})
+        else:
+            self.send_later(delay, {"type": "server.flush"})
+
+    def send_later(self, delay, message):
+        """
+        Handle `message` after `delay` seconds. The timer stays in this process
+        rather than going through the channel layer, where the message could
+        be dropped (full channel or expiry) and leave its flag set for good.
+        """
+        self.loop.call_soon_threadsafe(
+            self.loop.call_later, delay, self.dispatch_later, message
+        )
+
+    def dispatch_later(self, message):
+        # runs on the handler thread like the messages from the channel layer,
+        # in a fresh context since the timer was started from that thread
+        task = self.loop.create_task(
+            self.dispatch(message), context=contextvars.Context()
+        )
+        task.add_done_callback(self.log_dispatch_error)
+
+    @staticmethod
+    def log_dispatch_error(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Timer handler failed", exc_info=task.exception())
+
+    def server_stats(self, event):
+        """Reply to `event["channel"]` with the master's counters."""
+        self.maybe_init()
+        async_to_sync(self.channel_layer.send)(
+            event["channel"],
+            {
+                "type": "master.stats",
+                "version": self.version,
+                "cpu_time": time.process_time(),
+                "stats": dict(self.stats),
+            },
+        )
+
+    def server_activity_tick(self, event):
+        """Broadcast the activities queued since the last tick."""
+        self.activity_tick_scheduled = False
+        if not self.pending_activities:
+            return
+        now = time.monotonic()
+        payload = {
+            "activities": list(self.pending_activities.values()),
+        }
+        async_to_sync(self.channel_layer.group_send)(
+            CLIENT_GROUP_NAME,
+            {
+                "type": "client.notify",
+                "payload": encoding.dumps(payload),
+            },
+        )
+        for key, activity in self.pending_activities.items():
+            self.activity_sent[key] = (now, activity)
+        self.pending_activities = {}
+        # forget tabs that have not been heard from
+        for key, (ts, _) in list(self.activity_sent.items()):
+            if ts < now - self.ACTIVITY_CACHE_TIME:
+                del self.activity_sent[key]
+
+    def update(self, changes):
+        """
+        Apply `changes` to the snapshot, or recompute everything if `changes`
+        is None, and broadcast the delta. Blocks the consumer; only used while
+        taking over.
+        """
+        rebuild = self.build(self.version, self.data, changes)
+        if rebuild is not None:
+            self.commit(rebuild)
+
+    def build_in_thread(self, version, data, changes):
+        db.close_old_connections()
+        try:
+            return self.build(version, data, changes)
+        finally:
+            db.close_old_connections()
+
+    def build(self, version, data, changes):
+        """
+        Compute the version after `version`, whose snapshot is `data`, and the
+        broadcast for it. Returns None if nothing changed.
+
+        Does not modify `data` or the consumer, so that it can run in the
+        rebuild thread while the consumer serves `data`.
+        """
+        start = time.perf_counter()
+        stages = {}
+        if changes is None:
+            new_data = api.data_everything()
+            stages["queried"] = time.time()
+            delta, roots = diff(data, new_data)
+        else:
+            partial = api.data_partial(changes)
+            stages["queried"] = time.time()
+            new_data, delta, roots = apply_partial(data, partial)
+        stages["diffed"] = time.time()
+        if not roots:
+            return None
+        payload = {
+            "prev_version": version,
+            "version": version + 1,
+            "data": delta,
+            "roots": roots,
+        }
+        update = encoding.dumps(payload)
+        return Rebuild(
+            version=version + 1,
+            data=new_data,
+            roots=roots,
+            update=update,
+            frames=encode_delta(payload, update),
+            build_time=time.perf_counter() - start,
+            stages=stages,
+        )
+
+    def commit(self, rebuild, pending=None):
+        """
+        Broadcast `rebuild`, made from the `pending` changes if given, and make
+        it the current version.
+        """
+        timestamp = time.time()
+        stages = rebuild.stages
+        if pending is not None:
+            stages["received"] = pending.received
+            stages["committed"] = pending.committed or pending.received
+        for fields in rebuild.frames.values():
+            if "compressed" in fields:
+                self.count_compression(rebuild.update, fields["compressed"])
+                break
+        self.history.add(self.version, rebuild.version, rebuild.update)
+        self.timestamp = timestamp
+        self.version = rebuild.version
+        self.data = rebuild.data
+        for section in rebuild.roots:
+            self.section_versions[section] = rebuild.version
+        # saved first so clients never see a version a successor does not know
+        self.save_state(rebuild.update)
+        for variant, fields in rebuild.frames.items():
+            async_to_sync(self.channel_layer.group_send)(
+                variant_group(variant),
+                {
+                    "type": "client.update",
+                    "version": rebuild.version,
+                    "timestamp": timestamp,
+                    "stages": stages,
+                    **fields,
+                },
+            )
+        stages["sent"] = time.time()
+        self.checkpoint_snapshot()
+        if stages.get("committed") is not None:
+            for stage in ("received", "queried", "diffed", "sent"):
+                metrics.observe(
+                    "checkmate_broadcast_stage_seconds",
+                    stages[stage] - stages["committed"],
+                    stage=stage,
                 )
-                self.version = version
-                self.data = data
+        self.count("broadcasts")
+        metrics.increment("checkmate_broadcasts_total")
+        metrics.set_gauge("checkmate_version", self.version)
+        logger.debug(
+            "Broadcast v%d from %d invalidations, built in %.3fs",
+            rebuild.version,
+            1 if pending is None else pending.count,
+            rebuild.build_time,
+        )
+
+
+@dataclasses.dataclass
+class Rebuild:
+    """The next version of the snapshot, see `BroadcastMasterConsumer.build`."""
+
+    version: int
+    data: dict
+    roots: dict
+    update: str  # encoded delta
+    frames: dict  # variant -> encoded fields of the broadcast to its clients
+    build_time: float  # s
+    stages: dict  # stage -> wall time
+
+
+@dataclasses.dataclass
+class PendingUpdate:
+    """Changes accumulated by the master since its last broadcast."""
+
+    changes: dict = dataclasses.field(default_factory=dict)
+    full: bool = False
+    count: int = 0
+    first: float = None  # monotonic s
+    last: float = None  # monotonic s
+    committed: float = None  # wall time of the earliest commit
+    received: float = None  # wall time of the first update
+
+    def add(self, changes, now, committed=None):
+        if changes is None:
+            self.full = True
+        else:
+            for section, keys in changes.items():
+                self.changes.setdefault(section, set()).update(keys)
+        self.count += 1
+        if self.first is None:
+            self.first = now
+            self.received = time.time()
+        self.last = now
+        if committed is not None and (
+            self.committed is None or committed < self.committed
+        ):
+            self.committed = committed
+
+    def deadline(self):
+        return min(
+            self.last + settings.BROADCAST_DEBOUNCE,
+            self.first + settings.BROADCAST_MAX_LATENCY,
+        )
 
 
 VOID = lambda: None
@@ -208,30 +1037,130 @@ def diff(old, new):
     """
     Return (data, roots) where `data` is the tree of updates and `roots`
     specifies which nodes should be replaced.
+
+    Equal subtrees are detected with a single (C level) equality check before
+    descending, so unchanged entities cost almost nothing.
     """
+    if old == new:
+        return None, False  # old == new
     if isinstance(old, dict) and isinstance(new, dict):
         data = {}
         roots = {}
-        for key in set(old.keys()) | set(new.keys()):
+        for key in old.keys() | new.keys():
             subdata, subroots = diff(old.get(key, VOID), new.get(key, VOID))
             if subroots:
                 roots[key] = subroots
                 if subdata is not VOID:
                     data[key] = subdata
-        if roots:
-            return data, roots  # old != new
-        else:
-            return None, False  # old == new
+        return data, roots  # old != new
     else:
-        if old == new:
-            return None, False  # old == new
+        return new, True  # old != new
+
+
+def patch(data, delta, roots):
+    """
+    Apply the changes returned by `diff` to `data`, which is modified. Returns
+    the updated data.
+    """
+    if roots is True:
+        return delta
+    for key, subroots in roots.items():
+        if subroots is True and key not in delta:
+            data.pop(key, None)
         else:
-            return new, True  # old != new
+            data[key] = patch(data.get(key), delta[key], subroots)
+    return data
+
+
+def apply_partial(data, partial):
+    """
+    Apply the sections returned by `api.data_partial` to `data`. Returns
+    (data, delta, roots): the updated data, and the changes in the same format
+    as `diff`. The given `data` is not modified; the updated data shares the
+    unchanged sections and entries with it.
+    """
+    data = dict(data)
+    delta = {}
+    roots = {}
+    for section, value in partial.items():
+        if section in ("users", "rounds", "puzzles"):
+            entries = data[section]
+            copied = False
+            for key, entry in value.items():
+                subdata, subroots = diff(
+                    entries.get(key, VOID), VOID if entry is None else entry
+                )
+                if subroots:
+                    roots.setdefault(section, {})[key] = subroots
+                    if subdata is not VOID:
+                        delta.setdefault(section, {})[key] = subdata
+                    if not copied:
+                        entries = data[section] = dict(entries)
+                        copied = True
+                    if entry is None:
+                        del entries[key]
+                    else:
+                        entries[key] = entry
+        else:
+            subdata, subroots = diff(data.get(section, VOID), value)
+            if subroots:
+                roots[section] = subroots
+                delta[section] = subdata
+                data[section] = value
+    return data, delta, roots
 
 
-@dispatch.receiver(cachalot.signals.post_invalidation)
-def update_cache(sender, **kwargs):
-    async_to_sync(get_channel_layer().send)(
-        MASTER_CHANNEL_NAME,
-        {"type": "server.maybe_update"},
-    )
+# encodings of broadcasts, see `client_variant`
+VARIANTS = ("json", "deflate", "lazy", "lazy-deflate", "msgpack")
+
+
+def client_variant(msgpack=False, compress=False, lazy=False):
+    """Name the encoding of broadcasts for a client with the given options."""
+    if msgpack:
+        return "msgpack"
+    if lazy:
+        return "lazy-deflate" if compress else "lazy"
+    return "deflate" if compress else "json"
+
+
+def variant_group(variant):
+    """Group of the clients receiving broadcasts encoded as `variant`."""
+    return f"{CLIENT_GROUP_NAME}.{variant}"
+
+
+def encode_delta(payload, update, variants=VARIANTS):
+    """
+    Encode the delta `payload`, which is `update` as JSON, for `variants`.
+    Returns variant -> fields of the `client.update` message for its clients
+    (see `ClientConsumer.client_update`).
+    """
+    frames = {}
+    compressed = None
+    lazy = None
+    for variant in variants:
+        if variant == "msgpack":
+            frames[variant] = {"packed": encoding.packb(payload)}
+            continue
+        fields = frames[variant] = {}
+        if (
+            variant in ("deflate", "lazy-deflate")
+            and len(update) >= settings.WEBSOCKET_COMPRESSION_THRESHOLD
+        ):
+            if compressed is None:
+                compressed = zlib.compress(update.encode())
+            fields["compressed"] = compressed
+        else:
+            fields["update"] = update
+        if variant in ("lazy", "lazy-deflate"):
+            if lazy is None:
+                lazy = {}
+                lazy_delta, text_changed = api.lazy_delta(payload["data"])
+                if text_changed:
+                    # clients not subscribed to the changed text only get
+                    # digests
+                    lazy["text_changed"] = text_changed
+                    lazy["lazy_update"] = encoding.dumps(
+                        {**payload, "data": lazy_delta}
+                    )
+            fields.update(lazy)
+    return frames
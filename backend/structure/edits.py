@@ -0,0 +1,208 @@
+"""
+Write-behind buffer for edits of text fields of rounds and puzzles.
+
+Notes and tags are edited often (a PATCH per committed edit) and saving them
+has no side effects (unlike the answer, which can solve a puzzle and notify
+Discord, so it is always saved directly). An edit of only these fields is
+acknowledged
+without saving: it is stored in a Redis hash keyed by (object, field), so a
+later edit of the same field replaces it, and sent to clients as an ephemeral
+`{"edits": {section: {slug: {field: value}}}}` notification. The `flush_edits`
+task writes the buffered edits of each model with one UPDATE at most every
+EDIT_BUFFER_INTERVAL, after which clients get the change as a regular update.
+
+Edits stay in Redis until their UPDATE is committed. A direct save that changes
+a buffered field replaces its edit with a tombstone first (see
+`discard_saved`), so a flush in progress does not write the older edit over
+it.
+"""
+
+from collections import defaultdict
+import math
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from services.celery import app
+from services.redis_manager import RedisManager
+from . import changes
+from . import encoding
+from . import models
+
+KEY = "edits"
+SCHEDULED_KEY = "edits-flush-scheduled"
+TOMBSTONE = b"null"
+
+# delete the fields of KEYS[1] that still have the values in ARGV (field, value
+# pairs), keeping edits made in the meantime
+REMOVE_SCRIPT = """
+local removed = 0
+for i = 1, #ARGV, 2 do
+    if redis.call("hget", KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        removed = removed + redis.call("hdel", KEYS[1], ARGV[i])
+    end
+end
+return removed
+"""
+
+BUFFERED_FIELDS = ("notes", "tags")
+
+SECTION_MODELS = {
+    changes.SECTIONS[model]: model for model in (models.Round, models.Puzzle)
+}
+
+
+def _field_key(model, slug, field):
+    return f"{changes.SECTIONS[model]}/{slug}/{field}"
+
+
+def schedule_flush(pipeline):
+    """Schedule a flush unless one is scheduled. Executes `pipeline`."""
+    # expires in case the task is lost
+    pipeline.set(
+        SCHEDULED_KEY,
+        1,
+        nx=True,
+        ex=max(1, math.ceil(10 * settings.EDIT_BUFFER_INTERVAL)),
+    )
+    *_, schedule = pipeline.execute()
+    if schedule:
+        app.send_task(
+            "services.tasks.flush_edits", countdown=settings.EDIT_BUFFER_INTERVAL
+        )
+
+
+def buffer(model, slug, values, user_id=None):
+    """
+    Buffer the edit of `values` (field -> validated value) of a round or
+    puzzle, schedule a flush and notify clients.
+    """
+    section = changes.SECTIONS[model]
+    edit_time = time.time()
+    pipeline = RedisManager.instance().pipeline(transaction=False)
+    for field, value in values.items():
+        pipeline.hset(
+            KEY,
+            _field_key(model, slug, field),
+            encoding.dumps({"value": value, "user": user_id, "time": edit_time}),
+        )
+    schedule_flush(pipeline)
+    payload = {"edits": {section: {slug: values}}}
+    async_to_sync(get_channel_layer().group_send)(
+        changes.CLIENT_GROUP_NAME,
+        {
+            "type": "client.notify",
+            "payload": encoding.dumps(payload),
+        },
+    )
+
+
+def discard(model, slug, fields):
+    """
+    Replace buffered edits of `fields`, which are about to be saved directly,
+    with tombstones. Must be called before the save.
+    """
+    fields = [field for field in fields if field in BUFFERED_FIELDS]
+    if fields and settings.EDIT_BUFFER_INTERVAL:
+        pipeline = RedisManager.instance().pipeline(transaction=False)
+        pipeline.hset(
+            KEY,
+            mapping={_field_key(model, slug, field): TOMBSTONE for field in fields},
+        )
+        # the flush removes the tombstones
+        schedule_flush(pipeline)
+
+
+def discard_saved(sender, instance, update_fields=None, **kwargs):
+    """
+    `pre_save` receiver for rounds and puzzles (see `apps.py`) discarding the
+    edits of the buffered fields the save changes.
+    """
+    if instance._state.adding:
+        return
+    fields = BUFFERED_FIELDS if update_fields is None else update_fields
+    discard(
+        sender,
+        instance.pk,
+        [
+            field
+            for field in fields
+            if field in BUFFERED_FIELDS
+            and instance.__dict__.get(field) != instance.original_values.get(field)
+        ],
+    )
+
+
+def _save(redis, keys):
+    """
+    Save the edits of `keys`. Returns the entries saved, including tombstones.
+    """
+    slugs_by_model = defaultdict(set)
+    for key in keys:
+        section, slug, _ = key.decode().split("/")
+        slugs_by_model[SECTION_MODELS[section]].add(slug)
+    now = timezone.now()
+    with transaction.atomic():
+        # objects deleted since the edit are skipped
+        objs_by_model = {
+            model: model.objects.select_for_update().in_bulk(sorted(slugs))
+            for model, slugs in slugs_by_model.items()
+        }
+        # read the edits once the rows are locked: a direct save discards the
+        # edits it overrides before its UPDATE, which waits for the locks
+        entries = {
+            key: entry
+            for key, entry in zip(keys, redis.hmget(KEY, keys))
+            if entry is not None
+        }
+        edits_by_model = defaultdict(lambda: defaultdict(dict))
+        for key, entry in entries.items():
+            if entry != TOMBSTONE:
+                section, slug, field = key.decode().split("/")
+                edits_by_model[SECTION_MODELS[section]][slug][field] = encoding.loads(
+                    entry
+                )
+        for model, model_edits in edits_by_model.items():
+            objs = {
+                slug: obj
+                for slug, obj in objs_by_model[model].items()
+                if slug in model_edits
+            }
+            fields = {"modified", "modified_by"}
+            for slug, obj in objs.items():
+                last_edit = None
+                for field, edit in model_edits[slug].items():
+                    setattr(obj, field, edit["value"])
+                    fields.add(field)
+                    if last_edit is None or edit["time"] > last_edit["time"]:
+                        last_edit = edit
+                obj.modified = now
+                obj.modified_by_id = last_edit["user"]
+            model.objects.bulk_update(objs.values(), sorted(fields))
+            changes.mark_changed(model, objs.keys())
+    return entries
+
+
+def flush():
+    """Save the buffered edits. Returns the number of fields saved."""
+    redis = RedisManager.instance()
+    # edits from now on schedule another flush
+    redis.delete(SCHEDULED_KEY)
+    keys = sorted(redis.hkeys(KEY))
+    if not keys:
+        return 0
+    try:
+        entries = _save(redis, keys)
+    except Exception:
+        # the edits are still buffered
+        schedule_flush(redis.pipeline(transaction=False))
+        raise
+    if entries:
+        redis.register_script(REMOVE_SCRIPT)(
+            keys=[KEY], args=[item for entry in entries.items() for item in entry]
+        )
+    return sum(entry != TOMBSTONE for entry in entries.values())
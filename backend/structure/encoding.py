@@ -0,0 +1,86 @@
+"""
+Serialization of hunt data for clients.
+
+JSON is encoded with ujson, which is about twice as fast as the standard
+library on the snapshot. The encoders accept datetimes (as `isoformat()`), but
+calling back into Python for every datetime costs more than the rest of the
+encoding, so the data builders in `api` convert the known datetime fields of
+each row once with `prepare_row` instead.
+
+Discord ids (snowflakes) do not fit in a JavaScript number. By default they are
+sent as JSON numbers and clients parse with json-bigint. With
+`settings.SNOWFLAKE_STRINGS` they are sent as strings instead, so clients can
+use `JSON.parse`. The snapshot's "format_version" tells clients which one they
+are getting.
+"""
+
+import datetime
+
+from django.conf import settings
+import msgpack
+import ujson
+
+# format_version 1: snowflakes are numbers
+# format_version 2: snowflakes are strings
+FORMAT_VERSION_NUMBERS = 1
+FORMAT_VERSION_STRINGS = 2
+
+DATETIME_FIELDS = ("created", "modified", "solved")
+
+SNOWFLAKE_FIELDS = (
+    "discord_server_id",
+    "discord_category_id",
+    "discord_text_channel_id",
+    "discord_voice_channel_id",
+)
+
+
+def format_version():
+    if settings.SNOWFLAKE_STRINGS:
+        return FORMAT_VERSION_STRINGS
+    return FORMAT_VERSION_NUMBERS
+
+
+def prepare_row(obj):
+    """
+    Convert a row dict from `QuerySet.values()` (in place) to JSON types.
+    Datetimes become ISO 8601 strings and, if SNOWFLAKE_STRINGS is enabled,
+    Discord ids become strings.
+    """
+    for field in DATETIME_FIELDS:
+        value = obj.get(field)
+        if value is not None:
+            obj[field] = value.isoformat()
+    if settings.SNOWFLAKE_STRINGS:
+        for field in SNOWFLAKE_FIELDS:
+            value = obj.get(field)
+            if value is not None:
+                obj[field] = str(value)
+    return obj
+
+
+def _default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not serializable")
+
+
+def dumps(obj, html_safe=False):
+    """
+    Encode `obj` as ASCII JSON. If `html_safe`, also escape <, > and & so the
+    result can be embedded in a script element.
+    """
+    return ujson.dumps(
+        obj,
+        default=_default,
+        escape_forward_slashes=False,
+        encode_html_chars=html_safe,
+    )
+
+
+loads = ujson.loads
+
+
+def packb(obj):
+    """Encode `obj` as MessagePack, with datetimes as in `dumps`."""
+    return msgpack.packb(obj, default=_default)
@@ -0,0 +1,102 @@
+"""In memory stand-ins for services used by the tests."""
+
+
+class FakeRedis:
+    """The Redis commands used by the tests, in memory."""
+
+    def __init__(self):
+        self.data = {}
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def hdel(self, key, *fields):
+        values = self.data.get(key, {})
+        return sum(values.pop(field, None) is not None for field in fields)
+
+    def hkeys(self, key):
+        return list(self.data.get(key, {}))
+
+    def hmget(self, key, fields):
+        values = self.data.get(key, {})
+        return [values.get(field) for field in fields]
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        if field is not None:
+            mapping = {field: value}
+        values = self.data.setdefault(key, {})
+        for field, value in mapping.items():
+            values[field.encode()] = (
+                value if isinstance(value, bytes) else value.encode()
+            )
+        return len(mapping)
+
+    def lrange(self, key, start, stop):
+        values = self.data.get(key, [])
+        return values[start : None if stop == -1 else stop + 1]
+
+    def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(
+            value if isinstance(value, bytes) else value.encode() for value in values
+        )
+        return len(self.data[key])
+
+    def hvals(self, key):
+        return list(self.data.get(key, {}).values())
+
+    def zadd(self, key, mapping):
+        scores = self.data.setdefault(key, {})
+        for member, score in mapping.items():
+            scores[member.encode()] = score
+        return len(mapping)
+
+    def zrangebyscore(self, key, min, max):
+        scores = self.data.get(key, {})
+        low = float(min)
+        high = float(max)
+        return sorted(
+            (member for member, score in scores.items() if low <= score <= high),
+            key=scores.get,
+        )
+
+    def zrem(self, key, *members):
+        scores = self.data.get(key, {})
+        return sum(scores.pop(member, None) is not None for member in members)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        # edits.REMOVE_SCRIPT
+        def remove(keys, args):
+            values = self.data.get(keys[0], {})
+            for field, value in zip(args[::2], args[1::2]):
+                if values.get(field) == value:
+                    del values[field]
+
+        return remove
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        return lambda *args, **kwargs: self.commands.append((method, args, kwargs))
+
+    def execute(self):
+        return [method(*args, **kwargs) for method, args, kwargs in self.commands]
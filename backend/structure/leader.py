@@ -0,0 +1,243 @@
+"""
+Leader election and state handoff for the broadcast master.
+
+Several master workers can run at once. Only the holder of the Redis lease
+consumes the master channel; the others wait to take over. The leader persists
+its version and recent deltas with every broadcast, and a checkpoint of its
+snapshot in the background, so a successor continues the version sequence
+instead of forcing every client to refetch. Saves check the lease
+in the same script, so a leader that lost its lease cannot overwrite the state
+of its successor. A leader that loses its lease stops consuming and stands by
+again (see `manage.py runmaster`).
+"""
+
+import logging
+import threading
+
+from django.conf import settings
+
+from services.redis_manager import RedisManager
+from . import encoding
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class LeaderLease:
+    KEY = "channels-master-leader"
+    held = None  # the lease acquired by this process
+
+    def __init__(self, ttl=None):
+        self.ttl = settings.MASTER_LEASE_TTL if ttl is None else ttl
+        self.lock = RedisManager.instance().lock(
+            self.KEY, timeout=self.ttl, thread_local=False
+        )
+        self.on_lost = None
+        self.lost = threading.Event()
+        self.lost_lock = threading.Lock()
+
+    def acquire(self):
+        acquired = self.lock.acquire(blocking=False)
+        if acquired:
+            LeaderLease.held = self
+        return acquired
+
+    @property
+    def token(self):
+        return self.lock.local.token
+
+    def keep_alive(self, on_lost):
+        """
+        Renew the lease in a background thread until it is lost. Calls
+        `on_lost` (from any thread) if the lease could not be renewed or a
+        save found it held by another master.
+        """
+        self.on_lost = on_lost
+
+        def renew():
+            while not self.lost.wait(self.ttl / 4):
+                try:
+                    self.lock.reacquire()
+                except Exception:
+                    logger.exception("Lost channels master lease")
+                    self.lose()
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        return thread
+
+    def lose(self):
+        """Stop renewing the lease and call `on_lost`, once."""
+        with self.lost_lock:
+            if self.lost.is_set():
+                return
+            self.lost.set()
+        if self.on_lost is not None:
+            self.on_lost()
+
+
+class MasterStateStore:
+    """Persisted master state in Redis."""
+
+    STATE_KEY = "channels-master-state"
+    SNAPSHOT_KEY = "channels-master-snapshot"
+    SNAPSHOT_VERSION_KEY = "channels-master-snapshot-version"
+    DELTAS_KEY = "channels-master-deltas"
+
+    # KEYS: lease, state, deltas
+    # ARGV: lease token (empty to skip the check), state, max deltas and
+    # optionally the delta
+    SAVE_SCRIPT = """
+    if ARGV[1] ~= "" and redis.call("get", KEYS[1]) ~= ARGV[1] then
+        return 0
+    end
+    redis.call("set", KEYS[2], ARGV[2])
+    if ARGV[4] then
+        redis.call("rpush", KEYS[3], ARGV[4])
+        redis.call("ltrim", KEYS[3], -tonumber(ARGV[3]), -1)
+    end
+    return 1
+    """
+
+    # KEYS: lease, snapshot version, snapshot
+    # ARGV: lease token (empty to skip the check), version, snapshot
+    CHECKPOINT_SCRIPT = """
+    if ARGV[1] ~= "" and redis.call("get", KEYS[1]) ~= ARGV[1] then
+        return 0
+    end
+    redis.call("set", KEYS[2], ARGV[2])
+    redis.call("set", KEYS[3], ARGV[3])
+    return 1
+    """
+
+    def __init__(self, max_deltas=None):
+        self.redis = RedisManager.instance()
+        self.max_deltas = max_deltas
+
+    def run_as_leader(self, script, keys, args):
+        """
+        Run `script`, which returns 0 without writing if the lease is not held
+        with the token given as its first argument. Raises LeaseLost if this
+        process acquired the lease and no longer holds it, after notifying the
+        lease (see `keep_alive`).
+        """
+        lease = LeaderLease.held
+        saved = self.redis.register_script(script)(
+            keys=[LeaderLease.KEY, *keys],
+            args=[b"" if lease is None else lease.token, *args],
+        )
+        if not saved:
+            lease.lose()
+            raise LeaseLost()
+
+    def save(self, state, delta=None):
+        """
+        Save the `state` dict (including the current "version"). `delta` is
+        the encoded update from the previous version, if any. Raises LeaseLost
+        as `run_as_leader`.
+        """
+        version = state["version"]
+        args = [encoding.dumps(state), self.max_deltas]
+        if delta is not None:
+            args.append(encoding.dumps([version - 1, version, delta]))
+        self.run_as_leader(self.SAVE_SCRIPT, [self.STATE_KEY, self.DELTAS_KEY], args)
+
+    def checkpoint(self, version, snapshot):
+        """
+        Save the JSON encoded `snapshot` at `version`. Raises LeaseLost as
+        `run_as_leader`.
+        """
+        self.run_as_leader(
+            self.CHECKPOINT_SCRIPT,
+            [self.SNAPSHOT_VERSION_KEY, self.SNAPSHOT_KEY],
+            [version, snapshot],
+        )
+
+    def load(self):
+        """
+        Return (state, snapshot_version, data, deltas) or None if nothing is
+        saved. `data` is the decoded snapshot at `snapshot_version`, which can
+        be older than the saved state, and `deltas` is a list of
+        (prev_version, version, update).
+        """
+        pipeline = self.redis.pipeline()
+        pipeline.get(self.STATE_KEY)
+        pipeline.get(self.SNAPSHOT_VERSION_KEY)
+        pipeline.get(self.SNAPSHOT_KEY)
+        pipeline.lrange(self.DELTAS_KEY, 0, -1)
+        state, snapshot_version, snapshot, deltas = pipeline.execute()
+        if state is None or snapshot is None:
+            return None
+        deltas = [tuple(encoding.loads(delta)) for delta in deltas]
+        return (
+            encoding.loads(state),
+            int(snapshot_version),
+            encoding.loads(snapshot),
+            deltas,
+        )
+
+    def load_version(self):
+        """
+        Return the saved version, or None if nothing is saved or no master
+        holds the lease, since then the saved state may be out of date.
+        """
+        pipeline = self.redis.pipeline()
+        pipeline.get(self.STATE_KEY)
+        pipeline.exists(LeaderLease.KEY)
+        state, leader = pipeline.execute()
+        if state is None or not leader:
+            return None
+        return encoding.loads(state)["version"]
+
+    def load_snapshot_version(self):
+        """
+        Return the version of the last checkpoint, or None if there is none or
+        no master holds the lease.
+        """
+        pipeline = self.redis.pipeline()
+        pipeline.get(self.SNAPSHOT_VERSION_KEY)
+        pipeline.exists(LeaderLease.KEY)
+        version, leader = pipeline.execute()
+        if version is None or not leader:
+            return None
+        return int(version)
+
+    def load_snapshot(self):
+        """
+        Return (version, snapshot) with the last checkpoint of the JSON encoded
+        snapshot, or None.
+        """
+        pipeline = self.redis.pipeline()
+        pipeline.get(self.SNAPSHOT_VERSION_KEY)
+        pipeline.get(self.SNAPSHOT_KEY)
+        version, snapshot = pipeline.execute()
+        if version is None or snapshot is None:
+            return None
+        return int(version), snapshot.decode()
+
+    def load_updates(self, since):
+        """
+        Return (version, updates) where `updates` are the encoded updates from
+        version `since` to the saved version, or None if they are not all
+        saved.
+        """
+        pipeline = self.redis.pipeline()
+        pipeline.get(self.STATE_KEY)
+        pipeline.lrange(self.DELTAS_KEY, 0, -1)
+        state, deltas = pipeline.execute()
+        if state is None:
+            return None
+        version = encoding.loads(state)["version"]
+        if since == version:
+            return version, []
+        updates = []
+        for delta in deltas:
+            prev_version, _, update = encoding.loads(delta)
+            if prev_version == since or updates:
+                updates.append(update)
+        if not updates or since + len(updates) != version:
+            return None
+        return version, updates
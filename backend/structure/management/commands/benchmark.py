@@ -0,0 +1,47 @@
+import copy
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from structure import consumers
+from structure import encoding
+from structure.benchmarking import reference_diff, synthetic_hunt
+
+
+class Command(BaseCommand):
+    help = (
+        "Time diffing and encoding the snapshot of a synthetic hunt, against"
+        " the recursive diff and the stdlib JSON encoder."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--puzzles", type=int, default=1000)
+        parser.add_argument(
+            "--number", type=int, default=20, help="runs of each measurement"
+        )
+
+    def handle(self, *args, **options):
+        puzzles = options["puzzles"]
+        number = options["number"]
+        old = synthetic_hunt(puzzles)
+        new = copy.deepcopy(old)
+        for i in range(0, puzzles, 100):
+            new["puzzles"][f"puzzle-{i}"]["status"] = "solved"
+
+        def ms(func):
+            return 1000 * timeit.timeit(func, number=number) / number
+
+        self.stdout.write(
+            f"diff: {ms(lambda: consumers.diff(old, new)):.2f}ms"
+            f" (recursive: {ms(lambda: reference_diff(old, new)):.2f}ms)"
+        )
+        self.stdout.write(
+            f"json: {len(encoding.dumps(old))} bytes"
+            f" in {ms(lambda: encoding.dumps(old)):.2f}ms"
+            f" (stdlib: {ms(lambda: json.dumps(old)):.2f}ms)"
+        )
+        self.stdout.write(
+            f"msgpack: {len(encoding.packb(old))} bytes"
+            f" in {ms(lambda: encoding.packb(old)):.2f}ms"
+        )
@@ -0,0 +1,245 @@
+import asyncio
+from collections import defaultdict
+from importlib import import_module
+import random
+import re
+import statistics
+import time
+
+import aiohttp
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from structure import changes
+from structure import models
+from structure.changes import MASTER_CHANNEL_NAME
+
+TOKEN_PATTERN = re.compile(r"loadtest:(\d+)")
+USERNAME_PREFIX = "loadtest-"
+NAME_PREFIX = "Load test"
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure websocket fan-out against a running stack. Simulated clients"
+        " connect to the websocket while puzzle edits, relation changes and"
+        " activity are generated, then the latency from commit to receipt by"
+        " each client, bytes received per client and master CPU time are"
+        " reported."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="ws://localhost:8000/ws/")
+        parser.add_argument("--clients", type=int, default=50)
+        parser.add_argument("--duration", type=float, default=30, help="seconds")
+        parser.add_argument("--puzzles", type=int, default=20)
+        parser.add_argument(
+            "--edits", type=float, default=5, help="puzzle edits per second"
+        )
+        parser.add_argument(
+            "--relations", type=float, default=1, help="relation changes per second"
+        )
+        parser.add_argument(
+            "--activity",
+            type=float,
+            default=0.2,
+            help="activity changes per client per second",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--keep", action="store_true", help="Keep the load test puzzles and users"
+        )
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options["seed"])
+        self.setup(options["clients"], options["puzzles"])
+        try:
+            asyncio.run(self.run(options))
+        finally:
+            if not options["keep"]:
+                self.teardown()
+
+    def setup(self, num_clients, num_puzzles):
+        self.session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        self.sessions = []
+        self.created_users = []  # users that existed before are kept
+        for i in range(num_clients):
+            user, created = User.objects.get_or_create(username=f"{USERNAME_PREFIX}{i}")
+            if created:
+                self.created_users.append(user.pk)
+            session = self.session_store()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+            self.sessions.append(session.session_key)
+        self.round = models.Round.objects.create(
+            name=NAME_PREFIX, auto_assign_puzzles_to_meta=False
+        )
+        self.meta = models.Puzzle.objects.create(name=f"{NAME_PREFIX} meta")
+        self.puzzles = []
+        for i in range(num_puzzles):
+            puzzle = models.Puzzle.objects.create(name=f"{NAME_PREFIX} {i}")
+            models.RoundPuzzle(round=self.round, puzzle=puzzle).save()
+            self.puzzles.append(puzzle.pk)
+        self.seq = 0
+        self.committed = {}  # seq -> (kind, commit time)
+
+    def teardown(self):
+        models.Puzzle.objects.filter(pk__in=[self.meta.pk, *self.puzzles]).delete()
+        self.round.delete()
+        for session_key in self.sessions:
+            self.session_store(session_key).delete()
+        User.objects.filter(pk__in=self.created_users).delete()
+
+    def token(self):
+        self.seq += 1
+        return self.seq, f"loadtest:{self.seq}"
+
+    def edit(self):
+        seq, token = self.token()
+        puzzle = models.Puzzle.objects.get(pk=self.random.choice(self.puzzles))
+        puzzle.notes = token
+        puzzle.save(update_fields=["notes"])
+        self.committed[seq] = ("edit", time.time())
+
+    def change_relation(self):
+        seq, token = self.token()
+        feeder_id = self.random.choice(self.puzzles)
+        with transaction.atomic():
+            relation = models.MetaFeeder.objects.filter(
+                meta_id=self.meta.pk, feeder_id=feeder_id
+            ).first()
+            if relation is None:
+                models.MetaFeeder(meta_id=self.meta.pk, feeder_id=feeder_id).save()
+            else:
+                relation.delete()
+            models.Puzzle.objects.filter(pk=feeder_id).update(notes=token)
+            changes.mark_changed(models.Puzzle, [feeder_id])
+        self.committed[seq] = ("relation", time.time())
+
+    async def master_stats(self):
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.send(
+            MASTER_CHANNEL_NAME, {"type": "server.stats", "channel": channel}
+        )
+        return await asyncio.wait_for(channel_layer.receive(channel), timeout=10)
+
+    async def run(self, options):
+        before = await self.master_stats()
+        received = [{} for _ in self.sessions]  # seq -> receipt time
+        received_bytes = [0] * len(self.sessions)
+        sockets = []
+
+        async def client(i, session):
+            cookie = f"{settings.SESSION_COOKIE_NAME}={self.sessions[i]}"
+            async with session.ws_connect(
+                options["url"], headers={"Cookie": cookie}, max_msg_size=0
+            ) as ws:
+                sockets.append(ws)
+                activity = asyncio.create_task(send_activity(i, ws))
+                async for message in ws:
+                    now = time.time()
+                    data = message.data
+                    received_bytes[i] += len(data)
+                    if isinstance(data, bytes):
+                        data = data.decode(errors="replace")
+                    for match in TOKEN_PATTERN.finditer(data):
+                        received[i].setdefault(int(match.group(1)), now)
+                activity.cancel()
+
+        async def send_activity(tab, ws):
+            if options["activity"] <= 0:
+                return
+            # the consumer ignores messages until it has sent data
+            await asyncio.sleep(2)
+            while True:
+                await ws.send_json(
+                    {
+                        "activity": {
+                            "tab": tab,
+                            "puzzle": self.random.choice(self.puzzles),
+                        }
+                    }
+                )
+                await asyncio.sleep(self.random.expovariate(options["activity"]))
+
+        async def drive(rate, action):
+            if rate <= 0:
+                return
+            action = sync_to_async(action)
+            start = time.monotonic()
+            count = 0
+            while True:
+                await action()
+                count += 1
+                delay = start + count / rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+        async with aiohttp.ClientSession() as session:
+            clients = [
+                asyncio.create_task(client(i, session))
+                for i in range(len(self.sessions))
+            ]
+            # let clients connect and fetch
+            await asyncio.sleep(2)
+            start = time.monotonic()
+            drivers = [
+                asyncio.create_task(drive(options["edits"], self.edit)),
+                asyncio.create_task(drive(options["relations"], self.change_relation)),
+            ]
+            await asyncio.sleep(options["duration"])
+            for driver in drivers:
+                driver.cancel()
+            elapsed = time.monotonic() - start
+            # wait for the last broadcasts
+            await asyncio.sleep(2)
+            for ws in sockets:
+                await ws.close()
+            await asyncio.gather(*drivers, *clients, return_exceptions=True)
+        after = await self.master_stats()
+        self.report(elapsed, received, received_bytes, before, after)
+
+    def report(self, elapsed, received, received_bytes, before, after):
+        latencies = defaultdict(list)
+        missing = defaultdict(int)
+        for seq, (kind, committed) in self.committed.items():
+            for client_received in received:
+                if seq in client_received:
+                    latencies[kind].append(client_received[seq] - committed)
+                else:
+                    missing[kind] += 1
+        self.stdout.write(
+            f"{len(received)} clients, {len(self.committed)} changes"
+            f" in {elapsed:.1f}s"
+        )
+        for kind in ("edit", "relation"):
+            values = latencies[kind]
+            if len(values) < 2:
+                continue
+            percentiles = statistics.quantiles(values, n=100)
+            self.stdout.write(
+                f"{kind}: {len(values)} receipts ({missing[kind]} missing),"
+                f" p50 {1000 * percentiles[49]:.0f}ms,"
+                f" p95 {1000 * percentiles[94]:.0f}ms,"
+                f" p99 {1000 * percentiles[98]:.0f}ms"
+            )
+        self.stdout.write(
+            f"bytes per client: mean {statistics.mean(received_bytes):.0f},"
+            f" max {max(received_bytes)}"
+        )
+        broadcasts = after["stats"].get("broadcasts", 0) - before["stats"].get(
+            "broadcasts", 0
+        )
+        self.stdout.write(
+            f"master: {after['cpu_time'] - before['cpu_time']:.2f}s CPU,"
+            f" {after['version'] - before['version']} versions,"
+            f" {broadcasts} broadcasts"
+        )
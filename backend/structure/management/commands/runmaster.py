@@ -0,0 +1,61 @@
+import asyncio
+import logging
+import threading
+import time
+
+from channels.layers import get_channel_layer
+from channels.routing import get_default_application
+from channels.worker import Worker
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from structure.changes import MASTER_CHANNEL_NAME
+from structure.leader import LeaderLease
+
+logger = logging.getLogger(__name__)
+
+
+class MasterWorker(Worker):
+    """A worker that returns from `run` once `stopped` is set."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stopped = threading.Event()
+
+    async def handle(self):
+        listeners = asyncio.ensure_future(super().handle())
+        while not self.stopped.is_set():
+            done, _ = await asyncio.wait(
+                [listeners], timeout=settings.MASTER_STANDBY_POLL_INTERVAL
+            )
+            if done:
+                return listeners.result()
+        listeners.cancel()
+        # the state of the master consumer belongs to the new leader now
+        for scope_id in list(self.application_instances):
+            self.delete_application_instance(scope_id)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the broadcast master. Multiple instances may run at once; all but"
+        " the elected leader stand by to take over."
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            lease = LeaderLease()
+            while not lease.acquire():
+                time.sleep(settings.MASTER_STANDBY_POLL_INTERVAL)
+            logger.info("Elected channels master leader")
+            worker = MasterWorker(
+                application=get_default_application(),
+                channels=[MASTER_CHANNEL_NAME],
+                channel_layer=get_channel_layer(),
+            )
+            # stop consuming so the new leader is the only one broadcasting
+            lease.keep_alive(on_lost=worker.stopped.set)
+            worker.run()
+            if not lease.lost.is_set():
+                return
+            logger.warning("Lost channels master lease, standing by")
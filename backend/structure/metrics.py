@@ -0,0 +1,184 @@
+"""
+Metrics shared by the web, websocket and master processes.
+
+Each process accumulates counter increments, histogram observations and gauge
+values and a background thread writes them to a Redis hash every
+METRICS_FLUSH_INTERVAL, so recording a metric never waits for Redis. The hash fields are Prometheus series
+(eg `checkmate_broadcasts_total`), so `/metrics` only needs to list them.
+
+Gauges of a single process (eg its websocket clients) are labelled with the
+process and expire unless the process keeps flushing them, so the series of
+stopped processes disappear.
+"""
+
+from collections import Counter
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+from django.conf import settings
+
+from services.redis_manager import RedisManager
+
+logger = logging.getLogger(__name__)
+
+KEY = "metrics"
+EXPIRY_KEY = "metrics-expiry"
+PROCESS = f"{socket.gethostname()}:{os.getpid()}"
+PROCESS_GAUGE_TTL = 10  # flush intervals
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# name -> (type, help)
+METRICS = {
+    "checkmate_broadcast_stage_seconds": (
+        "histogram",
+        "Time from the commit of a change until each stage of its broadcast.",
+    ),
+    "checkmate_broadcasts_total": ("counter", "Versions broadcast by the master."),
+    "checkmate_version": ("gauge", "Current broadcast version."),
+    "checkmate_snapshot_bytes": ("gauge", "Size of the encoded snapshot."),
+    "checkmate_websocket_clients": (
+        "gauge",
+        "Connected websocket clients by process.",
+    ),
+    "checkmate_master_events_total": ("counter", "Master counters by event."),
+    "checkmate_page_data_total": (
+        "counter",
+        "Page loads by where the embedded data came from.",
+    ),
+    "checkmate_page_render_seconds": ("histogram", "Render time of app pages."),
+}
+
+_lock = threading.Lock()
+_counts = Counter()
+_sums = Counter()
+_gauges = {}  # series -> value, of this process
+_shared_gauges = {}  # series -> value, set since the last flush
+_flusher = None
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    rendered = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    return f"{name}{{{rendered}}}"
+
+
+def increment(name, value=1, **labels):
+    with _lock:
+        _counts[_series(name, labels)] += value
+    _start_flusher()
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """Add `value` to the histogram `name`."""
+    with _lock:
+        for bucket in buckets:
+            if value <= bucket:
+                _counts[_series(f"{name}_bucket", {**labels, "le": bucket})] += 1
+        _counts[_series(f"{name}_bucket", {**labels, "le": "+Inf"})] += 1
+        _counts[_series(f"{name}_count", labels)] += 1
+        _sums[_series(f"{name}_sum", labels)] += value
+    _start_flusher()
+
+
+def set_gauge(name, value, **labels):
+    """Set the gauge `name`. The last value set before a flush is written."""
+    with _lock:
+        _shared_gauges[_series(name, labels)] = value
+    _start_flusher()
+
+
+def set_process_gauge(name, value, **labels):
+    """Set the gauge `name` of this process, which is flushed with the rest."""
+    with _lock:
+        _gauges[_series(name, {**labels, "process": PROCESS})] = value
+    _start_flusher()
+
+
+def _start_flusher():
+    global _flusher
+    if _flusher is not None or settings.METRICS_FLUSH_INTERVAL is None:
+        return
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(
+                target=_flush_periodically, name="metrics-flush", daemon=True
+            )
+            _flusher.start()
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(settings.METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception:
+            logger.exception("Failed to flush metrics")
+
+
+def flush():
+    with _lock:
+        counts = dict(_counts)
+        sums = dict(_sums)
+        gauges = dict(_gauges)
+        shared_gauges = dict(_shared_gauges)
+        _counts.clear()
+        _sums.clear()
+        _shared_gauges.clear()
+    if counts or sums or gauges or shared_gauges:
+        pipeline = RedisManager.instance().pipeline(transaction=False)
+        for field, value in counts.items():
+            pipeline.hincrby(KEY, field, value)
+        for field, value in sums.items():
+            pipeline.hincrbyfloat(KEY, field, value)
+        if shared_gauges:
+            pipeline.hset(KEY, mapping=shared_gauges)
+        if gauges:
+            pipeline.hset(KEY, mapping=gauges)
+            expiry = time.time() + PROCESS_GAUGE_TTL * (
+                settings.METRICS_FLUSH_INTERVAL or 1
+            )
+            pipeline.zadd(EXPIRY_KEY, {field: expiry for field in gauges})
+        pipeline.execute()
+
+
+def _sort_key(field):
+    # histogram buckets in increasing order
+    name, _, labels = field.partition("{")
+    le = re.search(r'le="([^"]*)"', labels)
+    if le is None:
+        return (name, labels, 0)
+    return (name, labels.replace(le.group(0), ""), float(le.group(1)))
+
+
+def render():
+    """All metrics in the Prometheus text format."""
+    redis = RedisManager.instance()
+    # drop the gauges of processes that stopped
+    expired = redis.zrangebyscore(EXPIRY_KEY, "-inf", time.time())
+    pipeline = redis.pipeline()
+    if expired:
+        pipeline.zrem(EXPIRY_KEY, *expired)
+        pipeline.hdel(KEY, *expired)
+    pipeline.hgetall(KEY)
+    series = {
+        field.decode(): value.decode()
+        for field, value in pipeline.execute()[-1].items()
+    }
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for field in sorted(series, key=_sort_key):
+            base = field.split("{", 1)[0]
+            if base == name or (
+                kind == "histogram"
+                and base in (f"{name}_bucket", f"{name}_count", f"{name}_sum")
+            ):
+                lines.append(f"{field} {series[field]}")
+    return "\n".join(lines) + "\n"
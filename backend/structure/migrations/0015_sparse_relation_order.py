@@ -0,0 +1,75 @@
+# Generated by Django 5.2.9 on 2026-10-18 05:29
+
+from django.db import migrations, models
+from django.db.models import F
+
+ORDER_GAP = 1 << 16
+
+
+def spread_orders(apps, schema_editor):
+    for model_name in ("RoundPuzzle", "MetaFeeder"):
+        model = apps.get_model("structure", model_name)
+        model.objects.update(order=F("order") * ORDER_GAP)
+
+
+def compact_orders(apps, schema_editor):
+    for model_name, container in (("RoundPuzzle", "round"), ("MetaFeeder", "meta")):
+        model = apps.get_model("structure", model_name)
+        relations = list(model.objects.order_by(container, "order", "id"))
+        positions = {}
+        for relation in relations:
+            container_id = getattr(relation, f"{container}_id")
+            relation.order = positions.get(container_id, 0)
+            positions[container_id] = relation.order + 1
+        model.objects.bulk_update(relations, ["order"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("structure", "0014_huntconfig_create_voice_channels_by_default"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="metafeeder",
+            options={"get_latest_by": "created", "ordering": ["order", "id"]},
+        ),
+        migrations.AlterModelOptions(
+            name="roundpuzzle",
+            options={"get_latest_by": "created", "ordering": ["order", "id"]},
+        ),
+        migrations.RemoveConstraint(
+            model_name="metafeeder",
+            name="unique_feeder_order",
+        ),
+        migrations.RemoveConstraint(
+            model_name="roundpuzzle",
+            name="unique_puzzle_order",
+        ),
+        migrations.AlterField(
+            model_name="metafeeder",
+            name="order",
+            field=models.BigIntegerField(
+                blank=True,
+                help_text="Sort key of puzzles. Keys are sparse and may tie (then the earlier relation is first). Will default to last.",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="roundpuzzle",
+            name="order",
+            field=models.BigIntegerField(
+                blank=True,
+                help_text="Sort key of puzzles. Keys are sparse and may tie (then the earlier relation is first). Will default to last.",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="metafeeder",
+            index=models.Index(fields=["meta", "order"], name="feeder_order"),
+        ),
+        migrations.AddIndex(
+            model_name="roundpuzzle",
+            index=models.Index(fields=["round", "order"], name="puzzle_order"),
+        ),
+        migrations.RunPython(spread_orders, compact_orders),
+    ]
@@ -0,0 +1,122 @@
+# Generated by Django 5.2.9 on 2026-10-18 05:30
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("checkmate", "0002_trigram_extension"),
+        ("structure", "0015_sparse_relation_order"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="puzzle",
+            name="search_vector",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.contrib.postgres.search.CombinedSearchVector(
+                    django.contrib.postgres.search.CombinedSearchVector(
+                        django.contrib.postgres.search.CombinedSearchVector(
+                            django.contrib.postgres.search.SearchVector(
+                                "name", config="english", weight="A"
+                            ),
+                            "||",
+                            django.contrib.postgres.search.SearchVector(
+                                "answer", config="english", weight="A"
+                            ),
+                            django.contrib.postgres.search.SearchConfig("english"),
+                        ),
+                        "||",
+                        django.contrib.postgres.search.SearchVector(
+                            "tags", config="english", weight="B"
+                        ),
+                        django.contrib.postgres.search.SearchConfig("english"),
+                    ),
+                    "||",
+                    django.contrib.postgres.search.SearchVector(
+                        "notes", config="english", weight="C"
+                    ),
+                    django.contrib.postgres.search.SearchConfig("english"),
+                ),
+                output_field=django.contrib.postgres.search.SearchVectorField(),
+            ),
+        ),
+        migrations.AddField(
+            model_name="round",
+            name="search_vector",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.contrib.postgres.search.CombinedSearchVector(
+                    django.contrib.postgres.search.CombinedSearchVector(
+                        django.contrib.postgres.search.SearchVector(
+                            "name", config="english", weight="A"
+                        ),
+                        "||",
+                        django.contrib.postgres.search.SearchVector(
+                            "tags", config="english", weight="B"
+                        ),
+                        django.contrib.postgres.search.SearchConfig("english"),
+                    ),
+                    "||",
+                    django.contrib.postgres.search.SearchVector(
+                        "notes", config="english", weight="C"
+                    ),
+                    django.contrib.postgres.search.SearchConfig("english"),
+                ),
+                output_field=django.contrib.postgres.search.SearchVectorField(),
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="puzzle",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="puzzle_search"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="puzzle",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass("name", name="gin_trgm_ops"),
+                name="puzzle_name_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="puzzle",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass("answer", name="gin_trgm_ops"),
+                name="puzzle_answer_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="puzzle",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass("notes", name="gin_trgm_ops"),
+                name="puzzle_notes_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="round",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="round_search"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="round",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass("name", name="gin_trgm_ops"),
+                name="round_name_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="round",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass("notes", name="gin_trgm_ops"),
+                name="round_notes_trgm",
+            ),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.9 on 2026-10-18 05:32
+
+import django.contrib.postgres.indexes
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("structure", "0016_search"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="puzzle",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["tags"], name="puzzle_tags_gin"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="round",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["tags"], name="round_tags_gin"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="round",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["round_tags"], name="round_round_tags_gin"
+            ),
+        ),
+    ]
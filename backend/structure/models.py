@@ -1,9 +1,12 @@
 from collections import defaultdict
+import copy
 import logging
 
 from django import forms
 from django.conf import settings
 from django.contrib.postgres import fields
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.db import models, transaction
 from django import dispatch
@@ -14,12 +17,14 @@ import autoslug
 import crum
 
 from services.celery import app
-from services.redis_manager import RedisManager
 
 logger = logging.getLogger(__name__)
 
 MAX_LENGTH = 500
 
+# text search configuration for `search_vector`
+SEARCH_CONFIG = "english"
+
 
 def CharField(*args, **kwargs):
     if kwargs.get("blank") and kwargs.get("default") is None:
@@ -27,6 +32,45 @@ def CharField(*args, **kwargs):
     return models.CharField(*args, max_length=MAX_LENGTH, **kwargs)
 
 
+def SearchVectorGeneratedField(**weighted_fields):
+    """
+    A tsvector of the fields (keyword) with their weights (value), kept up to
+    date by the database.
+    """
+    vectors = [
+        SearchVector(field, weight=weight, config=SEARCH_CONFIG)
+        for field, weight in weighted_fields.items()
+    ]
+    expression = vectors[0]
+    for vector in vectors[1:]:
+        expression = expression + vector
+    return models.GeneratedField(
+        expression=expression,
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+
+class SearchableManager(models.Manager):
+    """Leaves out `search_vector`, which is only needed in queries."""
+
+    def get_queryset(self):
+        return super().get_queryset().defer("search_vector")
+
+
+def search_indexes(model_name, *trigram_fields):
+    """Indexes for full text search and trigram matches of `trigram_fields`."""
+    return [
+        GinIndex(fields=["search_vector"], name=f"{model_name}_search"),
+        *(
+            GinIndex(
+                OpClass(field, name="gin_trgm_ops"), name=f"{model_name}_{field}_trgm"
+            )
+            for field in trigram_fields
+        ),
+    ]
+
+
 class SingletonModel(models.Model):
     POPULATE_DEFAULTS = True
 
@@ -202,6 +246,18 @@ class Entity(models.Model):
         get_latest_by = "created"
         ordering = ("created",)
 
+    # fields compared by `edits.discard_saved` to know what a save changes
+    TRACKED_FIELDS = ("notes", "tags")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # deferred fields are not loaded
+        self.original_values = {
+            field: copy.copy(self.__dict__[field])
+            for field in self.TRACKED_FIELDS
+            if field in self.__dict__
+        }
+
     def save(self, *args, **kwargs):
         user = crum.get_current_user()
         if user and user.pk is None:
@@ -219,12 +275,6 @@ class Entity(models.Model):
     def __str__(self):
         return self.name
 
-    @classmethod
-    def get_lock(cls, slug, blocking_timeout=5):
-        return RedisManager.instance().reentrant_lock(
-            f"lock-order-{cls.__name__}-{slug}", blocking_timeout=blocking_timeout
-        )
-
 
 class Round(Entity):
     puzzles = models.ManyToManyField(
@@ -241,6 +291,16 @@ class Round(Entity):
         blank=True,
         help_text="Tag categories that should be displayed / set for each puzzle in the round.",
     )
+    search_vector = SearchVectorGeneratedField(name="A", tags="B", notes="C")
+
+    objects = SearchableManager()
+
+    class Meta(Entity.Meta):
+        indexes = [
+            *search_indexes("round", "name", "notes"),
+            GinIndex(fields=["tags"], name="round_tags_gin"),
+            GinIndex(fields=["round_tags"], name="round_round_tags_gin"),
+        ]
 
 
 class LockedPuzzle(Entity):
@@ -269,6 +329,17 @@ class Puzzle(Entity):
         default=False,
         help_text="Used as a placeholder for information before the puzzle is released.",
     )
+    search_vector = SearchVectorGeneratedField(
+        name="A", answer="A", tags="B", notes="C"
+    )
+
+    objects = SearchableManager()
+
+    class Meta(Entity.Meta):
+        indexes = [
+            *search_indexes("puzzle", "name", "answer", "notes"),
+            GinIndex(fields=["tags"], name="puzzle_tags_gin"),
+        ]
 
     # should match statuses in `colors.tsx` in the frontend
     SOLVED_STATUSES = set(["solved", "backsolved", "bought"])
@@ -299,13 +370,24 @@ class Puzzle(Entity):
     def is_new(self):
         return self.status == self.NEW_STATUS
 
-    def save(self, *args, **kwargs):
-        feeder_ids = set(self.feeders.through.objects.filter(meta_id=self.pk))
+    def became_solved(self):
+        return not self.original_is_solved and self.is_solved()
+
+    def became_unsolved(self):
+        return (
+            self.original_is_solved and not self.is_solved() and self.solved is not None
+        )
+
+    def set_auto_fields(self, has_feeders):
+        """
+        Update the fields that follow from the others before saving. Returns
+        the names of the fields that were set.
+        """
         auto_fields = []
-        if feeder_ids:
+        if has_feeders:
             self.is_meta = True
             auto_fields.append("is_meta")
-        if self.solved is None and not self.original_is_solved and self.is_solved():
+        if self.solved is None and self.became_solved():
             self.solved = timezone.now()
             auto_fields.append("solved")
         if self.solved != self.original_solved:
@@ -314,29 +396,68 @@ class Puzzle(Entity):
             else:
                 self.solved_by = crum.get_current_user()
             auto_fields.append("solved_by")
-        if "update_fields" in kwargs:
-            kwargs["update_fields"] = list({*kwargs["update_fields"], *auto_fields})
+        return auto_fields
+
+    def add_round_feeders(self, feeder_ids):
+        """Add the puzzles of auto assigned rounds to a new meta."""
+        for _round in self.rounds.all().prefetch_related("puzzle_relations"):
+            if _round.auto_assign_puzzles_to_meta:
+                for relation in _round.puzzle_relations.all():
+                    puzzle_id = relation.puzzle_id
+                    if puzzle_id not in feeder_ids and puzzle_id != self.pk:
+                        self.feeders.through(
+                            meta_id=self.pk, feeder_id=puzzle_id
+                        ).save()
+                        feeder_ids.add(puzzle_id)
+
+    @classmethod
+    def save_all(cls, puzzles, save):
+        """
+        Save `puzzles` with the side effects of saving a puzzle: the fields that
+        follow from the others are set, new metas get the puzzles of their auto
+        assigned rounds as feeders, and solved or unsolved puzzles are cleaned
+        up once the transaction commits. `save(auto_fields)` writes the puzzles,
+        given the names of the fields that were set.
+        """
+        metas = set(
+            cls.feeders.through.objects.filter(
+                meta_id__in=[puzzle.pk for puzzle in puzzles]
+            ).values_list("meta_id", flat=True)
+        )
+        auto_fields = set()
+        for puzzle in puzzles:
+            auto_fields.update(puzzle.set_auto_fields(puzzle.pk in metas))
         with transaction.atomic():
-            super().save(*args, **kwargs)
-            if self.is_meta and not self.original_is_meta:
-                # add feeders from rounds
-                for _round in self.rounds.all().prefetch_related("puzzle_relations"):
-                    if _round.auto_assign_puzzles_to_meta:
-                        for relation in _round.puzzle_relations.all():
-                            puzzle_id = relation.puzzle_id
-                            if puzzle_id not in feeder_ids and puzzle_id != self.pk:
-                                self.feeders.through(
-                                    meta_id=self.pk, feeder_id=puzzle_id
-                                ).save()
-                                feeder_ids.add(puzzle_id)
-        if not self.original_is_solved and self.is_solved():
-            # cleanup
-            app.send_task("services.tasks.post_solve_puzzle", args=[self.pk])
-        if self.original_is_solved and not self.is_solved() and self.solved is not None:
-            # unsolve
-            app.send_task(
-                "services.tasks.unsolve_puzzle", args=[self.pk], countdown=60.0
-            )
+            save(auto_fields)
+            for puzzle in puzzles:
+                if puzzle.is_meta and not puzzle.original_is_meta:
+                    puzzle.add_round_feeders(
+                        set(puzzle.feeder_relations.values_list("feeder_id", flat=True))
+                    )
+            solved = [puzzle.pk for puzzle in puzzles if puzzle.became_solved()]
+            unsolved = [puzzle.pk for puzzle in puzzles if puzzle.became_unsolved()]
+            if solved:
+                transaction.on_commit(
+                    lambda: app.send_task(
+                        "services.tasks.post_solve_puzzles", args=[solved]
+                    )
+                )
+            if unsolved:
+                transaction.on_commit(
+                    lambda: app.send_task(
+                        "services.tasks.unsolve_puzzles",
+                        args=[unsolved],
+                        countdown=60.0,
+                    )
+                )
+
+    def save(self, *args, **kwargs):
+        def save(auto_fields):
+            if "update_fields" in kwargs:
+                kwargs["update_fields"] = list({*kwargs["update_fields"], *auto_fields})
+            super(Puzzle, self).save(*args, **kwargs)
+
+        Puzzle.save_all([self], save)
 
     @property
     def long_name(self):
@@ -351,13 +472,18 @@ class Puzzle(Entity):
 
 class BasePuzzleRelation(models.Model):
     created = models.DateTimeField(auto_now_add=True, db_index=True)
-    order = models.PositiveSmallIntegerField(
-        blank=True, help_text="Order of puzzles (0-indexed). Will default to last."
+    order = models.BigIntegerField(
+        blank=True,
+        help_text="Sort key of puzzles. Keys are sparse and may tie (then the"
+        " earlier relation is first). Will default to last.",
     )
 
+    # space between keys when appending or rebalancing
+    ORDER_GAP = 1 << 16
+
     class Meta:
         abstract = True
-        ordering = ["order"]
+        ordering = ["order", "id"]
         get_latest_by = "created"
         required_db_features = {
             "supports_deferrable_unique_constraints",
@@ -388,30 +514,20 @@ class BasePuzzleRelation(models.Model):
         )
 
     def next_order(self):
-        try:
-            return self.objects_in_container().latest("order").order + 1
-        except models.ObjectDoesNotExist:
-            return 0
-
-    def get_container_lock(self):
-        container_cls = self._meta.get_field(self.CONTAINER).related_model
-        return container_cls.get_lock(getattr(self, f"{self.CONTAINER}_id"))
+        last_order = self.objects_in_container().aggregate(models.Max("order"))[
+            "order__max"
+        ]
+        return 0 if last_order is None else last_order + self.ORDER_GAP
 
     def save(self, *args, **kwargs):
-        with self.get_container_lock():
-            with transaction.atomic():
-                if self.order is None:
-                    self.order = self.next_order()
-                super().save(*args, **kwargs)
+        # concurrent appends may get the same key, which is fine
+        if self.order is None:
+            self.order = self.next_order()
+        super().save(*args, **kwargs)
         self.touch_related()
 
     def delete(self, *args, **kwargs):
-        with self.get_container_lock():
-            with transaction.atomic():
-                super().delete(*args, **kwargs)
-                self.objects_in_container().filter(order__gt=self.order).update(
-                    order=models.F("order") - 1
-                )
+        super().delete(*args, **kwargs)
         self.touch_related(deleted=True)
 
     def touch_related(self, deleted=False):
@@ -449,53 +565,44 @@ class RoundPuzzle(BasePuzzleRelation):
                 name="unique_puzzle",
                 deferrable=models.Deferrable.DEFERRED,
             ),
-            models.UniqueConstraint(
-                fields=["round", "order"],
-                name="unique_puzzle_order",
-                deferrable=models.Deferrable.DEFERRED,
-            ),
         ]
+        indexes = [models.Index(fields=["round", "order"], name="puzzle_order")]
 
     def save(self, *args, **kwargs):
-        with self.get_container_lock():
-            with transaction.atomic():
-                adding = self._state.adding
-                super().save(*args, **kwargs)
-                if adding:
-                    if self.round.auto_assign_puzzles_to_meta:
-                        if self.puzzle.is_meta:
-                            feeder_ids = set(
-                                self.puzzle.feeder_relations.filter(
-                                    meta_id=self.puzzle_id
-                                )
-                            )
-                            for relation in self.round.puzzle_relations.all():
-                                puzzle_id = relation.puzzle_id
-                                if (
-                                    puzzle_id not in feeder_ids
-                                    and puzzle_id != self.puzzle_id
-                                ):
-                                    MetaFeeder(
-                                        meta_id=self.puzzle_id, feeder_id=puzzle_id
-                                    ).save()
-                                    feeder_ids.add(puzzle_id)
-                        metas = list(
-                            self.round.puzzles.all()
-                            .filter(is_meta=True)
-                            .prefetch_related("feeder_relations")
+        with transaction.atomic():
+            adding = self._state.adding
+            super().save(*args, **kwargs)
+            if adding:
+                if self.round.auto_assign_puzzles_to_meta:
+                    if self.puzzle.is_meta:
+                        feeder_ids = set(
+                            self.puzzle.feeder_relations.filter(meta_id=self.puzzle_id)
                         )
-                        for meta in metas:
-                            feeder_ids = set(
-                                relation.feeder_id
-                                for relation in meta.feeder_relations.all()
-                            )
+                        for relation in self.round.puzzle_relations.all():
+                            puzzle_id = relation.puzzle_id
                             if (
-                                self.puzzle_id not in feeder_ids
-                                and self.puzzle_id != meta.pk
+                                puzzle_id not in feeder_ids
+                                and puzzle_id != self.puzzle_id
                             ):
                                 MetaFeeder(
-                                    meta_id=meta.pk, feeder_id=self.puzzle_id
+                                    meta_id=self.puzzle_id, feeder_id=puzzle_id
                                 ).save()
+                                feeder_ids.add(puzzle_id)
+                    metas = list(
+                        self.round.puzzles.all()
+                        .filter(is_meta=True)
+                        .prefetch_related("feeder_relations")
+                    )
+                    for meta in metas:
+                        feeder_ids = set(
+                            relation.feeder_id
+                            for relation in meta.feeder_relations.all()
+                        )
+                        if (
+                            self.puzzle_id not in feeder_ids
+                            and self.puzzle_id != meta.pk
+                        ):
+                            MetaFeeder(meta_id=meta.pk, feeder_id=self.puzzle_id).save()
 
 
 class MetaFeeder(BasePuzzleRelation):
@@ -518,12 +625,8 @@ class MetaFeeder(BasePuzzleRelation):
                 name="unique_feeder",
                 deferrable=models.Deferrable.DEFERRED,
             ),
-            models.UniqueConstraint(
-                fields=["meta", "order"],
-                name="unique_feeder_order",
-                deferrable=models.Deferrable.DEFERRED,
-            ),
         ]
+        indexes = [models.Index(fields=["meta", "order"], name="feeder_order")]
 
     def clean(self, *args, **kwargs):
         if self.meta_id == self.feeder_id:
@@ -0,0 +1,43 @@
+import time
+
+from services.redis_manager import RedisManager
+from . import encoding
+
+
+class PresenceStore:
+    """
+    Latest activity per (uid, tab) in Redis, readable from any process.
+
+    Activities are stored in a hash keyed by "uid:tab" alongside a sorted set
+    of expiry times, so reads and pruning cost O(active tabs).
+    """
+
+    ACTIVITIES_KEY = "presence-activities"
+    EXPIRY_KEY = "presence-expiry"
+
+    def __init__(self, ttl):
+        self.redis = RedisManager.instance()
+        self.ttl = ttl
+
+    @staticmethod
+    def field(activity):
+        return f"{activity['uid']}:{activity['tab']}"
+
+    def update(self, activity):
+        field = self.field(activity)
+        pipeline = self.redis.pipeline()
+        pipeline.hset(self.ACTIVITIES_KEY, field, encoding.dumps(activity))
+        pipeline.zadd(self.EXPIRY_KEY, {field: time.time() + self.ttl})
+        pipeline.execute()
+
+    def current(self):
+        """Return the list of unexpired activities."""
+        now = time.time()
+        expired = self.redis.zrangebyscore(self.EXPIRY_KEY, "-inf", now)
+        pipeline = self.redis.pipeline()
+        if expired:
+            pipeline.zrem(self.EXPIRY_KEY, *expired)
+            pipeline.hdel(self.ACTIVITIES_KEY, *expired)
+        pipeline.hvals(self.ACTIVITIES_KEY)
+        activities = pipeline.execute()[-1]
+        return [encoding.loads(activity) for activity in activities]
@@ -0,0 +1,284 @@
+"""
+Bulk changes to puzzle relations (RoundPuzzle and MetaFeeder).
+
+Saving or deleting a relation finds the next order, re-saves both related
+objects and, for a RoundPuzzle in a round that assigns its puzzles to metas,
+saves a MetaFeeder for each derived edge. These functions have the same effect
+for many relations with a fixed number of queries: orders are allocated in one
+pass, rows are written with `bulk_create`, derived edges are computed in memory
+and the related rows are touched with one UPDATE per model.
+
+Orders are sparse sort keys: clients only see positions (the order of the
+lists in the snapshot). Appending takes the last key plus ORDER_GAP and moving
+takes a key between the new neighbours, so inserts, moves and deletes write a
+single relation and need no lock. When the keys between two neighbours run
+low, the container is rebalanced in the background.
+"""
+
+from collections import defaultdict
+import crum
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from services.celery import app
+from . import changes
+from . import models
+
+
+def _field_ids(cls):
+    return f"{cls.CONTAINER}_id", f"{cls.ITEM}_id"
+
+
+def _related_model(cls, key):
+    return cls._meta.get_field(key).related_model
+
+
+def _existing_pairs(cls, pairs):
+    container_key, item_key = _field_ids(cls)
+    return set(
+        cls.objects.filter(
+            **{
+                f"{container_key}__in": {container for container, _ in pairs},
+                f"{item_key}__in": {item for _, item in pairs},
+            }
+        ).values_list(container_key, item_key)
+    )
+
+
+def _next_orders(cls, container_ids):
+    container_key, _ = _field_ids(cls)
+    last_orders = (
+        cls.objects.filter(**{f"{container_key}__in": container_ids})
+        .values(container_key)
+        .annotate(last_order=Max("order"))
+    )
+    next_orders = {container_id: 0 for container_id in container_ids}
+    for row in last_orders:
+        next_orders[row[container_key]] = row["last_order"] + cls.ORDER_GAP
+    return next_orders
+
+
+def _derived_feeders(cls, new_relations, new_metas):
+    """
+    MetaFeeder pairs that saving `new_relations` one at a time would also have
+    created. Metas that get their first feeders are added to `new_metas`.
+    """
+    derived = []
+    if cls is models.RoundPuzzle:
+        round_ids = {relation.round_id for relation in new_relations}
+        auto_round_ids = set(
+            models.Round.objects.filter(
+                pk__in=round_ids, auto_assign_puzzles_to_meta=True
+            ).values_list("pk", flat=True)
+        )
+        if not auto_round_ids:
+            return derived
+        round_puzzles = defaultdict(list)
+        round_metas = defaultdict(list)
+        for round_id, puzzle_id, is_meta in models.RoundPuzzle.objects.filter(
+            round_id__in=auto_round_ids
+        ).values_list("round_id", "puzzle_id", "puzzle__is_meta"):
+            round_puzzles[round_id].append(puzzle_id)
+            if is_meta:
+                round_metas[round_id].append(puzzle_id)
+        for relation in new_relations:
+            if relation.round_id not in auto_round_ids:
+                continue
+            puzzle_id = relation.puzzle_id
+            if puzzle_id in round_metas[relation.round_id]:
+                derived.extend(
+                    (puzzle_id, feeder_id)
+                    for feeder_id in round_puzzles[relation.round_id]
+                )
+            derived.extend(
+                (meta_id, puzzle_id) for meta_id in round_metas[relation.round_id]
+            )
+    elif cls is models.MetaFeeder:
+        # Puzzle.save makes a puzzle with feeders a meta, which then gets the
+        # puzzles of its auto assigned rounds as feeders
+        meta_ids = {relation.meta_id for relation in new_relations}
+        metas = set(
+            models.Puzzle.objects.filter(pk__in=meta_ids, is_meta=False).values_list(
+                "pk", flat=True
+            )
+        )
+        new_metas.update(metas)
+        derived.extend(
+            models.RoundPuzzle.objects.filter(
+                round__puzzle_relations__puzzle_id__in=metas,
+                round__auto_assign_puzzles_to_meta=True,
+            )
+            .order_by("round__puzzle_relations__puzzle_id", "round_id", "order")
+            .values_list("round__puzzle_relations__puzzle_id", "puzzle_id")
+        )
+    return [
+        (meta_id, feeder_id) for meta_id, feeder_id in derived if meta_id != feeder_id
+    ]
+
+
+def _add(cls, pairs, touched, new_metas):
+    container_key, item_key = _field_ids(cls)
+    existing = _existing_pairs(cls, pairs)
+    new_pairs = []
+    for pair in pairs:
+        if pair not in existing:
+            existing.add(pair)
+            new_pairs.append(pair)
+    if not new_pairs:
+        return []
+    container_ids = {container_id for container_id, _ in new_pairs}
+    next_orders = _next_orders(cls, container_ids)
+    new_relations = []
+    for container_id, item_id in new_pairs:
+        new_relations.append(
+            cls(
+                **{
+                    container_key: container_id,
+                    item_key: item_id,
+                    "order": next_orders[container_id],
+                }
+            )
+        )
+        next_orders[container_id] += cls.ORDER_GAP
+    cls.objects.bulk_create(new_relations)
+    touched[_related_model(cls, cls.CONTAINER)].update(container_ids)
+    touched[_related_model(cls, cls.ITEM)].update(item for _, item in new_pairs)
+    derived = _derived_feeders(cls, new_relations, new_metas)
+    if derived:
+        new_relations.extend(_add(models.MetaFeeder, derived, touched, new_metas))
+    return new_relations
+
+
+def _touch(touched, new_metas=()):
+    """
+    Update modified timestamps as re-saving each object would, with one UPDATE
+    per model.
+    """
+    user = crum.get_current_user()
+    if user and user.pk is None:
+        user = None
+    now = timezone.now()
+    for model, keys in touched.items():
+        model.objects.filter(pk__in=keys).update(modified=now, modified_by=user)
+        changes.mark_changed(model, keys)
+    if new_metas:
+        models.Puzzle.objects.filter(pk__in=new_metas).update(is_meta=True)
+
+
+def add(cls, pairs):
+    """
+    Add relations of type `cls` for (container id, item id) `pairs` that do
+    not exist yet, at the end of their containers. Returns the new relations,
+    including derived MetaFeeders.
+    """
+    touched = defaultdict(set)
+    new_metas = set()
+    with transaction.atomic():
+        new_relations = _add(cls, list(pairs), touched, new_metas)
+        _touch(touched, new_metas)
+    return new_relations
+
+
+def remove(cls, pairs):
+    """
+    Remove the relations of type `cls` for (container id, item id) `pairs`.
+    Returns the number of relations removed.
+    """
+    container_key, item_key = _field_ids(cls)
+    pairs = set(pairs)
+    if not pairs:
+        return 0
+    touched = defaultdict(set)
+    with transaction.atomic():
+        removed = {
+            pk: (container_id, item_id)
+            for pk, container_id, item_id in cls.objects.filter(
+                **{
+                    f"{container_key}__in": {container for container, _ in pairs},
+                    f"{item_key}__in": {item for _, item in pairs},
+                }
+            ).values_list("pk", container_key, item_key)
+            if (container_id, item_id) in pairs
+        }
+        if not removed:
+            return 0
+        cls.objects.filter(pk__in=removed).delete()
+        touched[_related_model(cls, cls.CONTAINER)].update(
+            container for container, _ in removed.values()
+        )
+        touched[_related_model(cls, cls.ITEM)].update(
+            item for _, item in removed.values()
+        )
+        _touch(touched)
+    return len(removed)
+
+
+def _order_between(cls, before, after):
+    """A key between `before` and `after` (None for the ends), if any."""
+    if before is None and after is None:
+        return 0
+    if before is None:
+        return after - cls.ORDER_GAP
+    if after is None:
+        return before + cls.ORDER_GAP
+    if after - before < 2:
+        return None
+    return (before + after) // 2
+
+
+def move(relation, siblings, position):
+    """
+    Move `relation` to `position` among `siblings`, the relations of its
+    container in order (including `relation`). Only `relation` is written,
+    unless its new neighbours have no key between them.
+    """
+    cls = type(relation)
+    container_id = getattr(relation, f"{cls.CONTAINER}_id")
+    others = [sibling for sibling in siblings if sibling.pk != relation.pk]
+    before = others[position - 1].order if position > 0 else None
+    after = others[position].order if position < len(others) else None
+    order = _order_between(cls, before, after)
+    if order is None:
+        others = rebalance(cls, container_id, exclude=relation.pk)
+        before = others[position - 1].order if position > 0 else None
+        after = others[position].order if position < len(others) else None
+        order = _order_between(cls, before, after)
+    elif before is not None and after is not None:
+        if after - before < settings.RELATION_REBALANCE_GAP:
+            transaction.on_commit(
+                lambda: app.send_task(
+                    "services.tasks.rebalance_relations",
+                    args=[cls.__name__, container_id],
+                )
+            )
+    relation.order = order
+    relation.save(update_fields=["order"])
+
+
+def rebalance(cls, container_id, exclude=None):
+    """
+    Spread out the keys of the relations in a container, keeping their order
+    and the last key (so concurrent appends still go last). Positions do not
+    change, so clients are not notified. Returns the relations in order,
+    without the relation with primary key `exclude`.
+    """
+    container_key, _ = _field_ids(cls)
+    with transaction.atomic():
+        relations = list(
+            cls.objects.select_for_update()
+            .filter(**{container_key: container_id})
+            .exclude(pk=exclude)
+        )
+        if not relations:
+            return relations
+        last_order = relations[-1].order
+        rebalanced = []
+        for i, relation in enumerate(reversed(relations)):
+            order = last_order - i * cls.ORDER_GAP
+            if relation.order != order:
+                relation.order = order
+                rebalanced.append(relation)
+        cls.objects.bulk_update(rebalanced, ["order"])
+    return relations
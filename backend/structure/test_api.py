@@ -0,0 +1,254 @@
+from unittest import mock
+
+import crum
+from django import test
+from django.contrib.auth.models import User
+from rest_framework import exceptions
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from . import api
+from . import encoding
+from . import leader
+from . import models
+from .fakes import FakeRedis
+
+
+class ApiTestCase(test.SimpleTestCase):
+    def test_search_vector_not_in_snapshot(self):
+        self.assertNotIn("search_vector", api.BaseRoundSerializer().fields)
+        self.assertNotIn("search_vector", api.BasePuzzleSerializer().fields)
+
+    def test_search_highlight(self):
+        start, stop = api.SEARCH_START_SEL, api.SEARCH_STOP_SEL
+        self.assertEqual(
+            api.highlight(f"<img src=x onerror=alert(1)> {start}cat{stop} & dog"),
+            "&lt;img src=x onerror=alert(1)&gt; <mark>cat</mark> &amp; dog",
+        )
+        self.assertIsNone(api.highlight("<mark>cat</mark>"))
+
+    def test_tag_filter(self):
+        self.assertEqual(api.parse_tag("key"), ("key", None))
+        self.assertEqual(api.parse_tag("key:a:b"), ("key", "a:b"))
+        self.assertEqual(api.parse_tag("key:"), ("key", ""))
+        request = Request(
+            APIRequestFactory().get(
+                "/api/puzzles", {"tag": ["a", "b:c"], "tag_any": "d,e"}
+            )
+        )
+        queryset = api.TagFilter().filter_queryset(
+            request, models.Puzzle.objects.all(), None
+        )
+        sql, params = queryset.query.sql_with_params()
+        self.assertIn('"tags" ? ', sql)
+        self.assertIn('"tags" @> ', sql)
+        self.assertIn('"tags" ?| ', sql)
+        self.assertEqual(params[:2], ("a", {"b": "c"}))
+        with self.assertRaises(exceptions.NotAcceptable):
+            api.TagFilter().filter_queryset(
+                Request(APIRequestFactory().get("/api/puzzles", {"round_tag": "x"})),
+                models.Puzzle.objects.all(),
+                None,
+            )
+
+    def everything(self, redis, headers=None, **params):
+        request = APIRequestFactory().get("/api/everything", params, headers=headers)
+        force_authenticate(request, User(username="test"))
+        with mock.patch.object(leader.RedisManager, "instance", return_value=redis):
+            return api.everything(request)
+
+    def master_redis(self):
+        # a master at version 3 that checkpointed version 1 and saved deltas
+        # from version 1
+        redis = FakeRedis()
+        store = leader.MasterStateStore
+        redis.set(leader.LeaderLease.KEY, b"token")
+        redis.set(store.STATE_KEY, encoding.dumps({"version": 3}).encode())
+        redis.set(store.SNAPSHOT_VERSION_KEY, b"1")
+        redis.set(store.SNAPSHOT_KEY, b'{"puzzles": {}}')
+        for version in (2, 3):
+            update = encoding.dumps({"prev_version": version - 1, "version": version})
+            redis.rpush(
+                store.DELTAS_KEY, encoding.dumps([version - 1, version, update])
+            )
+        return redis
+
+    def test_everything(self):
+        redis = self.master_redis()
+        response = self.everything(redis)
+        self.assertEqual(response.content, b'{"puzzles": {}}')
+        self.assertEqual(response.headers["ETag"], '"1"')
+
+        # the latest version is known to be current
+        response = self.everything(redis, headers={"If-None-Match": '"3"'})
+        self.assertEqual(response.status_code, 304)
+        response = self.everything(redis, headers={"If-None-Match": '"1"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_everything_since(self):
+        redis = self.master_redis()
+        response = self.everything(redis, since=1)
+        self.assertEqual(
+            [update["version"] for update in encoding.loads(response.content)], [2, 3]
+        )
+        self.assertEqual(response.headers["ETag"], '"3"')
+        response = self.everything(redis, since=3)
+        self.assertEqual(encoding.loads(response.content), [])
+
+        # the deltas from version 0 are no longer saved
+        response = self.everything(redis, since=0)
+        self.assertEqual(
+            encoding.loads(response.content),
+            [
+                {
+                    "prev_version": None,
+                    "version": 1,
+                    "roots": True,
+                    "data": {"puzzles": {}},
+                }
+            ],
+        )
+        self.assertEqual(response.headers["ETag"], '"1"')
+
+        self.assertEqual(self.everything(redis, since="x").status_code, 400)
+
+    def test_page_snapshot(self):
+        self.addCleanup(setattr, api, "_page_snapshot", None)
+        redis = self.master_redis()
+        snapshot = '{"puzzles": {"a": {"notes": "</script>"}}}'
+        redis.set(leader.MasterStateStore.SNAPSHOT_KEY, snapshot.encode())
+        request = mock.Mock(user=User(id=5))
+
+        def load():
+            with mock.patch.object(leader.RedisManager, "instance", return_value=redis):
+                encoded, source = api.encoded_everything_with_uid(request)
+            self.assertNotIn("</script>", encoded)
+            return encoding.loads(encoded), source
+
+        page = {"uid": 5, "puzzles": {"a": {"notes": "</script>"}}}
+        self.assertEqual(load(), (page, "miss"))
+        # the checkpoint trails the saved versions and is kept until it moves
+        redis.set(
+            leader.MasterStateStore.STATE_KEY,
+            encoding.dumps({"version": 4}).encode(),
+        )
+        with mock.patch.object(
+            leader.MasterStateStore, "load_snapshot"
+        ) as load_snapshot:
+            self.assertEqual(load(), (page, "hit"))
+            self.assertEqual(load(), (page, "hit"))
+        load_snapshot.assert_not_called()
+        redis.set(leader.MasterStateStore.SNAPSHOT_VERSION_KEY, b"4")
+        self.assertEqual(load(), (page, "miss"))
+
+        redis.delete(leader.LeaderLease.KEY)
+        with mock.patch.object(
+            api, "data_everything_with_uid", return_value={"uid": 5}
+        ):
+            self.assertEqual(load(), ({"uid": 5}, "fallback"))
+
+    def test_everything_without_master(self):
+        redis = self.master_redis()
+        redis.delete(leader.LeaderLease.KEY)
+        with mock.patch.object(
+            api, "data_everything", return_value={"puzzles": {}}
+        ) as data_everything:
+            response = self.everything(redis, since=1)
+            self.assertEqual(
+                encoding.loads(response.content),
+                [
+                    {
+                        "prev_version": None,
+                        "version": None,
+                        "roots": True,
+                        "data": {"puzzles": {}},
+                    }
+                ],
+            )
+            self.assertNotIn("ETag", response.headers)
+
+            # nor before the first checkpoint
+            redis = self.master_redis()
+            redis.delete(leader.MasterStateStore.SNAPSHOT_KEY)
+            response = self.everything(redis)
+            self.assertEqual(encoding.loads(response.content), {"puzzles": {}})
+        self.assertEqual(data_everything.call_count, 2)
+
+
+class BulkUpdateTestCase(test.TestCase):
+    """`bulk_update_puzzles` has the side effects of `Puzzle.save`."""
+
+    def setUp(self):
+        self.user = User.objects.create(username="test")
+        self.client.force_login(self.user)
+        self.round = models.Round.objects.create(slug="r", name="R")
+        for slug in ("a", "b", "c", "d"):
+            puzzle = models.Puzzle.objects.create(slug=slug, name=slug.upper())
+            models.RoundPuzzle(round=self.round, puzzle=puzzle).save()
+
+    def save(self, slug, **fields):
+        puzzle = models.Puzzle.objects.get(pk=slug)
+        for field, value in fields.items():
+            setattr(puzzle, field, value)
+        with crum.impersonate(self.user):
+            puzzle.save()
+
+    def bulk_update(self, slug, **fields):
+        response = self.client.post(
+            "/api/puzzles/bulk_update",
+            {"puzzles": [{"slug": slug, **fields}]},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 204)
+
+    def side_effects(self, update, slug, **fields):
+        """The task sent and the saved puzzle after `update(slug, **fields)`."""
+        with mock.patch.object(models.app, "send_task") as send_task:
+            with self.captureOnCommitCallbacks(execute=True):
+                update(slug, **fields)
+        puzzle = models.Puzzle.objects.get(pk=slug)
+        feeders = set(puzzle.feeders.values_list("pk", flat=True))
+        return (
+            [(args, kwargs) for args, kwargs in send_task.call_args_list],
+            puzzle.status,
+            puzzle.solved is not None,
+            puzzle.solved_by,
+            puzzle.is_meta,
+            feeders,
+        )
+
+    def assertSameSideEffects(self, **fields):
+        saved = self.side_effects(self.save, "a", **fields)
+        updated = self.side_effects(self.bulk_update, "b", **fields)
+        # the tasks name the puzzle
+        self.assertEqual(
+            saved[0],
+            [(args, {**kwargs, "args": [["a"]]}) for args, kwargs in updated[0]],
+        )
+        self.assertEqual(saved[1:], updated[1:])
+        return saved
+
+    def test_solve_unsolve(self):
+        tasks, _, solved, solved_by, _, _ = self.assertSameSideEffects(status="solved")
+        self.assertEqual(
+            tasks, [(("services.tasks.post_solve_puzzles",), {"args": [["a"]]})]
+        )
+        self.assertTrue(solved)
+        self.assertEqual(solved_by, self.user)
+
+        tasks, *_ = self.assertSameSideEffects(status="")
+        self.assertEqual(
+            tasks,
+            [
+                (
+                    ("services.tasks.unsolve_puzzles",),
+                    {"args": [["a"]], "countdown": 60.0},
+                )
+            ],
+        )
+
+    def test_meta_feeders(self):
+        saved = self.side_effects(self.save, "c", is_meta=True)
+        updated = self.side_effects(self.bulk_update, "d", is_meta=True)
+        self.assertEqual(saved[4:], (True, {"a", "b", "d"}))
+        self.assertEqual(updated[4:], (True, {"a", "b", "c"}))
@@ -0,0 +1,74 @@
+from collections import defaultdict
+from unittest import mock
+
+from django import test
+from django.db import transaction
+
+from . import api
+from . import changes
+from . import models
+
+
+class ChangesTestCase(test.TestCase):
+    def setUp(self):
+        self.round = models.Round.objects.create(slug="r", name="R")
+        self.meta = models.Puzzle.objects.create(slug="m", name="M")
+        self.puzzle = models.Puzzle.objects.create(slug="p", name="P")
+
+    def committed_changes(self, write):
+        """The sections marked changed by `write`, once its transaction commits."""
+        with mock.patch.object(changes, "flush") as flush:
+            with self.captureOnCommitCallbacks(execute=True):
+                write()
+        marked = defaultdict(set)
+        for (batch,), _ in flush.call_args_list:
+            for section, keys in batch.items():
+                marked[section].update(keys)
+        return marked
+
+    def test_m2m_add_remove(self):
+        marked = self.committed_changes(
+            lambda: self.round.puzzles.add(self.puzzle, through_defaults={"order": 0})
+        )
+        self.assertEqual(
+            marked, {"rounds": {self.round.pk}, "puzzles": {self.puzzle.pk}}
+        )
+        self.assertEqual(
+            api.data_partial(marked)["rounds"][self.round.pk]["puzzles"],
+            [self.puzzle.pk],
+        )
+
+        marked = self.committed_changes(lambda: self.round.puzzles.remove(self.puzzle))
+        self.assertEqual(
+            marked, {"rounds": {self.round.pk}, "puzzles": {self.puzzle.pk}}
+        )
+        self.assertEqual(
+            api.data_partial(marked)["rounds"][self.round.pk]["puzzles"], []
+        )
+
+        self.round.puzzles.add(self.puzzle, through_defaults={"order": 0})
+        marked = self.committed_changes(lambda: self.puzzle.rounds.clear())
+        self.assertEqual(
+            marked, {"rounds": {self.round.pk}, "puzzles": {self.puzzle.pk}}
+        )
+
+    def test_meta_feeder_delete(self):
+        relation = models.MetaFeeder.objects.create(meta=self.meta, feeder=self.puzzle)
+        marked = self.committed_changes(relation.delete)
+        self.assertEqual(marked, {"puzzles": {self.meta.pk, self.puzzle.pk}})
+        data = api.data_partial(marked)["puzzles"]
+        self.assertEqual(data[self.meta.pk]["feeders"], [])
+        self.assertEqual(data[self.puzzle.pk]["metas"], [])
+
+    def test_rollback(self):
+        def write():
+            try:
+                with transaction.atomic():
+                    models.Round.objects.create(slug="rolled-back", name="X")
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            self.puzzle.save(update_fields=["name"])
+
+        marked = self.committed_changes(write)
+        self.assertEqual(marked, {"puzzles": {self.puzzle.pk}})
@@ -1,9 +1,130 @@
+import asyncio
+from collections import deque
+import concurrent.futures
+import copy
+import json
+from unittest import mock
+import zlib
+
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
 from django import test
+from django.conf import settings
+import msgpack
 
+from . import api
 from . import consumers
+from . import encoding
+from .benchmarking import reference_diff, synthetic_hunt
+
+
+class FullChannelLayer(InMemoryChannelLayer):
+    """A channel layer that drops every message sent to a channel."""
+
+    async def send(self, channel, message):
+        raise ChannelFull()
+
+
+def connected_client():
+    """
+    A connected client, a function to broadcast a version to it and one to
+    receive its next request to the master.
+    """
+    client = consumers.ClientConsumer()
+    client.channel_layer = InMemoryChannelLayer()
+    client.channel_name = "client"
+    client.msgpack = client.compress = client.lazy = False
+    client.outbox = deque()
+    client.outbox_deltas = 0
+    client.outbox_ready = asyncio.Event()
+    client.fetching = True
+    client.version = 0
+    client.timestamp = None
+    client.acked = None
+    client.stalled = False
+    client.stalled_deltas = 0
+
+    def update(version, **kwargs):
+        async_to_sync(client.client_update)(
+            {"version": version, "timestamp": 0, "update": str(version), **kwargs}
+        )
+
+    def master_request():
+        return async_to_sync(client.channel_layer.receive)(
+            consumers.MASTER_CHANNEL_NAME
+        )
+
+    return client, update, master_request
+
+
+def idle_master():
+    """A master with an empty snapshot that never rebuilds it."""
+    master = consumers.BroadcastMasterConsumer()
+    master.channel_layer = FullChannelLayer()
+    master.version = 1
+    master.built = []
+
+    def build_in_thread(version, data, changes):
+        master.built.append(changes)
+
+    master.build_in_thread = build_in_thread
+    return master
+
+
+def run_master(master, messages, duration):
+    """Handle `messages`, then let the master's timers run for `duration` s."""
+
+    async def run():
+        master.loop = asyncio.get_running_loop()
+        for message in messages:
+            await master.dispatch(message)
+        await asyncio.sleep(duration)
+
+    asyncio.run(run())
 
 
+@test.override_settings(METRICS_FLUSH_INTERVAL=None)
 class ConsumerTestCase(test.SimpleTestCase):
+    def test_flush_without_channel_layer(self):
+        # the debounce timer fires even if the channel is full
+        master = idle_master()
+        update = {"type": "server.maybe_update", "changes": {"puzzles": ["a"]}}
+        run_master(master, [update, update], settings.BROADCAST_MAX_LATENCY + 0.2)
+        self.assertEqual(master.built, [{"puzzles": {"a"}}])
+        self.assertFalse(master.flush_scheduled)
+        self.assertIsNone(master.rebuild)
+        # and the next update is flushed again
+        run_master(master, [update], settings.BROADCAST_MAX_LATENCY + 0.2)
+        self.assertEqual(len(master.built), 2)
+
+    def test_activity_tick_without_channel_layer(self):
+        master = idle_master()
+        master.presence = mock.Mock()
+        activity = {"uid": 1, "tab": "tab", "puzzle": "a"}
+        run_master(
+            master,
+            [{"type": "client.query", "activity": activity}],
+            settings.ACTIVITY_BROADCAST_INTERVAL + 0.2,
+        )
+        self.assertFalse(master.activity_tick_scheduled)
+        self.assertEqual(master.pending_activities, {})
+        self.assertEqual(master.activity_sent[(1, "tab")][1], activity)
+
+    def test_stale_rebuilt(self):
+        master = idle_master()
+        # a notification with no rebuild in flight is ignored
+        master.server_rebuilt({"type": "server.rebuilt"})
+        # as is one for another rebuild
+        future = concurrent.futures.Future()
+        future.set_result(None)
+        pending = consumers.PendingUpdate()
+        master.rebuild = (future, pending)
+        master.server_rebuilt({"type": "server.rebuilt", "future": object()})
+        self.assertEqual(master.rebuild, (future, pending))
+        master.server_rebuilt({"type": "server.rebuilt", "future": future})
+        self.assertIsNone(master.rebuild)
+
     def test_diff_equal(self):
         data, update = consumers.diff(
             {
@@ -55,3 +176,323 @@ class ConsumerTestCase(test.SimpleTestCase):
                 },
             },
         )
+
+    def test_apply_partial(self):
+        data = {
+            "hunt": {"root": ""},
+            "puzzles": {
+                "a": {"slug": "a", "status": "", "rounds": ["r"]},
+                "b": {"slug": "b", "status": "", "rounds": []},
+            },
+            "round_order": ["r"],
+        }
+        original = copy.deepcopy(data)
+        new_data, delta, roots = consumers.apply_partial(
+            data,
+            {
+                "puzzles": {
+                    "a": {"slug": "a", "status": "solved", "rounds": ["r"]},
+                    "b": None,
+                    "c": {"slug": "c", "status": "", "rounds": []},
+                },
+                "round_order": ["r"],
+            },
+        )
+        self.assertEqual(
+            roots,
+            {
+                "puzzles": {
+                    "a": {"status": True},
+                    "b": True,
+                    "c": True,
+                },
+            },
+        )
+        self.assertEqual(
+            delta,
+            {
+                "puzzles": {
+                    "a": {"status": "solved"},
+                    "c": {"slug": "c", "status": "", "rounds": []},
+                },
+            },
+        )
+        self.assertEqual(set(new_data["puzzles"].keys()), {"a", "c"})
+        self.assertEqual(new_data["puzzles"]["a"]["status"], "solved")
+        self.assertIs(new_data["hunt"], data["hunt"])
+        self.assertEqual(data, original)
+
+    def test_diff_matches_reference(self):
+        old = synthetic_hunt(1000)
+        new = copy.deepcopy(old)
+        new["puzzles"]["puzzle-3"]["status"] = "solved"
+        new["puzzles"]["puzzle-3"]["answer"] = "ANSWER"
+        new["puzzles"]["puzzle-8"]["tags"]["type"] = "logic"
+        del new["puzzles"]["puzzle-9"]
+        new["puzzles"]["puzzle-new"] = copy.deepcopy(old["puzzles"]["puzzle-9"])
+        new["rounds"]["round-0"]["puzzles"].append("puzzle-new")
+        for pair in ((old, new), (new, old), (old, copy.deepcopy(old))):
+            self.assertEqual(
+                json.dumps(consumers.diff(*pair), sort_keys=True),
+                json.dumps(reference_diff(*pair), sort_keys=True),
+            )
+
+    def test_takeover(self):
+        versions = [synthetic_hunt(10)]
+        versions[0]["users"] = {1: {"id": 1, "username": "a"}}
+        versions.append(copy.deepcopy(versions[0]))
+        versions[1]["puzzles"]["puzzle-3"]["status"] = "solved"
+        del versions[1]["puzzles"]["puzzle-4"]
+        versions.append(copy.deepcopy(versions[1]))
+        versions[2]["users"][2] = {"id": 2, "username": "b"}
+        versions[2]["rounds"]["round-0"]["puzzles"] = []
+        deltas = []
+        for version in (1, 2):
+            delta, roots = consumers.diff(versions[version - 1], versions[version])
+            update = {
+                "prev_version": version,
+                "version": version + 1,
+                "data": delta,
+                "roots": roots,
+            }
+            deltas.append((version, version + 1, encoding.dumps(update)))
+        state = {"version": 3, "timestamp": 0, "section_versions": {}}
+        checkpoint = encoding.loads(encoding.dumps(versions[0]))
+
+        def take_over(saved):
+            master = consumers.BroadcastMasterConsumer()
+            master.store = mock.Mock(**{"load.return_value": saved})
+            master.update = mock.Mock()
+            master.checkpoint_snapshot = mock.Mock()
+            with mock.patch.object(
+                consumers.api, "data_everything", return_value=versions[2]
+            ) as data_everything:
+                master.maybe_init()
+            return master, data_everything
+
+        # the checkpoint is brought up to date with the saved deltas
+        master, data_everything = take_over((state, 1, checkpoint, deltas))
+        self.assertEqual(master.version, 3)
+        self.assertEqual(master.data, versions[2])
+        self.assertEqual(master.history.since(1, 3), [delta[1:] for delta in deltas])
+        master.update.assert_called_once_with(None)
+        data_everything.assert_not_called()
+        # unless they do not reach back to it
+        master, data_everything = take_over((state, 1, checkpoint, deltas[1:]))
+        self.assertEqual(master.version, 4)
+        self.assertEqual(master.data, versions[2])
+        self.assertIsNone(master.history.since(3, 4))
+        master.checkpoint_snapshot.assert_called_once_with()
+
+    def test_delta_history(self):
+        history = consumers.DeltaHistory(max_length=3, max_bytes=100)
+        for version in range(1, 6):
+            history.add(version, version + 1, f"update{version}")
+        self.assertEqual(history.since(5, 6), [(6, "update5")])
+        self.assertEqual(
+            history.since(3, 6),
+            [(4, "update3"), (5, "update4"), (6, "update5")],
+        )
+        self.assertEqual(history.since(6, 6), [])
+        self.assertIsNone(history.since(2, 6))
+        self.assertIsNone(history.since(None, 6))
+        history.add(6, 7, "x" * 95)
+        self.assertIsNone(history.since(5, 7))
+        self.assertEqual(history.since(6, 7), [(7, "x" * 95)])
+
+    def test_variant_broadcasts(self):
+        master = idle_master()
+        master.channel_layer = InMemoryChannelLayer()
+        master.data = {}
+        master.section_versions = {}
+        master.presence = mock.Mock(current=lambda: [])
+        master.store = mock.Mock()
+        master.checkpoint_snapshot = mock.Mock()
+        for variant in consumers.VARIANTS:
+            async_to_sync(master.channel_layer.group_add)(
+                consumers.variant_group(variant), variant
+            )
+
+        def receive(channel):
+            return async_to_sync(master.channel_layer.receive)(channel)
+
+        payload = {
+            "prev_version": 1,
+            "version": 2,
+            "data": {"hunt": {"name": "hunt"}},
+            "roots": {"hunt": True},
+        }
+        update = encoding.dumps(payload)
+        rebuild = consumers.Rebuild(
+            version=2,
+            data={},
+            roots=payload["roots"],
+            update=update,
+            frames=consumers.encode_delta(payload, update),
+            build_time=0,
+            stages={},
+        )
+        with mock.patch.object(consumers, "metrics"):
+            master.commit(rebuild)
+        # the delta is saved with the version, the snapshot in the background
+        self.assertEqual(master.store.save.call_args.args[1], update)
+        master.checkpoint_snapshot.assert_called_once_with()
+        # each client only gets the encoding it uses
+        message = receive("json")
+        self.assertEqual(message["update"], update)
+        self.assertNotIn("packed", message)
+        message = receive("msgpack")
+        self.assertEqual(msgpack.unpackb(message["packed"]), payload)
+        self.assertNotIn("update", message)
+        # and catches up from the history in it
+        master.client_query(
+            {
+                "type": "client.query",
+                "fetch": True,
+                "channel": "msgpack",
+                "since": 1,
+                "msgpack": True,
+            }
+        )
+        message = receive("msgpack")
+        self.assertEqual(message["version"], 2)
+        self.assertEqual(msgpack.unpackb(message["packed"]), payload)
+        message = receive("msgpack")
+        self.assertEqual(msgpack.unpackb(message["packed"])["prev_version"], 2)
+
+    def test_section_versions(self):
+        master = idle_master()
+        master.channel_layer = InMemoryChannelLayer()
+        master.data = {
+            "hunt": {"name": "hunt"},
+            "rounds": {"r": {"name": "R"}},
+            "puzzles": {"a": {"name": "A"}},
+        }
+        master.section_versions = {key: 1 for key in master.data}
+        master.store = mock.Mock()
+        master.checkpoint_snapshot = mock.Mock()
+        before = master.encoded_snapshot()
+        encoded_rounds = master.encoded_sections[("rounds", False)]
+
+        with mock.patch.object(
+            api, "data_partial", return_value={"puzzles": {"a": {"name": "B"}}}
+        ):
+            rebuild = master.build(1, master.data, {"puzzles": {"a"}})
+        with mock.patch.object(consumers, "metrics"):
+            master.commit(rebuild)
+        # only the changed section is at the new version
+        self.assertEqual(
+            master.section_versions, {"hunt": 1, "rounds": 1, "puzzles": 2}
+        )
+        # and encoded again
+        after = master.encoded_snapshot()
+        self.assertEqual(after.version, 2)
+        self.assertIs(master.encoded_sections[("rounds", False)], encoded_rounds)
+        self.assertEqual(master.encoded_sections[("puzzles", False)][0], 2)
+        self.assertEqual(
+            encoding.loads(after.data),
+            {**encoding.loads(before.data), "puzzles": {"a": {"name": "B"}}},
+        )
+
+    @test.override_settings(WEBSOCKET_COMPRESSION_THRESHOLD=16)
+    def test_compressed_broadcasts(self):
+        payload = {"prev_version": 1, "version": 2, "data": {}, "roots": {}}
+        update = encoding.dumps(payload)
+        frames = consumers.encode_delta(payload, update)
+        # only clients that opted in get compressed frames, and only those
+        self.assertEqual(frames["json"], {"update": update})
+        self.assertEqual(
+            zlib.decompress(frames["deflate"]["compressed"]).decode(), update
+        )
+        self.assertNotIn("update", frames["deflate"])
+        with self.settings(WEBSOCKET_COMPRESSION_THRESHOLD=len(update) + 1):
+            self.assertEqual(
+                consumers.encode_delta(payload, update, ["deflate"]),
+                {"deflate": {"update": update}},
+            )
+
+    def test_lazy_catch_up(self):
+        master = idle_master()
+        master.channel_layer = InMemoryChannelLayer()
+        master.presence = mock.Mock(current=lambda: [])
+        notes = "x" * settings.LAZY_TEXT_THRESHOLD
+        payload = {
+            "prev_version": 1,
+            "version": 2,
+            "data": {"puzzles": {"a": {"notes": notes}}},
+            "roots": {"puzzles": {"a": {"notes": True}}},
+        }
+        update = encoding.dumps(payload)
+        frames = consumers.encode_delta(payload, update)
+        self.assertNotIn("lazy_update", frames["json"])
+        master.history.add(1, 2, update)
+        master.version = 2
+        # lazy clients catching up get the digests they would have been sent
+        master.client_query(
+            {
+                "type": "client.query",
+                "fetch": True,
+                "channel": "lazy",
+                "since": 1,
+                "lazy": True,
+            }
+        )
+        message = async_to_sync(master.channel_layer.receive)("lazy")
+        for key in ("update", "lazy_update", "text_changed"):
+            self.assertEqual(message[key], frames["lazy"][key])
+        self.assertEqual(message["text_changed"], ["puzzles/a"])
+        self.assertEqual(
+            encoding.loads(message["lazy_update"])["data"]["puzzles"]["a"]["notes"],
+            api.lazy_text_entry(notes),
+        )
+
+    def test_backlog_resync(self):
+        client, update, master_request = connected_client()
+        update(1)  # included in the fetch in flight
+        update(1, fetch=True)
+        self.assertEqual(list(client.outbox), [("1", False, None)])
+        # the client stops reading
+        for version in range(2, 1 + client.BACKLOG_LIMIT):
+            update(version)
+        self.assertEqual(len(client.outbox), client.BACKLOG_LIMIT)
+        update(1 + client.BACKLOG_LIMIT)
+        self.assertEqual(len(client.outbox), 0)
+        self.assertEqual(
+            master_request()["resync"],
+            {"reason": "slow", "collapsed": client.BACKLOG_LIMIT - 1},
+        )
+        # deltas until the snapshot arrives are dropped
+        update(2 + client.BACKLOG_LIMIT)
+        update(2 + client.BACKLOG_LIMIT, fetch=True)
+        update(3 + client.BACKLOG_LIMIT)
+        self.assertEqual(len(client.outbox), 2)
+        # a lost broadcast also resyncs
+        update(5 + client.BACKLOG_LIMIT)
+        self.assertEqual(master_request()["resync"], {"reason": "gap", "collapsed": 1})
+
+    def test_ack_lag_resync(self):
+        client, update, master_request = connected_client()
+
+        def ack(version):
+            async_to_sync(client.receive)(text_data=json.dumps({"version": version}))
+
+        update(1, fetch=True)
+        ack(1)
+        # frames are sent as soon as they are queued, but not read
+        for version in range(2, 2 + client.BACKLOG_LIMIT):
+            update(version)
+            client.outbox.clear()
+            client.outbox_deltas = 0
+        self.assertFalse(client.stalled)
+        update(2 + client.BACKLOG_LIMIT)
+        self.assertTrue(client.stalled)
+        # nothing more is sent until the client has caught up
+        update(3 + client.BACKLOG_LIMIT)
+        self.assertEqual(len(client.outbox), 0)
+        ack(client.BACKLOG_LIMIT)
+        self.assertTrue(client.stalled)
+        ack(1 + client.BACKLOG_LIMIT)
+        self.assertFalse(client.stalled)
+        request = master_request()
+        self.assertEqual(request["since"], 1 + client.BACKLOG_LIMIT)
+        self.assertEqual(request["resync"], {"reason": "slow", "collapsed": 2})
@@ -0,0 +1,69 @@
+from unittest import mock
+
+from django import test
+
+from . import edits
+from . import encoding
+from . import models
+from .fakes import FakeRedis
+
+
+class EditsTestCase(test.SimpleTestCase):
+    def test_flush_edits_interleaving(self):
+        redis = FakeRedis()
+        puzzle = models.Puzzle(slug="a", notes="saved")
+        saved = []
+
+        def buffer(field, value):
+            redis.hset(
+                edits.KEY,
+                edits._field_key(models.Puzzle, "a", field),
+                encoding.dumps({"value": value, "user": None, "time": 0}),
+            )
+
+        def select_for_update():
+            # the notes are saved directly while the flush waits for the row
+            edits.discard(models.Puzzle, "a", ["notes"])
+            return mock.Mock(in_bulk=lambda slugs: {"a": puzzle})
+
+        def bulk_update(objs, fields):
+            saved.append(fields)
+            # edited again before the flush commits
+            buffer("tags", {"newer": ""})
+
+        with (
+            mock.patch.object(edits.RedisManager, "instance", return_value=redis),
+            mock.patch.object(edits.app, "send_task"),
+            mock.patch.object(edits.transaction, "atomic"),
+            mock.patch.object(edits.changes, "mark_changed"),
+            mock.patch.object(models.Puzzle, "objects") as objects,
+        ):
+            objects.select_for_update.side_effect = select_for_update
+            objects.bulk_update.side_effect = bulk_update
+            buffer("notes", "older")
+            buffer("tags", {"older": ""})
+            self.assertEqual(edits.flush(), 1)
+        self.assertEqual(puzzle.notes, "saved")
+        self.assertEqual(puzzle.tags, {"older": ""})
+        self.assertEqual(saved, [["modified", "modified_by", "tags"]])
+        # the tombstone is removed but the newer edit is kept for the next flush
+        self.assertEqual(
+            redis.hkeys(edits.KEY),
+            [edits._field_key(models.Puzzle, "a", "tags").encode()],
+        )
+
+    def test_discard_saved(self):
+        puzzle = models.Puzzle(slug="a", notes="saved", tags={"a": ""})
+        puzzle._state.adding = False
+        puzzle.notes = "changed"
+        puzzle.tags["b"] = ""
+        with mock.patch.object(edits, "discard") as discard:
+            edits.discard_saved(models.Puzzle, puzzle)
+            edits.discard_saved(models.Puzzle, puzzle, update_fields={"notes"})
+            edits.discard_saved(models.Puzzle, puzzle, update_fields={"name"})
+            puzzle.notes = "saved"
+            edits.discard_saved(models.Puzzle, puzzle)
+        self.assertEqual(
+            [call.args[2] for call in discard.call_args_list],
+            [["notes", "tags"], ["notes"], [], ["tags"]],
+        )
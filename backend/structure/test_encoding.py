@@ -0,0 +1,72 @@
+import datetime
+import json
+
+from django import test
+import msgpack
+
+from . import encoding
+from .benchmarking import synthetic_hunt
+
+
+class EncodingTestCase(test.SimpleTestCase):
+    def test_msgpack_64_bit_ids(self):
+        snowflake = 1195126011530661948  # a Discord channel id
+        self.assertNotEqual(float(snowflake), snowflake)
+        created = datetime.datetime(2021, 1, 15, 17, tzinfo=datetime.timezone.utc)
+        row = {"discord_text_channel_id": snowflake, "created": created}
+        packed = encoding.packb(encoding.prepare_row(dict(row)))
+        # datetimes are converted by prepare_row or packb
+        self.assertEqual(
+            msgpack.unpackb(packed),
+            {"discord_text_channel_id": snowflake, "created": created.isoformat()},
+        )
+        self.assertEqual(
+            msgpack.unpackb(encoding.packb(row))["created"], created.isoformat()
+        )
+
+    def test_encoding_matches_stdlib(self):
+        data = synthetic_hunt(100)
+        data["puzzles"]["puzzle-0"][
+            "name"
+        ] = "Puzzle \u00e9 \u2713 \U0001f600 </script>"
+        # the same bytes as the stdlib encoder, and the same data as msgpack
+        self.assertEqual(encoding.dumps(data), json.dumps(data, separators=(",", ":")))
+        self.assertEqual(encoding.loads(encoding.dumps(data)), data)
+        self.assertEqual(msgpack.unpackb(encoding.packb(data)), data)
+
+    def test_json_encoder(self):
+        timestamp = datetime.datetime(2021, 1, 15, 17, tzinfo=datetime.timezone.utc)
+        data = {"created": timestamp, "link": "https://example.com/</script>"}
+        self.assertEqual(
+            json.loads(encoding.dumps(data)),
+            {"created": timestamp.isoformat(), "link": data["link"]},
+        )
+        self.assertNotIn("</script>", encoding.dumps(data, html_safe=True))
+        self.assertEqual(
+            json.loads(encoding.dumps(data, html_safe=True)),
+            json.loads(encoding.dumps(data)),
+        )
+
+    def test_prepare_row(self):
+        timestamp = datetime.datetime(2021, 1, 15, 17, tzinfo=datetime.timezone.utc)
+        row = {
+            "created": timestamp,
+            "solved": None,
+            "discord_text_channel_id": 2**63 - 1,
+        }
+        with self.settings(SNOWFLAKE_STRINGS=False):
+            self.assertEqual(encoding.format_version(), 1)
+            self.assertEqual(
+                encoding.prepare_row(dict(row)),
+                {**row, "created": "2021-01-15T17:00:00+00:00"},
+            )
+        with self.settings(SNOWFLAKE_STRINGS=True):
+            self.assertEqual(encoding.format_version(), 2)
+            self.assertEqual(
+                encoding.prepare_row(dict(row)),
+                {
+                    **row,
+                    "created": "2021-01-15T17:00:00+00:00",
+                    "discord_text_channel_id": "9223372036854775807",
+                },
+            )
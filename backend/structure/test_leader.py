@@ -0,0 +1,44 @@
+import threading
+from unittest import mock
+
+from channels.layers import InMemoryChannelLayer
+from django import test
+
+from . import leader
+from .management.commands.runmaster import MasterWorker
+
+
+class LeaderTestCase(test.SimpleTestCase):
+    def lease(self):
+        with mock.patch.object(leader.RedisManager, "instance"):
+            return leader.LeaderLease(ttl=60)
+
+    def test_lost_lease_stops_worker(self):
+        lease = self.lease()
+        worker = MasterWorker(
+            application=mock.AsyncMock(),
+            channels=["master"],
+            channel_layer=InMemoryChannelLayer(),
+        )
+        on_lost = mock.Mock(side_effect=worker.stopped.set)
+        lease.keep_alive(on_lost)
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        lease.lose()
+        lease.lose()
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        on_lost.assert_called_once_with()
+
+    def test_save_without_lease(self):
+        lease = self.lease()
+        on_lost = mock.Mock()
+        lease.keep_alive(on_lost)
+        self.addCleanup(setattr, leader.LeaderLease, "held", None)
+        leader.LeaderLease.held = lease
+        with mock.patch.object(leader.RedisManager, "instance") as instance:
+            # the script finds another master's token
+            instance.return_value.register_script.return_value.return_value = 0
+            with self.assertRaises(leader.LeaseLost):
+                leader.MasterStateStore().save({"version": 1}, "{}")
+        on_lost.assert_called_once_with()
@@ -0,0 +1,53 @@
+from unittest import mock
+
+from django import test
+
+from . import metrics
+
+
+@test.override_settings(METRICS_FLUSH_INTERVAL=None)
+class MetricsTestCase(test.SimpleTestCase):
+    def setUp(self):
+        for values in (
+            metrics._counts,
+            metrics._sums,
+            metrics._gauges,
+            metrics._shared_gauges,
+        ):
+            values.clear()
+
+    def test_metrics_bucket_order(self):
+        fields = [
+            metrics._series("h_bucket", {"stage": "sent", "le": le})
+            for le in ("+Inf", 10, 2.5, 0.5)
+        ]
+        self.assertEqual(
+            sorted(fields, key=metrics._sort_key),
+            [
+                'h_bucket{stage="sent",le="0.5"}',
+                'h_bucket{stage="sent",le="2.5"}',
+                'h_bucket{stage="sent",le="10"}',
+                'h_bucket{stage="sent",le="+Inf"}',
+            ],
+        )
+
+    def test_flush(self):
+        redis = mock.Mock()
+        pipeline = redis.pipeline.return_value
+        with mock.patch.object(metrics.RedisManager, "instance", return_value=redis):
+            metrics.increment("c", 2)
+            metrics.increment("c")
+            metrics.set_gauge("g", 1, lazy="true")
+            metrics.set_gauge("g", 2, lazy="true")
+            # nothing is written until the flush
+            redis.hset.assert_not_called()
+            metrics.flush()
+            pipeline.hincrby.assert_called_once_with(metrics.KEY, "c", 3)
+            pipeline.hset.assert_called_once_with(
+                metrics.KEY, mapping={'g{lazy="true"}': 2}
+            )
+            pipeline.execute.assert_called_once()
+            # and only what changed is written again
+            pipeline.reset_mock()
+            metrics.flush()
+            pipeline.execute.assert_not_called()
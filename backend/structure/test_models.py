@@ -0,0 +1,22 @@
+from django import test
+
+from . import models
+
+
+class ModelsTestCase(test.SimpleTestCase):
+    def test_puzzle_auto_fields(self):
+        puzzle = models.Puzzle(slug="a", name="A")
+        puzzle.status = "solved"
+        self.assertTrue(puzzle.became_solved())
+        self.assertEqual(
+            set(puzzle.set_auto_fields(True)), {"is_meta", "solved", "solved_by"}
+        )
+        self.assertTrue(puzzle.is_meta)
+        self.assertIsNotNone(puzzle.solved)
+
+        puzzle = models.Puzzle(
+            slug="b", name="B", status="solved", solved=puzzle.solved
+        )
+        puzzle.status = ""
+        self.assertTrue(puzzle.became_unsolved())
+        self.assertEqual(puzzle.set_auto_fields(False), [])
@@ -0,0 +1,39 @@
+from unittest import mock
+
+from django import test
+
+from . import presence
+from .fakes import FakeRedis
+
+
+class PresenceTestCase(test.SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(
+            presence.RedisManager, "instance", return_value=FakeRedis()
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_merge_and_expire(self):
+        # two processes share the store
+        first = presence.PresenceStore(ttl=10)
+        second = presence.PresenceStore(ttl=10)
+        with mock.patch.object(presence.time, "time", return_value=100):
+            first.update({"uid": 1, "tab": "a", "puzzle": "p"})
+            second.update({"uid": 2, "tab": "b", "puzzle": "q"})
+        with mock.patch.object(presence.time, "time", return_value=105):
+            first.update({"uid": 2, "tab": "b", "puzzle": "r"})
+            self.assertCountEqual(
+                second.current(),
+                [
+                    {"uid": 1, "tab": "a", "puzzle": "p"},
+                    {"uid": 2, "tab": "b", "puzzle": "r"},
+                ],
+            )
+        with mock.patch.object(presence.time, "time", return_value=112):
+            self.assertEqual(first.current(), [{"uid": 2, "tab": "b", "puzzle": "r"}])
+        with mock.patch.object(presence.time, "time", return_value=116):
+            self.assertEqual(second.current(), [])
+        # expired activities are pruned
+        self.assertEqual(first.redis.data[first.ACTIVITIES_KEY], {})
+        self.assertEqual(first.redis.data[first.EXPIRY_KEY], {})
@@ -0,0 +1,110 @@
+import functools
+from unittest import mock
+
+import crum
+from django import test
+from django.contrib.auth.models import User
+
+from . import changes
+from . import models
+from . import relations
+
+
+class RelationsTestCase(test.SimpleTestCase):
+    def test_order_between(self):
+        gap = models.RoundPuzzle.ORDER_GAP
+        between = functools.partial(relations._order_between, models.RoundPuzzle)
+        self.assertEqual(between(None, None), 0)
+        self.assertEqual(between(None, 0), -gap)
+        self.assertEqual(between(gap, None), 2 * gap)
+        self.assertEqual(between(0, gap), gap // 2)
+        # runs out after log2(gap) moves into the same place
+        before, after = 0, gap
+        for _ in range(16):
+            after = between(before, after)
+        self.assertEqual(after, 1)
+        self.assertIsNone(between(before, after))
+        self.assertIsNone(between(gap, gap))
+
+
+class BulkRelationsTestCase(test.TestCase):
+    def setUp(self):
+        self.round = models.Round.objects.create(slug="r", name="R")
+        self.meta = models.Puzzle.objects.create(slug="m", name="M", is_meta=True)
+        for slug in ("a", "b", "c"):
+            models.Puzzle.objects.create(slug=slug, name=slug.upper())
+        models.RoundPuzzle(round=self.round, puzzle=self.meta).save()
+
+    def feeders(self, meta_id):
+        return list(
+            models.MetaFeeder.objects.filter(meta_id=meta_id).values_list(
+                "feeder_id", flat=True
+            )
+        )
+
+    def test_add_remove(self):
+        gap = models.RoundPuzzle.ORDER_GAP
+        added = relations.add(
+            models.RoundPuzzle, [("r", "a"), ("r", "b"), ("r", "a"), ("r", "m")]
+        )
+        self.assertEqual(
+            [(type(relation), relation.pk is not None) for relation in added],
+            [(models.RoundPuzzle, True)] * 2 + [(models.MetaFeeder, True)] * 2,
+        )
+        self.assertEqual(
+            list(
+                models.RoundPuzzle.objects.filter(round_id="r").values_list(
+                    "puzzle_id", "order"
+                )
+            ),
+            [("m", 0), ("a", gap), ("b", 2 * gap)],
+        )
+        # derived from the round assigning its puzzles to its meta
+        self.assertEqual(self.feeders("m"), ["a", "b"])
+
+        self.assertEqual(
+            relations.remove(models.RoundPuzzle, [("r", "a"), ("r", "c")]), 1
+        )
+        self.assertEqual(
+            list(self.round.puzzles.values_list("pk", flat=True)), ["m", "b"]
+        )
+        # feeders stay, as when deleting the relation
+        self.assertEqual(self.feeders("m"), ["a", "b"])
+        self.assertEqual(relations.remove(models.RoundPuzzle, []), 0)
+
+    def test_add_feeder_makes_meta(self):
+        relations.add(models.RoundPuzzle, [("r", "a"), ("r", "b")])
+        relations.add(models.MetaFeeder, [("c", "a")])
+        self.assertTrue(models.Puzzle.objects.get(pk="c").is_meta)
+        self.assertEqual(self.feeders("c"), ["a"])
+
+        # a meta in the round gets the other puzzles of the round
+        models.MetaFeeder.objects.filter(meta_id="m").delete()
+        models.Puzzle.objects.filter(pk="m").update(is_meta=False)
+        relations.add(models.MetaFeeder, [("m", "c")])
+        self.assertTrue(models.Puzzle.objects.get(pk="m").is_meta)
+        self.assertEqual(self.feeders("m"), ["c", "a", "b"])
+
+    def test_touch(self):
+        user = User.objects.create(username="test")
+        before = models.Puzzle.objects.get(pk="a").modified
+        with mock.patch.object(changes, "mark_changed") as mark_changed:
+            with crum.impersonate(user):
+                relations.add(models.RoundPuzzle, [("r", "a")])
+        puzzle = models.Puzzle.objects.get(pk="a")
+        self.assertGreater(puzzle.modified, before)
+        self.assertEqual(puzzle.modified_by, user)
+        self.assertEqual(models.Round.objects.get(pk="r").modified_by, user)
+        marked = {
+            (model, key)
+            for (model, keys), _ in mark_changed.call_args_list
+            for key in keys
+        }
+        self.assertEqual(
+            marked,
+            {
+                (models.Round, "r"),
+                (models.Puzzle, "a"),
+                (models.Puzzle, "m"),
+            },
+        )
@@ -23,6 +23,8 @@ urlpatterns = [
     path("accounts/", include("rest_framework.urls", namespace="rest_framework")),
     path("api/", include(rest_router.urls)),
     path("api/everything", api.everything),
+    path("api/text", api.text),
+    path("api/search", api.search),
     path("api/discord_voice_move", api.discord_voice_move),
     path("api/scraper", api.scraper_view),
     path("", views.master),
@@ -31,4 +33,5 @@ urlpatterns = [
     path("extension/", views.extension),
     path("getting-started/", views.getting_started),
     path("google/", views.google_sheets_owner),
+    path("metrics", views.prometheus_metrics),
 ]
@@ -1,49 +1,73 @@
+import secrets
+import time
+
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseForbidden
 from django.shortcuts import redirect, render
 from django.template import TemplateDoesNotExist
+from django.utils.safestring import mark_safe
 from django.views.decorators.http import require_GET, require_POST
 from django.views.static import serve
 
 from rest_framework import renderers
 
 from . import api
+from . import encoding
+from . import metrics
+from . import models
 
 
-def render_app(request, page, props=None, **kwargs):
+def render_app(request, page, props=None, data_json=None, **kwargs):
+    """
+    Render `page` with `props`. `data_json` is an already encoded (and HTML
+    safe) value for `props["data"]`.
+    """
     template_name = "app.html"
     context = kwargs.get("context", {})
     context["page"] = page
-    if props is not None:
-        context["props"] = props
+    # encode like the api rather than with json_script so datetimes and
+    # Discord ids match what the websocket sends
+    props_json = encoding.dumps("" if props is None else props, html_safe=True)
+    if data_json is not None:
+        props_json = f'{props_json[:-1]}, "data": {data_json}}}'
+    context["props_json"] = mark_safe(props_json)
     kwargs["context"] = context
     return render(request, template_name, **kwargs)
 
 
+def render_app_with_data(request, page, props):
+    """
+    `render_app` with the hunt data (see `api.encoded_everything_with_uid`).
+    Records the snapshot cache hits and render time.
+    """
+    start = time.perf_counter()
+    data_json, source = api.encoded_everything_with_uid(request)
+    response = render_app(request, page, props, data_json=data_json)
+    metrics.increment("checkmate_page_data_total", source=source)
+    metrics.observe("checkmate_page_render_seconds", time.perf_counter() - start)
+    return response
+
+
 @login_required
 def master(request):
     page = "main"
-    data = api.data_everything_with_uid(request)
     props = {
         "page": "master",
-        "data": data,
     }
-    return render_app(request, page, props)
+    return render_app_with_data(request, page, props)
 
 
 @login_required
 def puzzle(request, slug):
-    data = api.data_everything_with_uid(request)
-    if slug not in data["puzzles"]:
+    if not models.Puzzle.objects.filter(pk=slug).exists():
         return redirect("/")
     page = "main"
     props = {
         "page": "puzzle",
         "slug": slug,
-        "data": data,
     }
-    return render_app(request, page, props)
+    return render_app_with_data(request, page, props)
 
 
 @login_required
@@ -66,3 +90,17 @@ def extension(request):
         "extension_version": settings.EXTENSION_VERSION,
     }
     return render_app(request, page, props)
+
+
+@require_GET
+def prometheus_metrics(request):
+    # for staff, or scrapers sending METRICS_TOKEN as a bearer token
+    token = settings.METRICS_TOKEN
+    authorization = request.headers.get("Authorization", "")
+    if not request.user.is_staff and not (
+        token and secrets.compare_digest(authorization, f"Bearer {token}")
+    ):
+        return HttpResponseForbidden()
+    return HttpResponse(
+        metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
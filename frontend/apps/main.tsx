@@ -54,6 +54,13 @@ interface MainProps {
 
 const isBlank = x => x === undefined || x === null;
 
+// not in the typescript dom lib yet
+const DecompressionStream = (window as any).DecompressionStream;
+const inflate = (buffer : ArrayBuffer) : Promise<string> => {
+  const stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream('deflate'));
+  return new Response(stream).text();
+};
+
 export const Main : React.FC<MainProps> = props => {
   const [slug, setSlug] = useState(props.page === 'puzzle' ? props.slug : undefined);
   const page = isBlank(slug) ? 'master' : 'puzzle';
@@ -323,9 +330,35 @@ export const Main : React.FC<MainProps> = props => {
       } catch (error) {}
     };
     const openWebsocket = (initial=false) => {
-      const socket = new WebSocket(`wss://${window.location.host}/ws/`);
+      // a known version lets the server send only the missed updates
+      const version = updateCacheRef.current?.version;
+      const query = isBlank(version) ? '' : `?version=${version}`;
+      // large payloads can be sent as deflate compressed binary frames
+      const protocols = DecompressionStream ? ['checkmate.deflate'] : [];
+      const socket = new WebSocket(`wss://${window.location.host}/ws/${query}`, protocols);
+      socket.binaryType = 'arraybuffer';
+      // decompression is asynchronous so chain messages to keep them in order
+      let received = Promise.resolve();
+      // echo back the last version received so the server can tell when this
+      // client falls behind
+      let receivedVersion = null;
+      let ackTimeoutId = null;
+      const ack = (version) => {
+        receivedVersion = version;
+        if (ackTimeoutId !== null) return;
+        ackTimeoutId = setTimeout(() => {
+          ackTimeoutId = null;
+          if (socket.readyState === WebSocket.OPEN) {
+            socket.send(JSON.stringify({version: receivedVersion}));
+          }
+        }, 1000);
+      };
       socket.addEventListener('message', (e) => {
-        const _data = JSONbig.parse(e.data);
+        const text = typeof e.data === 'string' ? e.data : inflate(e.data);
+        received = received.then(() => text).then(handleMessage).catch(console.error);
+      });
+      const handleMessage = (text) => {
+        const _data = JSONbig.parse(text);
         if (_data.data) {
           // update state data
           dataDispatch({
@@ -333,12 +366,19 @@ export const Main : React.FC<MainProps> = props => {
             cacheRef: updateCacheRef,
             update: _data,
           });
+          ack(_data.version);
+        }
+        // show edits of other users before they are saved
+        if (_data.edits) {
+          dataDispatch({
+            edits: _data.edits,
+          });
         }
         // update active users
         if (_data.activities) {
           dispatchActivity(_data.activities);
         }
-      });
+      };
       socket.addEventListener('open', (e) => {
         setIsConnected(true);
         if (initial) sendActivity();
@@ -30,6 +30,8 @@ export enum EditState {
   WAITING,
 }
 
+const WAITING_TIMEOUT = 5000; // ms
+
 interface TdEditableProps {
   value: string;
   editState?: EditState;
@@ -61,6 +63,9 @@ export const TdEditable : React.FC<TdEditableProps> = React.memo(({
 }) => {
   const [uid] = useState(uniqueId('datalist-uid-'));
   const prevValue = usePrevious(value);
+  const valueRef = useRef(value);
+  valueRef.current = value;
+  const patchCountRef = useRef(0);
   const internalEditStatePair = useState(EditState.DEFAULT);
   if (!editState) [editState, setEditState] = internalEditStatePair;
   const inputRef = useRef(null);
@@ -100,6 +105,7 @@ export const TdEditable : React.FC<TdEditableProps> = React.memo(({
         if (inputRef.current.value === value) {
             setEditState(EditState.DEFAULT);
         } else {
+          const patchCount = ++patchCountRef.current;
           const func = async () => {
             const response = await patch(inputRef.current.value);
             if (response === null) {
@@ -108,6 +114,17 @@ export const TdEditable : React.FC<TdEditableProps> = React.memo(({
             }
             if (!response.ok) {
               setEditState(EditState.DEFAULT);
+            } else if (valueRef.current === inputRef.current?.value) {
+              // the new value arrived before the response
+              setEditState(EditState.DEFAULT);
+            } else {
+              // the new value normally follows shortly, but do not wait for
+              // it forever (eg when the server kept the previous value)
+              setTimeout(() => {
+                if (patchCount === patchCountRef.current) {
+                  setEditState(state => state === EditState.WAITING ? EditState.DEFAULT : state);
+                }
+              }, WAITING_TIMEOUT);
             }
           }
           func();
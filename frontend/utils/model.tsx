@@ -124,7 +124,21 @@ export interface DataUpdate {
   roots: any;
 }
 
-export const dataReducer = produce((draft : Draft<Data>, {ws, cacheRef, update} : {ws, cacheRef, update: DataUpdate}) : Data => {
+// edits acknowledged but not saved yet, by section, slug and field
+export interface DataEdits {
+  [section: string]: {[slug: string]: {[field: string]: any}};
+}
+
+export const dataReducer = produce((draft : Draft<Data>, {ws, cacheRef, update, edits} : {ws?, cacheRef?, update?: DataUpdate, edits?: DataEdits}) : Data => {
+  if (edits) {
+    // not versioned, the update that saves them follows
+    for (const [section, entities] of Object.entries(edits)) {
+      for (const [slug, values] of Object.entries(entities)) {
+        if (draft[section]?.[slug]) Object.assign(draft[section][slug], values);
+      }
+    }
+    return draft;
+  }
   update.reception_timestamp = Date.now();
   if (cacheRef.current === null) {
     cacheRef.current = {